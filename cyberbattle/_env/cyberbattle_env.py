@@ -10,7 +10,7 @@ import logging
 import sys
 import networkx
 from networkx import convert_matrix
-from typing import NamedTuple, Optional, Tuple, List, Dict, TypeVar, TypedDict, cast, OrderedDict
+from typing import FrozenSet, NamedTuple, Optional, Set, Tuple, List, Dict, TypeVar, TypedDict, cast, OrderedDict
 # from collections import OrderedDict
 
 import numpy
@@ -25,7 +25,9 @@ from cyberbattle._env.defender import DefenderAgent
 from cyberbattle.simulation.model import PortName, PrivilegeLevel
 from cyberbattle.simulation.actions import Reward
 from ..simulation import commandcontrol, model, actions
+from ..simulation.tracing import EventKind, EventTracer
 from .discriminatedunion import DiscriminatedUnion
+from . import state_hash
 from cyberbattle.simulation.config import logger
 
 # logger = logging.getLogger(__name__)
@@ -174,7 +176,9 @@ StepInfo = TypedDict(
         'network_availability': float,
         'profile_str': str,
         'precondition_str': str,
-        'reward_string': str
+        'reward_string': str,
+        # true if the episode ended because no action could change the state anymore
+        'dead_end': bool
     })
 
 
@@ -351,8 +355,8 @@ class CyberBattleEnv(gym.Env):
         self.__credential_cache: List[model.CachedCredential] = []
         self.__episode_rewards: List[float] = []
         # The actuator used to execute actions in the simulation environment
-        self._actuator = actions.AgentActions(self.__environment, throws_on_invalid_actions=self.__throws_on_invalid_actions)
-        self._actuator = actions.AgentActions(self.__environment, throws_on_invalid_actions=self.__throws_on_invalid_actions)
+        self._actuator = actions.AgentActions(self.__environment, throws_on_invalid_actions=self.__throws_on_invalid_actions,
+                                              tracer=self.__tracer)
         self._defender_actuator = actions.DefenderAgentActions(self.__environment)
 
         self.__stepcount = 0
@@ -364,6 +368,102 @@ class CyberBattleEnv(gym.Env):
             if node_data.agent_installed:
                 self.__discovered_nodes.append(node_id)
 
+        # Zobrist hash of the attacker-visible state and the facts already folded into it
+        self.__state_hash = state_hash.ZobristHash()
+        self.__hashed_node_count = 0
+        self.__hashed_credential_count = 0
+        self.__hashed_profiles: List[state_hash.Token] = []
+        self.__hashed_ip_local = False
+        self.__hashed_nodes: Dict[model.NodeID, Tuple[int, FrozenSet[int]]] = {}
+        self.__update_state_hash()
+
+        # valid actions tried since the state hash last changed, for dead-end detection
+        self.__tried_since_change: Set[Tuple[str, Tuple[int, ...]]] = set()
+        self.__live_action_count: Tuple[int, int] = (-1, 0)
+
+    def __update_state_hash(self) -> None:
+        """Fold the state changes since the last update into the Zobrist state hash"""
+        zobrist = self.__state_hash
+
+        # discovered nodes and cached credentials are only ever appended
+        for node_id in self.__discovered_nodes[self.__hashed_node_count:]:
+            zobrist.toggle(('node', node_id))
+        self.__hashed_node_count = len(self.__discovered_nodes)
+
+        for credential in self.__credential_cache[self.__hashed_credential_count:]:
+            zobrist.toggle(('credential', credential.node, credential.port, credential.credential))
+        self.__hashed_credential_count = len(self.__credential_cache)
+
+        # discovered profiles get appended or updated in place
+        for index, profile in enumerate(self.__discovered_profiles):
+            token = state_hash.profile_token(profile)
+            if index == len(self.__hashed_profiles):
+                self.__hashed_profiles.append(token)
+                zobrist.toggle(token)
+            elif self.__hashed_profiles[index] != token:
+                zobrist.toggle(self.__hashed_profiles[index])
+                zobrist.toggle(token)
+                self.__hashed_profiles[index] = token
+
+        if self.__ip_local != self.__hashed_ip_local:
+            zobrist.toggle(('ip.local',))
+            self.__hashed_ip_local = self.__ip_local
+
+        # privilege levels and discovered properties change inside the actuator
+        # (and through the defender), so compare them against the hashed values
+        no_properties: FrozenSet[int] = frozenset()
+        for node_id in self.__discovered_nodes:
+            level = int(self._actuator.get_node_privilegelevel(node_id))
+            properties = self._actuator.get_discovered_properties(node_id) \
+                if self._actuator.is_node_discovered(node_id) else no_properties
+            hashed_level, hashed_properties = self.__hashed_nodes.get(node_id, (PrivilegeLevel.NoAccess, no_properties))
+            if level == hashed_level and properties == hashed_properties:
+                continue
+            if level != hashed_level:
+                if hashed_level != PrivilegeLevel.NoAccess:
+                    zobrist.toggle(('privilege', node_id, hashed_level))
+                if level != PrivilegeLevel.NoAccess:
+                    zobrist.toggle(('privilege', node_id, level))
+            for property_index in properties ^ hashed_properties:
+                zobrist.toggle(('property', node_id, property_index))
+            self.__hashed_nodes[node_id] = (level, frozenset(properties))
+
+    def __count_live_actions(self) -> int:
+        """Number of valid actions in the current state, except connections to owned nodes"""
+        counted_at, count = self.__live_action_count
+        if counted_at != self.__state_hash.value:
+            mask = self.obs['action_mask']
+            owned = self.__get__owned_nodes_indices()
+            count = numpy.count_nonzero(mask['local_vulnerability']) + \
+                numpy.count_nonzero(mask['remote_vulnerability']) + \
+                numpy.count_nonzero(mask['connect']) - numpy.count_nonzero(mask['connect'][:, owned])
+            self.__live_action_count = (self.__state_hash.value, count)
+        return count
+
+    def __dead_end_reached(self, action: Action, action_valid: bool, state_hash_before: int) -> bool:
+        """Record an action taken in the current state and tell whether
+        all the live actions of the state were tried without changing it"""
+        if self.__state_hash.value != state_hash_before:
+            self.__tried_since_change.clear()
+            return False
+
+        kind = DiscriminatedUnion.kind(action)
+        coordinates = tuple(int(c) for c in action[kind])  # type: ignore
+        if action_valid and not (kind == 'connect' and self.is_node_owned(coordinates[1])):
+            self.__tried_since_change.add((kind, coordinates))
+
+        return len(self.__tried_since_change) >= self.__count_live_actions()
+
+    def state_hash(self) -> int:
+        """Return a 64-bit hash of the attacker-visible state: discovered nodes,
+        privilege levels of owned nodes, discovered properties, cached credentials,
+        discovered profiles and the ip.local flag.
+
+        The hash is maintained incrementally on every step. It does not depend on the
+        order in which entities were discovered and, unlike the builtin `hash()`,
+        is identical across processes and runs."""
+        return self.__state_hash.value
+
     @property
     def name(self) -> str:
         return "CyberBattleEnv"
@@ -457,6 +557,8 @@ class CyberBattleEnv(gym.Env):
                  renderer='',
                  observation_padding=False,
                  throws_on_invalid_actions=True,
+                 terminate_on_dead_end=False,
+                 tracer: Optional[EventTracer] = None,
                  ):
         """Arguments
         ===========
@@ -474,6 +576,11 @@ class CyberBattleEnv(gym.Env):
                                     to fit in `maximum_node_count` rows. Turn on this flag for gym agent that expects observations of fixed sizes.
         throws_on_invalid_actions - whether to raise an exception if the step function attempts an invalid action (e.g., running an attack from a node that's not owned)
                                     if set to False a negative reward is returned instead.
+        terminate_on_dead_end     - whether to end the episode as soon as every valid action that could still change the state
+                                    was already tried since the state last changed (the step info then has `dead_end` set).
+                                    Connecting to an owned node is never counted as such an action.
+        tracer                    - if set, records the internals of each step (chosen precondition, error type, reward components,
+                                    detection points triggered) in the ring buffer of the tracer, see `cyberbattle.simulation.tracing`.
         """
 
         self.__node_count = len(initial_environment.network.nodes.items())
@@ -502,6 +609,8 @@ class CyberBattleEnv(gym.Env):
         self.__renderer = renderer
         self.__observation_padding = observation_padding
         self.__throws_on_invalid_actions = throws_on_invalid_actions
+        self.__terminate_on_dead_end = terminate_on_dead_end
+        self.__tracer = tracer
 
         self.viewer = None
 
@@ -897,7 +1006,11 @@ class CyberBattleEnv(gym.Env):
 
             observation = self.obs
             if not self.is_action_valid(action, observation['action_mask']):
-                logger.warning(f"INVALID ACTION, through suspiciousness r={actions.Penalty.SUPSPICIOUSNESS} for action={action}")
+                if logger.isEnabledFor(logging.WARNING):
+                    logger.warning(f"INVALID ACTION, through suspiciousness r={actions.Penalty.SUPSPICIOUSNESS} for action={action}")
+                if self.__tracer is not None:
+                    self.__tracer.record(EventKind.INVALID_ACTION, source_node_id, target_node_id,
+                                         error_type=actions.ErrorType.OTHER.value, reward=actions.Penalty.SUPSPICIOUSNESS)
                 return actions.ActionResult(reward=actions.Penalty.SUPSPICIOUSNESS, outcome=None, precondition="", profile="", reward_string="")
 
             result = self._actuator.exploit_remote_vulnerability(
@@ -922,6 +1035,12 @@ class CyberBattleEnv(gym.Env):
                 self.__index_to_port_name(port_index),
                 self.__credential_cache[credential_cache_index].credential)
 
+            if self.__tracer is not None:
+                succeeded = isinstance(result.outcome, model.LateralMove) and result.reward >= 0
+                self.__tracer.record(EventKind.CONNECT, source_node_id, target_node_id, self.__index_to_port_name(port_index),
+                                     error_type=(actions.ErrorType.NOERROR if succeeded else actions.ErrorType.OTHER).value,
+                                     reward=result.reward)
+
             return result
 
         raise ValueError("Invalid discriminated union value: " + str(action))
@@ -1104,7 +1223,10 @@ class CyberBattleEnv(gym.Env):
             obs['newly_discovered_profiles_count'] = numpy.int32(newly_discovered_profiles_count)
 
         if isinstance(outcome, model.DetectionPoint):
-            logger.info(f"or WARNING (hidden from agent): detection point {outcome.detection_point_name} triggered on step={self.__stepcount}!")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(f"or WARNING (hidden from agent): detection point {outcome.detection_point_name} triggered on step={self.__stepcount}!")
+            if self.__tracer is not None:
+                self.__tracer.record(EventKind.DETECTION_POINT, detection_point=outcome.detection_point_name, reward=result.reward)
             if outcome.detection_point_name in self.__deception_tracker.keys():
                 self.__deception_tracker[outcome.detection_point_name].trigger_times += [self.__stepcount]
             else:
@@ -1356,7 +1478,13 @@ class CyberBattleEnv(gym.Env):
             raise RuntimeError("new episode must be started with env.reset()")
 
         self.__stepcount += 1
+        if self.__tracer is not None:
+            self.__tracer.step = self.__stepcount
         duration = time.time() - self.__start_time
+        dead_end = False
+        if self.__terminate_on_dead_end:
+            state_hash_before = self.__state_hash.value
+            action_valid = self.is_action_valid(action, self.obs['action_mask'])
         try:
             result = self.__execute_action(action)
             observation, reward = self.__observation_reward_from_action_result(result)
@@ -1367,6 +1495,7 @@ class CyberBattleEnv(gym.Env):
                 self._defender_actuator.on_attacker_step_taken()
                 self.__defender_agent.step(self.__environment, self._defender_actuator, self.__stepcount)
 
+            self.__update_state_hash()
             self.__owned_nodes_indices_cache = None
 
             if self.__attacker_goal_reached() or self.__defender_constraints_broken():
@@ -1375,6 +1504,10 @@ class CyberBattleEnv(gym.Env):
             elif self.__defender_goal_reached():
                 self.__done = True
                 reward = self.__LOSING_REWARD
+            elif self.__terminate_on_dead_end and self.__dead_end_reached(action, action_valid, state_hash_before):
+                logger.info(f"Dead end reached after {self.__stepcount} steps: all the valid actions were tried")
+                self.__done = True
+                dead_end = True
             # else:
             #     reward = max(0., reward)
 
@@ -1390,12 +1523,15 @@ class CyberBattleEnv(gym.Env):
             network_availability=self._defender_actuator.network_availability,
             precondition_str=result.precondition if isinstance(result.precondition, str) else str(result.precondition.expression),
             profile_str=result.profile,
-            reward_string=result.reward_string)
+            reward_string=result.reward_string,
+            dead_end=dead_end)
 
         return observation, reward, self.__done, info
 
     def reset(self) -> Observation:
         logger.warning("Resetting the CyberBattle environment")
+        if self.__tracer is not None and self.__stepcount:
+            self.__tracer.end_episode()
         self.__reset_environment()
         observation = self.__get_blank_observation()
         observation['action_mask'] = self.compute_action_mask()
@@ -1470,4 +1606,6 @@ class CyberBattleEnv(gym.Env):
         self.np_random, seed = seeding.np_random(seed)
 
     def close(self) -> None:
+        if self.__tracer is not None and self.__stepcount:
+            self.__tracer.end_episode()
         return None
@@ -8,6 +8,7 @@ import gym
 import numpy as np
 
 from .cyberbattle_env import AttackerGoal
+from .state_hash import zobrist_key
 
 
 def test_few_gym_iterations() -> None:
@@ -128,3 +129,52 @@ def test_wrap_spec(env_name) -> None:
     assert hasattr(env.spec, 'local_vulnerabilities')
     assert hasattr(env.spec, 'remote_vulnerabilities')
     assert hasattr(env.spec, 'dummy')
+
+
+def test_state_hash() -> None:
+    """The state hash tracks the attacker-visible state and is reproducible"""
+    env = gym.make('CyberBattleToyCtf-v0')
+    env.reset()
+    initial_hash = env.state_hash()
+
+    replay = gym.make('CyberBattleToyCtf-v0')
+    replay.reset()
+    assert replay.state_hash() == initial_hash
+
+    for _ in range(20):
+        action = env.sample_valid_action()
+        env.step(action)
+        replay.step(action)
+        assert env.state_hash() == replay.state_hash()
+
+    assert env.state_hash() != initial_hash
+
+    env.reset()
+    assert env.state_hash() == initial_hash
+
+
+def test_zobrist_key_is_process_independent() -> None:
+    """Keys must not depend on the per-process salt of the builtin `hash`"""
+    assert zobrist_key(('node', 'client')) == 0xb899202001c8e5b4
+
+
+def test_dead_end_termination() -> None:
+    """Trying every valid action without changing the state ends the episode"""
+    env = gym.make('CyberBattleTinyMicro-v1234', terminate_on_dead_end=True, attacker_goal=None).unwrapped
+    observation = env.reset()
+    tried = set()
+    state_hash = env.state_hash()
+    info = None
+    for _ in range(5000):
+        if env.state_hash() != state_hash:
+            state_hash = env.state_hash()
+            tried.clear()
+        untried = [(kind, tuple(c)) for kind, mask in observation['action_mask'].items()
+                   for c in np.argwhere(mask) if (kind, tuple(c)) not in tried]
+        assert untried, 'the dead end should have been detected'
+        kind, coordinates = untried[0]
+        tried.add((kind, coordinates))
+        observation, _, done, info = env.step({kind: np.array(coordinates, dtype=np.int32)})
+        if done:
+            break
+    assert info and info['dead_end']
@@ -0,0 +1,48 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Zobrist hashing of the attacker-visible simulation state
+
+Every elementary fact known to the attacker (a discovered node, a privilege
+level reached on a node, a discovered property, a cached credential, a
+discovered profile, the ip.local disclosure) is a token mapped to a random
+64-bit key. The state hash is the XOR of the keys of all the facts that
+currently hold, so adding or removing a fact is a single XOR.
+
+Keys are derived with blake2b from the token representation instead of the
+builtin `hash()`, which is salted per process for strings. The hash of a
+given state is therefore identical across processes and runs.
+"""
+
+import functools
+import hashlib
+from typing import Tuple, Union
+
+import cyberbattle.simulation.model as model
+
+Token = Tuple[Union[str, int], ...]
+
+
+@functools.lru_cache(maxsize=None)
+def zobrist_key(token: Token) -> int:
+    """Return the deterministic 64-bit key of a state token.
+    Tokens must only contain strings and integers."""
+    digest = hashlib.blake2b(repr(token).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def profile_token(profile: model.Profile) -> Token:
+    """Canonical token of a profile, independent of the iteration order of its roles"""
+    roles = tuple(sorted(profile.roles)) if profile.roles else ()
+    return ('profile', str(profile.username), str(profile.id), str(profile.ip)) + roles
+
+
+class ZobristHash:
+    """Incrementally maintained XOR of token keys"""
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def toggle(self, token: Token) -> None:
+        """Add the token to the hash if absent, remove it otherwise"""
+        self.value ^= zobrist_key(token)
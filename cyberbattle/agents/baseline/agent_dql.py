@@ -25,8 +25,8 @@ Requirements:
 from numpy import ndarray
 from cyberbattle._env import cyberbattle_env
 import numpy as np
-from typing import List, NamedTuple, Optional, Tuple, Union
-import random
+from typing import List, NamedTuple, Optional, Tuple
+import copy
 import os
 
 
@@ -134,33 +134,174 @@ class CyberBattleStateActionModel:
 
 
 class Transition(NamedTuple):
-    """One taken transition and its outcome"""
-    state: Union[Tuple[Tensor], List[Tensor]]
-    action: Union[Tuple[Tensor], List[Tensor]]
-    next_state: Union[Tuple[Tensor], List[Tensor]]
-    reward: Union[Tuple[Tensor], List[Tensor]]
+    """A batch of taken transitions and their outcome, one row per transition"""
+    state: Tensor
+    action: Tensor
+    next_state: Tensor
+    reward: Tensor
+    non_final: Tensor
+    index: Tensor
+    # importance-sampling weights (None for uniform sampling)
+    weight: Optional[Tensor] = None
+
+
+def compact_state_dtype(max_value: int) -> torch.dtype:
+    """Smallest tensor dtype holding state features with values in [0, max_value]"""
+    for dtype in (torch.uint8, torch.int16, torch.int32):
+        if max_value <= torch.iinfo(dtype).max:
+            return dtype
+    return torch.float32
 
 
 class ReplayMemory(object):
-    """Transition replay memory"""
+    """Transition replay memory
+
+    Transitions are stored in a ring buffer of preallocated contiguous tensors.
+    State features are small integers and are stored with a compact dtype,
+    they are converted back to float32 when a batch is sampled.
+
+    Parameters
+    ==========
+    capacity -- maximum number of transitions, the oldest are overwritten first
+    state_dim -- dimension of the state vectors
+    max_state_value -- upper bound of the state feature values
+    """
 
-    def __init__(self, capacity):
+    def __init__(self, capacity: int, state_dim: int, max_state_value: int):
         self.capacity = capacity
-        self.memory = []
+        state_dtype = compact_state_dtype(max_state_value)
+        self.states = torch.zeros((capacity, state_dim), dtype=state_dtype, device=device)
+        self.next_states = torch.zeros((capacity, state_dim), dtype=state_dtype, device=device)
+        self.actions = torch.zeros((capacity, 1), dtype=torch.long, device=device)
+        self.rewards = torch.zeros(capacity, dtype=torch.float32, device=device)
+        self.non_final = torch.zeros(capacity, dtype=torch.bool, device=device)
         self.position = 0
-
-    def push(self, *args):
-        """Saves a transition."""
-        if len(self.memory) < self.capacity:
-            self.memory.append(None)
-        self.memory[self.position] = Transition(*args)
+        self.size = 0
+
+    def push(self, state: ndarray, action: int, next_state: Optional[ndarray], reward: float) -> None:
+        """Saves a transition, `next_state` is None for final states."""
+        i = self.position
+        self.states[i] = torch.from_numpy(np.asarray(state))
+        self.actions[i, 0] = int(action)
+        self.rewards[i] = reward
+        if next_state is None:
+            self.next_states[i] = 0
+            self.non_final[i] = False
+        else:
+            self.next_states[i] = torch.from_numpy(np.asarray(next_state))
+            self.non_final[i] = True
         self.position = (self.position + 1) % self.capacity
-
-    def sample(self, batch_size):
-        return random.sample(self.memory, batch_size)
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample_indices(self, batch_size: int) -> Tensor:
+        """Uniformly sample transition indices (with replacement)"""
+        return torch.randint(self.size, (batch_size,), device=device)
+
+    def gather(self, indices: Tensor, weight: Optional[Tensor] = None) -> Transition:
+        """Assemble the batch of transitions at the given indices"""
+        return Transition(
+            state=self.states[indices].float(),
+            action=self.actions[indices],
+            next_state=self.next_states[indices].float(),
+            reward=self.rewards[indices],
+            non_final=self.non_final[indices],
+            index=indices,
+            weight=weight)
+
+    def sample(self, batch_size: int) -> Transition:
+        return self.gather(self.sample_indices(batch_size))
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
+
+
+class SumTree:
+    """Binary tree stored in an array where each inner node holds the sum of
+    its two children. Leaves hold the priorities of the replay memory slots.
+    Sampling proportionally to the priorities and updating priorities are
+    O(log n), and both are vectorized over a batch of slots."""
+
+    def __init__(self, capacity: int):
+        self.leaf_count = 1 << max(capacity - 1, 0).bit_length()
+        self.depth = self.leaf_count.bit_length() - 1
+        # node 1 is the root, node i has children 2i and 2i+1, leaves start at `leaf_count`
+        self.tree = np.zeros(2 * self.leaf_count, dtype=np.float64)
+
+    def total(self) -> float:
+        return float(self.tree[1])
+
+    def get(self, slots: np.ndarray) -> np.ndarray:
+        return self.tree[slots + self.leaf_count]
+
+    def update(self, slots: np.ndarray, priorities: np.ndarray) -> None:
+        """Set the priorities of the given slots and recompute the sums above them"""
+        nodes = slots + self.leaf_count
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes >> 1)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values: np.ndarray) -> np.ndarray:
+        """Return for each value in [0, total) the slot whose priority interval contains it"""
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = values.copy()
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values > self.tree[left]
+            values -= self.tree[left] * go_right
+            nodes = left + go_right
+        return nodes - self.leaf_count
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """Prioritized experience replay (Schaul et al. 2016, proportional variant)
+
+    Transitions are sampled with probability proportional to priority^alpha,
+    where the priority is the absolute TD error of the last time the
+    transition was replayed. New transitions get the maximum priority seen so
+    far so that they are replayed at least once. Batches carry the
+    importance-sampling weights correcting for the non-uniform sampling.
+
+    Parameters
+    ==========
+    alpha -- how much prioritization is used (0: uniform sampling)
+    beta -- importance-sampling correction exponent (1: full correction)
+    epsilon -- added to priorities so that no transition has zero probability
+    """
+
+    def __init__(self, capacity: int, state_dim: int, max_state_value: int,
+                 alpha: float = 0.6, beta: float = 0.4, epsilon: float = 1e-3):
+        super().__init__(capacity, state_dim, max_state_value)
+        self.alpha = alpha
+        self.beta = beta
+        self.epsilon = epsilon
+        self.sum_tree = SumTree(capacity)
+        self.max_priority = 1.0
+
+    def push(self, state: ndarray, action: int, next_state: Optional[ndarray], reward: float) -> None:
+        slot = self.position
+        super().push(state, action, next_state, reward)
+        self.sum_tree.update(np.array([slot]), np.array([self.max_priority ** self.alpha]))
+
+    def sample_indices(self, batch_size: int) -> Tensor:
+        # stratified sampling: one value drawn in each of `batch_size` equal segments of the total priority
+        total = self.sum_tree.total()
+        values = (np.arange(batch_size) + np.random.random_sample(batch_size)) * (total / batch_size)
+        slots = np.minimum(self.sum_tree.find(values), self.size - 1)
+        return torch.from_numpy(slots).to(device)
+
+    def sample(self, batch_size: int) -> Transition:
+        indices = self.sample_indices(batch_size)
+        probabilities = self.sum_tree.get(indices.cpu().numpy()) / self.sum_tree.total()
+        weights = (self.size * probabilities) ** (-self.beta)
+        weights /= weights.max()
+        return self.gather(indices, torch.as_tensor(weights, dtype=torch.float32, device=device))
+
+    def update_priorities(self, indices: Tensor, td_errors: Tensor) -> None:
+        """Update the priorities of replayed transitions from their new TD errors"""
+        priorities = td_errors.detach().abs().cpu().numpy().astype(np.float64) + self.epsilon
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.sum_tree.update(indices.cpu().numpy(), priorities ** self.alpha)
 
 
 class DQN(nn.Module):
@@ -192,6 +333,56 @@ class DQN(nn.Module):
         return self.head(x.view(x.size(0), -1))
 
 
+class DQNInference:
+    """Low-latency CPU forward pass of a `DQN`, for acting on a handful of
+    candidate actor states per step.
+
+    The network is traced and frozen with TorchScript, which removes the
+    Python module dispatch and inlines the weights, and is run without
+    autograd bookkeeping. Input states are copied to a preallocated float32
+    buffer shared with the input tensor.
+    The weights are a snapshot of the network at the last call to `refresh`."""
+
+    def __init__(self, dqn: DQN, max_batch_size: int = 1):
+        self.input_size = dqn.hidden_layer1.in_features
+        self.allocate_buffer(max_batch_size)
+        self.refresh(dqn)
+
+    def allocate_buffer(self, batch_size: int) -> None:
+        self.max_batch_size = batch_size
+        self.input_buffer = np.zeros((batch_size, self.input_size), dtype=np.float32)
+        self.input_tensor = torch.from_numpy(self.input_buffer)
+
+    def refresh(self, dqn: DQN) -> None:
+        """Take a snapshot of the current weights of the network"""
+        snapshot = copy.deepcopy(dqn).cpu().eval()
+        with torch.no_grad():
+            self.module = torch.jit.freeze(torch.jit.trace(snapshot, self.input_tensor[:1]))
+
+    def forward(self, states: ndarray) -> Tensor:
+        """Return the Q values of each state"""
+        n = len(states)
+        if n > self.max_batch_size:
+            self.allocate_buffer(n)
+        self.input_buffer[:n] = states
+        with torch.inference_mode():
+            return self.module(self.input_tensor[:n])
+
+    def lookup(self, states: ndarray, valid_actions: Optional[ndarray] = None) -> Tuple[List[int], List[float]]:
+        """Best action and its expected Q value for each state,
+        restricted to the valid actions of each state if a mask is provided"""
+        q_values = self.forward(states)
+        if valid_actions is not None:
+            q_values = mask_q_values(q_values, valid_actions)
+        expectedq, actions = q_values.max(1)
+        return actions.tolist(), expectedq.tolist()
+
+
+def mask_q_values(q_values: Tensor, valid_actions: ndarray) -> Tensor:
+    """Set the Q value of the invalid actions to -inf so that they are never the argmax"""
+    return q_values.masked_fill(torch.from_numpy(~valid_actions).to(q_values.device), float('-inf'))
+
+
 def random_argmax(array):
     """Just like `argmax` but if there are multiple elements with the max
     return a random index to break ties instead of returning the first one."""
@@ -229,6 +420,17 @@ class DeepQLearnerPolicy(Learner):
     batch_size    -- Deep Q-learning batch
     target_update -- Deep Q-learning replay frequency (in number of episodes)
     learning_rate -- the learning rate
+    prioritized_replay -- sample transitions by TD error instead of uniformly
+    priority_alpha, priority_beta -- prioritization and importance-sampling exponents of the prioritized replay
+    optimize_every -- optimize the model once every this many transitions stored in the replay memory
+    gradient_steps -- number of gradient steps (of `batch_size` samples each) every time the model is optimized
+    target_update_steps -- if set, update the target network every this many gradient steps
+                           instead of every `target_update` episodes
+    inference_refresh_steps -- if set, also act with the `DQNInference` engine while training,
+                               refreshing its weights every this many gradient steps
+                               (the engine is always used in evaluation mode)
+    mask_invalid_actions -- on exploit, pick the best action among the abstract actions that
+                            can be realized at the actor node instead of the best action overall
 
     Parameters from DeepDoubleQ paper
         - learning_rate = 0.00025
@@ -247,7 +449,15 @@ class DeepQLearnerPolicy(Learner):
                  batch_size: int,
                  learning_rate: float,
                  train_while_exploit: bool = True,
-                 reward_clip: Optional[Tuple[float, float]] = None):
+                 reward_clip: Optional[Tuple[float, float]] = None,
+                 prioritized_replay: bool = False,
+                 priority_alpha: float = 0.6,
+                 priority_beta: float = 0.4,
+                 optimize_every: int = 1,
+                 gradient_steps: int = 1,
+                 target_update_steps: Optional[int] = None,
+                 inference_refresh_steps: Optional[int] = None,
+                 mask_invalid_actions: bool = True):
 
         self.stateaction_model = CyberBattleStateActionModel(ep)
         self.batch_size = batch_size
@@ -255,21 +465,44 @@ class DeepQLearnerPolicy(Learner):
         self.learning_rate = learning_rate
         self.train_while_exploit = train_while_exploit
         self.reward_clip = reward_clip
+        self.mask_invalid_actions = mask_invalid_actions
 
         self.policy_net = DQN(ep).to(device)
         self.target_net = DQN(ep).to(device)
         self.target_net.load_state_dict(self.policy_net.state_dict())
         self.target_net.eval()
         self.target_update = target_update
+        self.target_update_steps = target_update_steps
+        self.optimize_every = optimize_every
+        self.gradient_steps = gradient_steps
+        self.transitions_count = 0
+        self.gradient_steps_done = 0
+
+        self.inference_refresh_steps = inference_refresh_steps
+        self.inference: Optional[DQNInference] = None
+        if inference_refresh_steps:
+            self.inference = DQNInference(self.policy_net, ep.maximum_node_count)
 
         self.optimizer = optim.RMSprop(self.policy_net.parameters(), lr=learning_rate)
-        self.memory = ReplayMemory(replay_memory_size)
+        state_space = self.stateaction_model.state_space
+        state_dim = len(state_space.dim_sizes)
+        max_state_value = int(np.max(state_space.dim_sizes)) - 1
+        self.prioritized_replay = prioritized_replay
+        if prioritized_replay:
+            self.memory = PrioritizedReplayMemory(replay_memory_size, state_dim, max_state_value,
+                                                  alpha=priority_alpha, beta=priority_beta)
+        else:
+            self.memory = ReplayMemory(replay_memory_size, state_dim, max_state_value)
 
         self.credcache_policy = CredentialCacheExploiter()
 
     def parameters_as_string(self):
         return f'γ={self.gamma}, lr={self.learning_rate}, replaymemory={self.memory.capacity},\n' \
-               f'batch={self.batch_size}, target_update={self.target_update}, reward_clip={1 if self.reward_clip else 0}'
+               f'batch={self.batch_size}, target_update={self.target_update}, reward_clip={1 if self.reward_clip else 0}' + \
+               (', per=1' if self.prioritized_replay else '') + \
+               (f', utd={self.gradient_steps}/{self.optimize_every}' if (self.gradient_steps, self.optimize_every) != (1, 1) else '') + \
+               (f', target_update_steps={self.target_update_steps}' if self.target_update_steps else '') + \
+               ('' if self.mask_invalid_actions else ', mask=0')
 
     def all_parameters_as_string(self) -> str:
         model = self.stateaction_model
@@ -283,19 +516,11 @@ class DeepQLearnerPolicy(Learner):
         if len(self.memory) < self.batch_size:
             return
 
-        transitions = self.memory.sample(self.batch_size)
-        # converts batch-array of Transitions to Transition of batch-arrays.
-        batch = Transition(*zip(*transitions))
-
-        # Compute a mask of non-final states and concatenate the batch elements
-        # (a final state would've been the one after which simulation ended)
-        non_final_mask = torch.tensor(tuple(map((lambda s: s is not None), batch.next_state)),
-                                      device=device, dtype=torch.bool)
-        non_final_next_states = torch.cat([s for s in batch.next_state
-                                           if s is not None])
-        state_batch = torch.cat(batch.state)
-        action_batch = torch.cat(batch.action)
-        reward_batch = torch.cat(batch.reward)
+        batch = self.memory.sample(self.batch_size)
+
+        state_batch = batch.state
+        action_batch = batch.action
+        reward_batch = batch.reward
         if self.reward_clip:
             reward_batch = 2 * (reward_batch - reward_batch.min()) / (reward_batch.max() - reward_batch.min()) - 1
 
@@ -309,17 +534,24 @@ class DeepQLearnerPolicy(Learner):
         state_action_values = output.gather(1, action_batch)
 
         # Compute V(s_{t+1}) for all next states.
-        # Expected values of actions for non_final_next_states are computed based
+        # Expected values of actions for next states are computed based
         # on the "older" target_net; selecting their best reward with max(1)[0].
-        # This is merged based on the mask, such that we'll have either the expected
-        # state value or 0 in case the state was final.
-        next_state_values = torch.zeros(self.batch_size, device=device)
-        next_state_values[non_final_mask] = self.target_net(non_final_next_states).max(1)[0].detach()
+        # This is masked such that we'll have either the expected
+        # state value or 0 in case the state was final
+        # (a final state would've been the one after which simulation ended).
+        next_state_values = self.target_net(batch.next_state).max(1)[0].detach() * batch.non_final
         # Compute the expected Q values
         expected_state_action_values = (next_state_values * self.gamma) + reward_batch
 
-        # Compute Huber loss
-        self.loss = F.smooth_l1_loss(state_action_values, expected_state_action_values.unsqueeze(1))
+        # Compute Huber loss, weighted by the importance-sampling weights with prioritized replay
+        if batch.weight is None:
+            self.loss = F.smooth_l1_loss(state_action_values, expected_state_action_values.unsqueeze(1))
+        else:
+            td_errors = state_action_values.squeeze(1) - expected_state_action_values
+            elementwise_loss = F.smooth_l1_loss(state_action_values.squeeze(1), expected_state_action_values, reduction='none')
+            self.loss = (batch.weight * elementwise_loss).mean()
+            assert isinstance(self.memory, PrioritizedReplayMemory)
+            self.memory.update_priorities(batch.index, td_errors)
 
         # Optimize the model
         self.optimizer.zero_grad()
@@ -335,6 +567,12 @@ class DeepQLearnerPolicy(Learner):
         self.optimizer.step()
         self.policy_net.eval()
 
+        self.gradient_steps_done += 1
+        if self.target_update_steps and self.gradient_steps_done % self.target_update_steps == 0:
+            self.target_net.load_state_dict(self.policy_net.state_dict())
+        if self.inference and self.inference_refresh_steps and self.gradient_steps_done % self.inference_refresh_steps == 0:
+            self.inference.refresh(self.policy_net)
+
     def get_actor_state_vector(self, global_state: ndarray, actor_features: ndarray) -> ndarray:
         return np.concatenate((np.array(global_state, dtype=np.float32),
                                np.array(actor_features, dtype=np.float32)))
@@ -347,54 +585,56 @@ class DeepQLearnerPolicy(Learner):
         # store the transition in memory
         # if self.reward_clip:
         #     reward = 2 * (reward - self.reward_clip[0]) / float(self.reward_clip[1] - self.reward_clip[0]) - 1
-        reward_tensor = torch.tensor([reward], device=device, dtype=torch.float)
-        action_tensor = torch.tensor([[np.int_(abstract_action)]], device=device, dtype=torch.long)
-        current_state_tensor = torch.as_tensor(actor_state, dtype=torch.float, device=device).unsqueeze(0)
-        if next_actor_state is None:
-            next_state_tensor = None
-        else:
-            next_state_tensor = torch.as_tensor(next_actor_state, dtype=torch.float, device=device).unsqueeze(0)
-        self.memory.push(current_state_tensor, action_tensor, next_state_tensor, reward_tensor)
+        self.memory.push(actor_state, abstract_action, next_actor_state, reward)
+        self.transitions_count += 1
 
-        # optimize the target network
-        self.optimize_model()
+        # optimize the policy network according to the update-to-data schedule
+        if self.transitions_count % self.optimize_every == 0:
+            for _ in range(self.gradient_steps):
+                self.optimize_model()
 
-    def on_step(self, wrapped_env: w.AgentWrapper,
-                observation, reward: float, done: bool, info, action_metadata):
-        agent_state = wrapped_env.state
+    def next_actor_state(self, wrapped_env: w.AgentWrapper, done: bool, action_metadata) -> Optional[ndarray]:
+        """State vector of the actor of the last step in the new environment state (None if the episode ended)"""
         if done:
-            self.update_q_function(reward,
-                                   actor_state=action_metadata.actor_state,
-                                   abstract_action=action_metadata.abstract_action,
-                                   next_actor_state=None)
-        else:
-            next_global_state = self.stateaction_model.global_features.get(agent_state, node=None)
-            next_actor_features = self.stateaction_model.node_specific_features.get(
-                agent_state, action_metadata.actor_node)
-            next_actor_state = self.get_actor_state_vector(next_global_state, next_actor_features)
+            return None
+        agent_state = wrapped_env.state
+        next_global_state = self.stateaction_model.global_features.get(agent_state, node=None)
+        next_actor_features = self.stateaction_model.node_specific_features.get(
+            agent_state, action_metadata.actor_node)
+        return self.get_actor_state_vector(next_global_state, next_actor_features)
 
-            self.update_q_function(reward,
-                                   actor_state=action_metadata.actor_state,
-                                   abstract_action=action_metadata.abstract_action,
-                                   next_actor_state=next_actor_state)
+    def on_step(self, wrapped_env: w.AgentWrapper,
+                observation, reward: float, done: bool, info, action_metadata):
+        self.update_q_function(reward,
+                               actor_state=action_metadata.actor_state,
+                               abstract_action=action_metadata.abstract_action,
+                               next_actor_state=self.next_actor_state(wrapped_env, done, action_metadata))
 
     def end_of_episode(self, i_episode, t):
         # Update the target network, copying all weights and biases in DQN
-        if i_episode % self.target_update == 0:
+        if not self.target_update_steps and i_episode % self.target_update == 0:
             self.target_net.load_state_dict(self.policy_net.state_dict())
 
-    def lookup_dqn(self, states_to_consider: ndarray) -> Tuple[List[np.int32], List[np.int32]]:
+    def lookup_dqn(self, states_to_consider: ndarray,
+                   valid_actions: Optional[ndarray] = None) -> Tuple[List[np.int32], List[np.int32]]:
         """ Given a set of possible current states return:
             - index, in the provided list, of the state that would yield the best possible outcome
-            - the best action to take in such a state"""
+            - the best action to take in such a state
+            If `valid_actions` is provided the best action of each state is picked among its valid actions"""
+        if self.inference:
+            return self.inference.lookup(states_to_consider, valid_actions)
+
         with torch.no_grad():
             # t.max(1) will return largest column value of each row.
             # second column on max result is index of where max element was
             # found, so we pick action with the larger expected reward.
             # action: np.int32 = self.policy_net(states_to_consider).max(1)[1].view(1, 1).item()
 
-            state_batch = torch.tensor(states_to_consider).to(device)
-            dnn_output = self.policy_net(state_batch).max(1)
+            state_batch = torch.from_numpy(np.ascontiguousarray(states_to_consider, dtype=np.float32)).to(device)
+            q_values = self.policy_net(state_batch)
+            if valid_actions is not None:
+                q_values = mask_q_values(q_values, valid_actions)
+            dnn_output = q_values.max(1)
             action_lookups = dnn_output[1].tolist()
             expectedq_lookups = dnn_output[0].tolist()
 
@@ -414,8 +654,7 @@ class DeepQLearnerPolicy(Learner):
     def explore(self, wrapped_env: w.AgentWrapper
                 ) -> Tuple[str, cyberbattle_env.Action, object]:
         """Random exploration that avoids repeating actions previously taken in the same state"""
-        # sample local and remote actions only (excludes connect action)
-        gym_action = wrapped_env.env.sample_valid_action(kinds=[0, 1, 2])
+        gym_action = wrapped_env.sample_untried_action()
         metadata = self.metadata_from_gymaction(wrapped_env, gym_action)
         return "explore", gym_action, metadata
 
@@ -453,6 +692,12 @@ class DeepQLearnerPolicy(Learner):
                 wrapped_env,
                 observation
                 ) -> Tuple[str, Optional[cyberbattle_env.Action], object]:
+        return self.exploit_batch([wrapped_env], [observation])[0]
+
+    def exploit_batch(self,
+                      wrapped_envs: List[w.AgentWrapper],
+                      observations: List
+                      ) -> List[Tuple[str, Optional[cyberbattle_env.Action], object]]:
 
         # first, attempt to exploit the credential cache
         # using the crecache_policy
@@ -460,30 +705,62 @@ class DeepQLearnerPolicy(Learner):
         # if gym_action:
         #     return action_style, gym_action, self.metadata_from_gymaction(wrapped_env, gym_action)
 
+        # Gather the actor state vectors of all the current active actors (i.e. owned nodes)
+        # of each environment in a single vectorized pass, then keep one actor per distinct state vector
+        active_actors = []
+        candidates = []
+        candidates_first_index = []
+        candidates_valid_actions = []
+        for wrapped_env, observation in zip(wrapped_envs, observations):
+            owned_nodes = w.owned_nodes(observation)
+            active_actors_states = self.stateaction_model.state_space.get_at_nodes(wrapped_env.state, owned_nodes)
+            candidate_actor_state_vector, candidate_first_index = np.unique(active_actors_states, axis=0, return_index=True)
+            if self.mask_invalid_actions:
+                # actions realizable from each candidate, candidates with none are dropped
+                valid_actions = self.stateaction_model.action_space.valid_actions_mask(
+                    owned_nodes[candidate_first_index], wrapped_env.state.observation)
+                has_valid_action = valid_actions.any(axis=1)
+                candidate_actor_state_vector = candidate_actor_state_vector[has_valid_action]
+                candidate_first_index = candidate_first_index[has_valid_action]
+                candidates_valid_actions.append(valid_actions[has_valid_action])
+            active_actors.append(owned_nodes)
+            candidates.append(candidate_actor_state_vector)
+            candidates_first_index.append(candidate_first_index)
+
+        # one Q lookup for the candidates of all the environments
+        action_lookups, expectedq_lookups = self.lookup_dqn(
+            np.concatenate(candidates),
+            np.concatenate(candidates_valid_actions) if self.mask_invalid_actions else None)
+
+        results = []
+        start = 0
+        for wrapped_env, owned_nodes, candidate_actor_state_vector, candidate_first_index in \
+                zip(wrapped_envs, active_actors, candidates, candidates_first_index):
+            end = start + len(candidate_actor_state_vector)
+            results.append(self.exploit_candidates(wrapped_env, owned_nodes, candidate_first_index,
+                                                   action_lookups[start:end], expectedq_lookups[start:end]))
+            start = end
+        return results
+
+    def exploit_candidates(self,
+                           wrapped_env,
+                           active_actors: ndarray,
+                           candidate_first_index: ndarray,
+                           remaining_action_lookups: List[int],
+                           remaining_expectedq_lookups: List[float]
+                           ) -> Tuple[str, Optional[cyberbattle_env.Action], object]:
+        """Try the candidate actors by decreasing expected Q value until one yields a valid gym action"""
         current_global_state = self.stateaction_model.global_features.get(wrapped_env.state, node=None)
-
-        # Gather the features of all the current active actors (i.e. owned nodes)
-        active_actors_features: List[ndarray] = [
-            self.stateaction_model.node_specific_features.get(wrapped_env.state, from_node)
-            for from_node in w.owned_nodes(observation)
-        ]
-
-        unique_active_actors_features: List[ndarray] = list(np.unique(active_actors_features, axis=0))
-
-        # array of actor state vector for every possible set of node features
-        candidate_actor_state_vector: ndarray = np.array([
-            self.get_actor_state_vector(current_global_state, node_features)
-            for node_features in unique_active_actors_features])
-
-        remaining_action_lookups, remaining_expectedq_lookups = self.lookup_dqn(candidate_actor_state_vector)
-        remaining_candidate_indices = list(range(len(candidate_actor_state_vector)))
+        remaining_candidate_indices = list(range(len(remaining_action_lookups)))
+        action_style = "exploit"
 
         while remaining_candidate_indices:
             _, remaining_candidate_index = random_argmax(remaining_expectedq_lookups)
             actor_index = remaining_candidate_indices[remaining_candidate_index]
             abstract_action = remaining_action_lookups[remaining_candidate_index]
 
-            actor_features = unique_active_actors_features[actor_index]
+            actor_features = self.stateaction_model.node_specific_features.get(
+                wrapped_env.state, active_actors[candidate_first_index[actor_index]])
 
             action_style, gym_action, metadata = self.try_exploit_at_candidate_actor_states(
                 wrapped_env,
@@ -507,6 +784,11 @@ class DeepQLearnerPolicy(Learner):
     def eval(self):
         self.policy_net.eval()
         self.target_net.eval()
+        # act with a frozen snapshot of the weights, the network does not change during evaluation
+        if self.inference:
+            self.inference.refresh(self.policy_net)
+        else:
+            self.inference = DQNInference(self.policy_net, self.stateaction_model.ep.maximum_node_count)
         self.prev_train_while_exploit = False
         if self.train_while_exploit:
             self.prev_train_while_exploit = True
@@ -515,31 +797,50 @@ class DeepQLearnerPolicy(Learner):
     def train(self):
         self.policy_net.train()
         self.target_net.train()
+        if self.inference_refresh_steps:
+            assert self.inference
+            self.inference.refresh(self.policy_net)
+        else:
+            self.inference = None
         if hasattr(self, 'prev_train_while_exploit'):
             self.train_while_exploit = self.prev_train_while_exploit
             delattr(self, 'prev_train_while_exploit')
 
+    def evaluation_snapshot(self) -> 'DeepQLearnerPolicy':
+        """Copy of the networks only, without the replay memory and optimizer state"""
+        snapshot = DeepQLearnerPolicy(self.stateaction_model.ep, gamma=self.gamma, replay_memory_size=1,
+                                      target_update=self.target_update, batch_size=self.batch_size,
+                                      learning_rate=self.learning_rate, train_while_exploit=False,
+                                      reward_clip=self.reward_clip, mask_invalid_actions=self.mask_invalid_actions)
+        snapshot.policy_net.load_state_dict(self.policy_net.state_dict())
+        snapshot.target_net.load_state_dict(self.target_net.state_dict())
+        return snapshot
+
     def save(self, filename: str, optimizer_save=False) -> None:
         logger.info("Saving policy_net, target_net " + optimizer_save * "and optimizer " + "parameters")
         if '.tar' not in filename:
             logger.warning("Checkpoint file should be of .tar format, got ." + filename.split('.')[-1])
         torch.save({**{'policy_net_state_dict': self.policy_net.state_dict(),
-                    'target_net_state_dict': self.policy_net.state_dict()},
+                    'target_net_state_dict': self.target_net.state_dict()},
                    **({'optimizer_state_dict': self.optimizer.state_dict()} if optimizer_save else {})}, filename)
 
     def load(self, filename: str, optimizer_load=True) -> None:
         checkpoint = torch.load(filename, map_location=device)
-        optimizer_saved = optimizer_load and 'optimzer_state_dict' in checkpoint.keys()
+        # checkpoints written by earlier versions stored the optimizer state under a misspelt key
+        optimizer_key = next((key for key in ['optimizer_state_dict', 'optimzer_state_dict'] if key in checkpoint), None)
+        optimizer_saved = optimizer_load and optimizer_key is not None
         logger.info("Loading policy_net, target_net " + optimizer_saved * "and optimizer " + "parameters")
         self.policy_net.load_state_dict(checkpoint['policy_net_state_dict'])
         self.target_net.load_state_dict(checkpoint['target_net_state_dict'])
         if optimizer_saved:
-            self.optimizer.load_state_dict(checkpoint['optimzer_state_dict'])
+            self.optimizer.load_state_dict(checkpoint[optimizer_key])
 
         self.policy_net.to(device)
         self.target_net.to(device)
         self.policy_net.eval()
         self.target_net.eval()
+        if self.inference:
+            self.inference.refresh(self.policy_net)
 
     def load_best(self, logdir_training: str, evaluation_ckpt=True, optimizer_load=True) -> None:
         filenames = [filename for filename in os.listdir(logdir_training)
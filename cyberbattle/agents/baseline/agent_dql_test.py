@@ -0,0 +1,138 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Test the components of the Deep Q-learning agent"""
+
+import gym
+import numpy as np
+import torch
+
+import cyberbattle.agents.baseline.agent_wrapper as w
+from cyberbattle.agents.baseline.agent_dql import DQN, DQNInference, DeepQLearnerPolicy, PrioritizedReplayMemory, ReplayMemory, SumTree
+
+
+def test_replay_memory_ring_buffer() -> None:
+    """Transitions are stored compactly, overwritten in FIFO order and gathered as float batches"""
+    memory = ReplayMemory(capacity=3, state_dim=2, max_state_value=99)
+    assert memory.states.dtype == torch.uint8
+    for i in range(4):
+        next_state = None if i == 3 else np.array([i + 1, 0], dtype=np.float32)
+        memory.push(np.array([i, 7], dtype=np.float32), i % 2, next_state, float(i))
+    assert len(memory) == 3
+
+    batch = memory.gather(torch.tensor([0, 1, 2]))
+    assert batch.state.dtype == torch.float32
+    assert batch.state[:, 0].tolist() == [3.0, 1.0, 2.0]
+    assert batch.action.shape == (3, 1)
+    assert batch.reward.tolist() == [3.0, 1.0, 2.0]
+    assert batch.non_final.tolist() == [False, True, True]
+
+    sample = memory.sample(16)
+    assert sample.state.shape == (16, 2)
+
+
+def test_sum_tree_sampling_and_updates() -> None:
+    """The sum tree maintains priority sums and maps values to their priority interval"""
+    tree = SumTree(5)
+    tree.update(np.array([0, 1, 2, 3, 4]), np.array([1.0, 2.0, 0.0, 3.0, 4.0]))
+    assert tree.total() == 10.0
+    slots = tree.find(np.array([0.5, 1.5, 2.9, 3.5, 5.9, 6.5, 9.9]))
+    assert slots.tolist() == [0, 1, 1, 3, 3, 4, 4]
+
+    tree.update(np.array([4, 4]), np.array([0.0, 0.0]))
+    assert tree.total() == 6.0
+
+
+def test_prioritized_replay_weights() -> None:
+    """High-priority transitions are sampled more and get lower importance-sampling weights"""
+    memory = PrioritizedReplayMemory(capacity=8, state_dim=1, max_state_value=10, alpha=1.0, beta=1.0)
+    for i in range(8):
+        memory.push(np.array([i], dtype=np.float32), 0, None, 0.0)
+    td_errors = torch.ones(8)
+    td_errors[3] = 10.0
+    memory.update_priorities(torch.arange(8), td_errors)
+
+    np.random.seed(0)
+    batch = memory.sample(64)
+    assert batch.weight is not None
+    assert (batch.index == 3).sum() > 24
+    assert batch.weight[batch.index == 3].max() < batch.weight[batch.index != 3].min()
+    assert torch.allclose(batch.weight.max(), torch.tensor(1.0))
+
+
+def test_update_to_data_schedule() -> None:
+    """The model is optimized `gradient_steps` times every `optimize_every` transitions"""
+    env = gym.make('CyberBattleToyCtf-v0')
+    ep = w.EnvironmentBounds.of_identifiers(maximum_node_count=12, maximum_total_credentials=10, identifiers=env.identifiers)
+    policy = DeepQLearnerPolicy(ep, gamma=0.9, replay_memory_size=100, target_update=10, batch_size=2, learning_rate=0.01,
+                                optimize_every=4, gradient_steps=3, target_update_steps=6)
+    state = np.zeros(len(policy.stateaction_model.state_space.dim_sizes), dtype=np.float32)
+    for _ in range(8):
+        policy.update_q_function(1.0, actor_state=state, abstract_action=np.int32(0), next_actor_state=state)
+    assert policy.gradient_steps_done == 6
+
+    # the target network was synchronized after the 6th gradient step
+    for target_param, policy_param in zip(policy.target_net.parameters(), policy.policy_net.parameters()):
+        assert torch.equal(target_param, policy_param)
+
+
+def test_inference_engine_matches_dqn() -> None:
+    """The inference engine agrees with the torch network and follows weight refreshes"""
+    env = gym.make('CyberBattleToyCtf-v0')
+    ep = w.EnvironmentBounds.of_identifiers(maximum_node_count=12, maximum_total_credentials=10, identifiers=env.identifiers)
+    dqn = DQN(ep)
+    inference = DQNInference(dqn, max_batch_size=2)
+    states = np.random.default_rng(0).integers(0, 5, size=(5, dqn.hidden_layer1.in_features)).astype(np.float32)
+
+    with torch.no_grad():
+        expected = dqn(torch.from_numpy(states)).numpy()
+    np.testing.assert_allclose(inference.forward(states).numpy(), expected, rtol=1e-4, atol=1e-5)
+
+    actions, q_values = inference.lookup(states)
+    assert actions == expected.argmax(axis=1).tolist()
+
+    with torch.no_grad():
+        dqn.head.bias += 1.0
+    np.testing.assert_allclose(inference.forward(states).numpy(), expected, rtol=1e-4, atol=1e-5)
+    inference.refresh(dqn)
+    np.testing.assert_allclose(inference.forward(states).numpy(), expected + 1.0, rtol=1e-4, atol=1e-5)
+
+
+def test_masked_lookup_picks_valid_actions() -> None:
+    """Masked lookups return the best action among the valid ones"""
+    env = gym.make('CyberBattleToyCtf-v0')
+    ep = w.EnvironmentBounds.of_identifiers(maximum_node_count=12, maximum_total_credentials=10, identifiers=env.identifiers)
+    policy = DeepQLearnerPolicy(ep, gamma=0.0, replay_memory_size=1, target_update=1, batch_size=1, learning_rate=0.0)
+    rng = np.random.default_rng(0)
+    states = rng.integers(0, 5, size=(6, policy.policy_net.hidden_layer1.in_features)).astype(np.float32)
+    valid_actions = rng.random((6, policy.policy_net.head.out_features)) < 0.1
+    valid_actions[:, 0] = True
+
+    with torch.no_grad():
+        q_values = policy.policy_net(torch.from_numpy(states)).numpy()
+    expected_actions = np.where(valid_actions, q_values, -np.inf).argmax(axis=1).tolist()
+
+    actions, _ = policy.lookup_dqn(states, valid_actions)
+    assert actions == expected_actions
+    policy.eval()
+    actions, _ = policy.lookup_dqn(states, valid_actions)
+    assert actions == expected_actions
+
+
+def test_checkpoint_restores_optimizer(tmp_path) -> None:
+    """`load` restores the optimizer state written by `save`"""
+    env = gym.make('CyberBattleToyCtf-v0')
+    ep = w.EnvironmentBounds.of_identifiers(maximum_node_count=12, maximum_total_credentials=10, identifiers=env.identifiers)
+    policy = DeepQLearnerPolicy(ep, gamma=0.9, replay_memory_size=100, target_update=10, batch_size=2, learning_rate=0.01)
+    state = np.zeros(len(policy.stateaction_model.state_space.dim_sizes), dtype=np.float32)
+    for _ in range(4):
+        policy.update_q_function(1.0, actor_state=state, abstract_action=np.int32(0), next_actor_state=state)
+    policy.save(str(tmp_path / 'policy.tar'), optimizer_save=True)
+
+    restored = DeepQLearnerPolicy(ep, gamma=0.9, replay_memory_size=100, target_update=10, batch_size=2, learning_rate=0.01)
+    restored.load(str(tmp_path / 'policy.tar'))
+    saved_state = policy.optimizer.state_dict()['state']
+    restored_state = restored.optimizer.state_dict()['state']
+    assert saved_state.keys() == restored_state.keys() and len(saved_state)
+    for key in saved_state:
+        assert torch.equal(saved_state[key]['square_avg'], restored_state[key]['square_avg'])
@@ -8,7 +8,7 @@
 
 from .agent_wrapper import AgentWrapper
 from .learner import Learner
-from typing import Optional
+from typing import List, Optional
 import cyberbattle._env.cyberbattle_env as cyberbattle_env
 import numpy as np
 import logging
@@ -67,6 +67,13 @@ class CredentialCacheExploiter(Learner):
         else:
             return 'exploit[undefined]->explore', None, None
 
+    def explore_batch(self, wrapped_envs: List[AgentWrapper]):
+        return [("explore", wrapped_env.env.sample_valid_action([0, 1]), None) for wrapped_env in wrapped_envs]
+
+    def exploit_batch(self, wrapped_envs: List[AgentWrapper], observations: List):
+        # the credential cache of each environment is looked up independently
+        return [self.exploit(wrapped_env, observation) for wrapped_env, observation in zip(wrapped_envs, observations)]
+
     def stateaction_as_string(self, actionmetadata):
         return ''
 
@@ -9,7 +9,7 @@ traditional Jupyter Notebook to open in your browser
 
 # pylint: disable=invalid-name
 
-from typing import NamedTuple, Optional, Tuple
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
 import numpy as np
 import logging
 
@@ -34,20 +34,76 @@ def random_argmax(array):
     return max_value, max_index
 
 
-def random_argtop_percentile(array: np.ndarray, percentile: float):
-    """Just like `argmax` but if there are multiple elements with the max
-    return a random index to break ties instead of returning the first one."""
-    top_percentile = np.percentile(array, percentile)
-    indices = np.where(array >= top_percentile)[0]
-
-    if len(indices) == 0:
-        return random_argmax(array)
-    elif indices.shape[0] > 1:
-        max_index = int(np.random.choice(indices, size=1))
-    else:
-        max_index = int(indices)
+def percentile_thresholds(rows: np.ndarray, percentile: float) -> np.ndarray:
+    """The `percentile` of each row of a matrix, interpolated linearly like `np.percentile`,
+    from a partial partition of the rows around the two ranks involved"""
+    n = rows.shape[1]
+    position = percentile / 100 * (n - 1)
+    lower = int(np.floor(position))
+    if lower >= n - 1:
+        return rows.max(axis=1)
+    partitioned = np.partition(rows, [lower, lower + 1], axis=1)
+    low, high = partitioned[:, lower], partitioned[:, lower + 1]
+    return np.minimum(low + (position - lower) * (high - low), high)
+
+
+def random_argtop_percentile_rows(rows: np.ndarray, percentile: float,
+                                  random: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    """For each row of a matrix return the value of its `percentile` and the index
+    of an element picked uniformly at random among the ones above it"""
+    thresholds = percentile_thresholds(rows, percentile)
+    candidates = rows >= thresholds[:, np.newaxis]
+    # pick the k-th candidate of each row, with k uniform among the candidate count
+    candidate_rank = np.cumsum(candidates, axis=1)
+    picked = random.integers(candidate_rank[:, -1])
+    indices = np.argmax(candidate_rank > picked[:, np.newaxis], axis=1)
+    return thresholds, indices
+
+
+class SparseQTable:
+    """Q-matrix that only stores the rows written to, as float32 vectors
+    allocated on first write. Rows never written to read as zeros.
+
+    Supports the indexing used by `QMatrix`: `qm[state]`, `qm[state, :]`,
+    `qm[states, :]` for a batch of states, and reading or assigning `qm[state, action]`.
+    """
 
-    return top_percentile, max_index
+    def __init__(self, shape: Tuple[int, int], dtype=np.float32):
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.rows: Dict[int, np.ndarray] = {}
+        self.zero_row = np.zeros(shape[1], dtype=self.dtype)
+        self.zero_row.flags.writeable = False
+
+    def row(self, state: int) -> np.ndarray:
+        return self.rows.get(int(state), self.zero_row)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        state, action = key[0], key[1] if len(key) > 1 else slice(None)
+        if np.ndim(state) > 0:
+            return np.stack([self.row(s) for s in state])[:, action]
+        return self.row(state)[action]
+
+    def __setitem__(self, key, value) -> None:
+        state, action = key
+        state = int(state)
+        row = self.rows.get(state)
+        if row is None:
+            row = self.rows[state] = np.zeros(self.shape[1], dtype=self.dtype)
+        row[action] = value
+
+    def __array__(self, dtype=None) -> np.ndarray:
+        """Dense copy of the matrix"""
+        dense = np.zeros(self.shape, dtype=dtype or self.dtype)
+        for state, row in self.rows.items():
+            dense[state] = row
+        return dense
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the allocated rows"""
+        return len(self.rows) * self.shape[1] * self.dtype.itemsize
 
 
 class QMatrix:
@@ -55,14 +111,19 @@ class QMatrix:
         state_space  - Features defining the state space
         action_space - Features defining the action space
         qm           - Optional: initialization values for the Q matrix
+        sparse       - store the Q matrix as a `SparseQTable` instead of a dense matrix
+        random       - Optional: random generator used to break ties when exploiting,
+                       by default seeded from the global numpy random state
     """
     # The Quality matrix
-    qm: np.ndarray
+    qm: Union[np.ndarray, SparseQTable]
 
     def __init__(self, name,
                  state_space: w.Feature,
                  action_space: w.Feature,
-                 qm: Optional[np.ndarray] = None):
+                 qm: Optional[Union[np.ndarray, SparseQTable]] = None,
+                 sparse: bool = False,
+                 random: Optional[np.random.Generator] = None):
         """Initialize the Q-matrix"""
 
         self.name = name
@@ -70,7 +131,9 @@ class QMatrix:
         self.action_space = action_space
         self.statedim = state_space.flat_size()
         self.actiondim = action_space.flat_size()
+        self.sparse = sparse
         self.qm = self.clear() if qm is None else qm
+        self.random = random or np.random.default_rng(np.random.randint(2**31))
 
         # error calculated for the last update to the Q-matrix
         self.last_error = 0
@@ -80,21 +143,29 @@ class QMatrix:
 
     def clear(self):
         """Re-initialize the Q-matrix to 0"""
+        if self.sparse:
+            self.qm = SparseQTable(self.shape())
+            return self.qm
         self.qm = np.zeros(shape=self.shape())
         # self.qm = np.random.rand(*self.shape()) / 100
         return self.qm
 
+    def memory_usage(self) -> int:
+        """Number of bytes used to store the Q values"""
+        return self.qm.nbytes
+
     def print(self):
         print(f"[{self.name}]\n"
               f"state: {self.state_space}\n"
               f"action: {self.action_space}\n"
-              f"shape = {self.shape()}")
+              f"shape = {self.shape()}\n"
+              f"memory = {self.memory_usage()} bytes")
 
     def update(self, current_state: int, action: int, next_state: int, reward, gamma, learning_rate):
         """Update the Q matrix after taking `action` in state 'current_State'
         and obtaining reward=R[current_state, action]"""
 
-        maxq_atnext, max_index = random_argmax(self.qm[next_state, ])
+        maxq_atnext = np.max(self.qm[next_state, ])
 
         # bellman equation for Q-learning
         temporal_difference = reward + gamma * maxq_atnext - self.qm[current_state, action]
@@ -110,8 +181,14 @@ class QMatrix:
     def exploit(self, features, percentile) -> Tuple[int, float]:
         """exploit: leverage the Q-matrix.
         Returns the expected Q value and the chosen action."""
-        expected_q, action = random_argtop_percentile(self.qm[features, :], percentile)
-        return int(action), float(expected_q)
+        expected_q, action = random_argtop_percentile_rows(self.qm[features, :][np.newaxis], percentile, self.random)
+        return int(action[0]), float(expected_q[0])
+
+    def exploit_batch(self, states: np.ndarray, percentile) -> Tuple[np.ndarray, np.ndarray]:
+        """exploit a batch of states with a single lookup of the Q-matrix rows.
+        Returns the chosen actions and their expected Q values."""
+        top_percentile, actions = random_argtop_percentile_rows(self.qm[states, :], percentile, self.random)
+        return actions, top_percentile
 
 
 class QLearnAttackSource(QMatrix):
@@ -120,7 +197,8 @@ class QLearnAttackSource(QMatrix):
         Action space: feature encodings of suggested nodes
     """
 
-    def __init__(self, ep: EnvironmentBounds, qm: Optional[np.ndarray] = None):
+    def __init__(self, ep: EnvironmentBounds, qm: Optional[np.ndarray] = None, sparse: bool = False,
+                 random: Optional[np.random.Generator] = None):
         self.ep = ep
 
         self.state_space = w.HashEncoding(ep, [
@@ -134,7 +212,7 @@ class QLearnAttackSource(QMatrix):
         self.action_space = w.RavelEncoding(ep, [
             w.Feature_active_node_properties(ep)])
 
-        super().__init__("attack_source", self.state_space, self.action_space, qm)
+        super().__init__("attack_source", self.state_space, self.action_space, qm, sparse, random)
 
 
 class QLearnBestAttackAtSource(QMatrix):
@@ -143,7 +221,8 @@ class QLearnBestAttackAtSource(QMatrix):
         Action space: a SimpleAbstract action
     """
 
-    def __init__(self, ep: EnvironmentBounds, qm: Optional[np.ndarray] = None) -> None:
+    def __init__(self, ep: EnvironmentBounds, qm: Optional[np.ndarray] = None, sparse: bool = False,
+                 random: Optional[np.random.Generator] = None) -> None:
 
         self.state_space = w.HashEncoding(ep, [
             w.Feature_active_node_properties(ep),
@@ -166,7 +245,7 @@ class QLearnBestAttackAtSource(QMatrix):
 
         self.action_space = w.AbstractAction(ep)
 
-        super().__init__("attack_at_source", self.state_space, self.action_space, qm)
+        super().__init__("attack_at_source", self.state_space, self.action_space, qm, sparse, random)
 
 
 # TODO: We should try scipy for sparse matrices and OpenBLAS (MKL Intel version of BLAS, faster than openBLAS) for numpy
@@ -220,6 +299,12 @@ class QTabularLearner(learner.Learner):
 
     trained -- another QTabularLearner that is pretrained to initialize the Q matrices from (referenced, not copied)
 
+    sparse -- store the Q matrices as `SparseQTable`, allocating only the rows of the states
+    actually visited (as float32) instead of the full dense matrices
+
+    seed -- seed of the random generator breaking ties between the top actions when exploiting
+    (by default seeded from the global numpy random state)
+
     exploit_percentile -- (experimental) Randomly pick actions above this percentile in the Q-matrix.
     Setting 100 gives the argmax as in standard Q-learning.
 
@@ -240,13 +325,16 @@ class QTabularLearner(learner.Learner):
                  learning_rate: float,
                  exploit_percentile: float,
                  trained=None,  # : Optional[QTabularLearner]
+                 sparse: bool = False,
+                 seed: Optional[int] = None
                  ):
+        self.random = np.random.default_rng(np.random.randint(2**31) if seed is None else seed)
         if trained:
             self.qsource = trained.qsource
             self.qattack = trained.qattack
         else:
-            self.qsource = QLearnAttackSource(ep)
-            self.qattack = QLearnBestAttackAtSource(ep)
+            self.qsource = QLearnAttackSource(ep, sparse=sparse, random=self.random)
+            self.qattack = QLearnBestAttackAtSource(ep, sparse=sparse, random=self.random)
 
         self.loss_qsource = LossEval(self.qsource)
         self.loss_qattack = LossEval(self.qattack)
@@ -290,61 +378,81 @@ class QTabularLearner(learner.Learner):
         self.loss_qattack.new_episode()
 
     def exploit(self, wrapped_env: w.AgentWrapper, observation):
+        return self.exploit_batch([wrapped_env], [observation])[0]
 
-        agent_state = wrapped_env.state
+    def exploit_batch(self, wrapped_envs: List[w.AgentWrapper], observations: List):
+        results: List = [None] * len(wrapped_envs)
 
-        qsource_state = self.qsource.state_space.encode(agent_state)
+        agent_states = [wrapped_env.state for wrapped_env in wrapped_envs]
+        qsource_states = self.qsource.state_space.vectors_to_indices(np.array([
+            self.qsource.state_space.feature_vector_of_observation(agent_state) for agent_state in agent_states]))
 
         #############
         # first, attempt to exploit the credential cache
         # using the crecache_policy
-        action_style, gym_action, _ = self.credcache_policy.exploit(wrapped_env, observation)
-        if gym_action:
-            source_node = cyberbattle_env.sourcenode_of_action(gym_action)
-            return action_style, gym_action, ChosenActionMetadata(
-                Q_source_state=qsource_state,
-                Q_source_expectedq=-1,
-                Q_attack_expectedq=-1,
-                source_node=source_node,
-                source_node_encoding=self.qsource.action_space.encode_at(
-                    agent_state, source_node),
-                abstract_action=np.int32(self.qattack.action_space.abstract_from_gymaction(gym_action)),
-                Q_attack_state=self.qattack.state_space.encode_at(agent_state, source_node)
-            )
+        pending = []
+        for k, (wrapped_env, observation, agent_state) in enumerate(zip(wrapped_envs, observations, agent_states)):
+            action_style, gym_action, _ = self.credcache_policy.exploit(wrapped_env, observation)
+            if gym_action:
+                source_node = cyberbattle_env.sourcenode_of_action(gym_action)
+                results[k] = action_style, gym_action, ChosenActionMetadata(
+                    Q_source_state=int(qsource_states[k]),
+                    Q_source_expectedq=-1,
+                    Q_attack_expectedq=-1,
+                    source_node=source_node,
+                    source_node_encoding=self.qsource.action_space.encode_at(
+                        agent_state, source_node),
+                    abstract_action=np.int32(self.qattack.action_space.abstract_from_gymaction(gym_action)),
+                    Q_attack_state=self.qattack.state_space.encode_at(agent_state, source_node)
+                )
+            else:
+                pending.append(k)
         #############
 
+        if not pending:
+            return results
+
         # Pick action: pick random source state among the ones with the maximum Q-value
-        action_style = "exploit"
-        source_node_encoding, qsource_expectedq = self.qsource.exploit(
-            qsource_state, percentile=100)
-
-        # Pick source node at random (owned and with the desired feature encoding)
-        potential_source_nodes = [
-            from_node
-            for from_node in w.owned_nodes(observation)
-            if source_node_encoding == self.qsource.action_space.encode_at(agent_state, from_node)
-        ]
-
-        if len(potential_source_nodes) == 0:
-            logging.debug(f'No node with encoding {source_node_encoding}, fallback on explore')
-            # NOTE: we should make sure that it does not happen too often,
-            # the penalty should be much smaller than typical rewards, small nudge
-            # not a new feedback signal.
-
-            # Learn the lack of node availability
-            self.qsource.update(qsource_state,
-                                source_node_encoding,
-                                qsource_state,
-                                reward=0, gamma=self.gamma, learning_rate=self.learning_rate)
-
-            return "exploit-1->explore", None, None
-        else:
-            source_node = np.random.choice(potential_source_nodes)
+        source_node_encodings, qsource_expectedqs = self.qsource.exploit_batch(qsource_states[pending], percentile=100)
+
+        attack_pending = []
+        for k, source_node_encoding, qsource_expectedq in zip(pending, source_node_encodings, qsource_expectedqs):
+            agent_state = agent_states[k]
+            qsource_state = int(qsource_states[k])
 
-            qattack_state = self.qattack.state_space.encode_at(agent_state, source_node)
+            # Pick source node at random (owned and with the desired feature encoding)
+            owned_nodes = w.owned_nodes(observations[k])
+            owned_nodes_encodings = self.qsource.action_space.encode_at_nodes(agent_state, owned_nodes)
+            potential_source_nodes = owned_nodes[owned_nodes_encodings == source_node_encoding]
 
-            abstract_action, qattack_expectedq = self.qattack.exploit(
-                qattack_state, percentile=self.exploit_percentile)
+            if len(potential_source_nodes) == 0:
+                logging.debug(f'No node with encoding {source_node_encoding}, fallback on explore')
+                # NOTE: we should make sure that it does not happen too often,
+                # the penalty should be much smaller than typical rewards, small nudge
+                # not a new feedback signal.
+
+                # Learn the lack of node availability
+                self.qsource.update(qsource_state,
+                                    source_node_encoding,
+                                    qsource_state,
+                                    reward=0, gamma=self.gamma, learning_rate=self.learning_rate)
+
+                results[k] = "exploit-1->explore", None, None
+            else:
+                source_node = self.random.choice(potential_source_nodes)
+                qattack_state = self.qattack.state_space.encode_at(agent_state, source_node)
+                attack_pending.append((k, int(source_node_encoding), float(qsource_expectedq), source_node, qattack_state))
+
+        if not attack_pending:
+            return results
+
+        abstract_actions, _ = self.qattack.exploit_batch(
+            np.array([qattack_state for _, _, _, _, qattack_state in attack_pending]), percentile=self.exploit_percentile)
+
+        action_style = "exploit"
+        for (k, source_node_encoding, qsource_expectedq, source_node, qattack_state), abstract_action in zip(attack_pending, abstract_actions):
+            wrapped_env, observation = wrapped_envs[k], observations[k]
+            qsource_state = int(qsource_states[k])
 
             gym_action = self.qattack.action_space.specialize_to_gymaction(
                 source_node, observation, np.int32(abstract_action))
@@ -354,7 +462,7 @@ class QTabularLearner(learner.Learner):
 
             if gym_action and wrapped_env.env.is_action_valid(gym_action, observation['action_mask']):
                 logging.debug(f'  exploit gym_action={gym_action} source_node_encoding={source_node_encoding}')
-                return action_style, gym_action, ChosenActionMetadata(
+                results[k] = action_style, gym_action, ChosenActionMetadata(
                     Q_source_state=qsource_state,
                     Q_source_expectedq=qsource_expectedq,
                     Q_attack_expectedq=qsource_expectedq,
@@ -373,7 +481,7 @@ class QTabularLearner(learner.Learner):
                 self.qsource.update(qsource_state,
                                     source_node_encoding,
                                     qsource_state,
-                                    reward=0, gamma=selnf.gamma, learning_rate=self.learning_rate)
+                                    reward=0, gamma=self.gamma, learning_rate=self.learning_rate)
 
                 self.qattack.update(qattack_state,
                                     int(abstract_action),
@@ -381,7 +489,9 @@ class QTabularLearner(learner.Learner):
                                     reward=0, gamma=self.gamma, learning_rate=self.learning_rate)
 
                 # fallback on random exploration
-                return ('exploit[invalid]->explore' if gym_action else 'exploit[undefined]->explore'), None, None
+                results[k] = ('exploit[invalid]->explore' if gym_action else 'exploit[undefined]->explore'), None, None
+
+        return results
 
     def explore(self, wrapped_env: w.AgentWrapper):
         agent_state = wrapped_env.state
@@ -416,7 +526,8 @@ class QTabularLearner(learner.Learner):
 
     def all_parameters_as_string(self) -> str:
         return f' dimension={self.qsource.state_space.flat_size()}x{self.qsource.action_space.flat_size()},' \
-            f'{self.qattack.state_space.flat_size()}x{self.qattack.action_space.flat_size()}\n' \
+            f'{self.qattack.state_space.flat_size()}x{self.qattack.action_space.flat_size()},' \
+            f' memory={self.qsource.memory_usage() + self.qattack.memory_usage()} bytes\n' \
             f'Q1={[f.name() for f in self.qsource.state_space.feature_selection]}' \
             f' -> {[f.name() for f in self.qsource.action_space.feature_selection]}\n' \
             f"Q2={[f.name() for f in self.qattack.state_space.feature_selection]} -> 'action'"
@@ -5,7 +5,7 @@
 features extracted from the environment observations"""
 
 from cyberbattle._env.cyberbattle_env import EnvironmentBounds
-from typing import Optional, List, Tuple
+from typing import Callable, Dict, Hashable, Optional, List, Tuple
 import enum
 import numpy as np
 from gym import spaces, Wrapper
@@ -27,6 +27,11 @@ class StateAugmentation:
     def on_reset(self, observation: cyberbattle_env.Observation):
         self.observation = observation
 
+    def memoize(self, key: Hashable, compute: Callable[[], ndarray]) -> ndarray:
+        """Return the feature vector identified by `key` in the current state.
+        No caching is done by default."""
+        return compute()
+
 
 class Feature(spaces.MultiDiscrete):
     """
@@ -36,6 +41,9 @@ class Feature(spaces.MultiDiscrete):
         for each discrete space.
     """
 
+    # False for global features whose value does not depend on the node
+    node_specific = True
+
     def __init__(self, env_properties: EnvironmentBounds, nvec):
         self.env_properties = env_properties
         super().__init__(nvec)
@@ -53,6 +61,16 @@ class Feature(spaces.MultiDiscrete):
         the current observation and specific node"""
         raise NotImplementedError
 
+    def get_at_nodes(self, a: StateAugmentation, nodes: np.ndarray, out: np.ndarray) -> None:
+        """Write the feature vector of each node in `nodes` to the rows of `out`,
+        an array of shape (len(nodes), feature dimension).
+        Subclasses override this with a vectorized implementation."""
+        if not self.node_specific:
+            out[:] = self.get(a, None)
+        else:
+            for row, node in enumerate(nodes):
+                out[row] = self.get(a, node)
+
     def pretty_print(self, v):
         return v
 
@@ -76,6 +94,9 @@ class Feature_active_node_properties(Feature):
         remapped = np.array(node_prop[node] % 2, dtype=np.int_)  # TODO new version of feature properties with 2->0.5 (as not sure if property is set or not)
         return remapped
 
+    def get_at_nodes(self, a: StateAugmentation, nodes: np.ndarray, out: np.ndarray) -> None:
+        out[:] = np.asarray(a.observation['discovered_nodes_properties'])[nodes] % 2
+
 
 class Feature_active_node_age(Feature):
     """How recently was this node discovered?
@@ -94,6 +115,9 @@ class Feature_active_node_age(Feature):
 
         return np.array([discovered_node_count - node - 1], dtype=np.int_)
 
+    def get_at_nodes(self, a: StateAugmentation, nodes: np.ndarray, out: np.ndarray) -> None:
+        out[:, 0] = a.observation['discovered_node_count'] - nodes - 1
+
 
 class Feature_active_node_id(Feature):
     """Return the node id itself"""
@@ -104,9 +128,13 @@ class Feature_active_node_id(Feature):
     def get(self, a: StateAugmentation, node) -> ndarray:
         return np.array([node], dtype=np.int_)
 
+    def get_at_nodes(self, a: StateAugmentation, nodes: np.ndarray, out: np.ndarray) -> None:
+        out[:, 0] = nodes
+
 
 class Feature_discovered_nodeproperties_sliding(Feature):
     """Bitmask indicating node properties seen in last few cache entries"""
+    node_specific = False
     # Actually, node properties seen in last few discovered nodes
     # (not 'cache entries', as the matrix does not store last seen discovered properties for any node, stacked as within the order of dicsovery),
     # but current state of discovered nodes, accross maximum self.window_size discovered nodes)
@@ -133,6 +161,7 @@ class Feature_discovered_nodeproperties_sliding(Feature):
 
 class Feature_discovered_ports(Feature):
     """Bitmask vector indicating each port seen so far in discovered credentials"""
+    node_specific = False
 
     def __init__(self, p: EnvironmentBounds):
         super().__init__(p, [2] * p.port_count)
@@ -148,6 +177,7 @@ class Feature_discovered_ports(Feature):
 
 class Feature_discovered_ports_sliding(Feature):
     """Bitmask indicating port seen in last few cache entries"""
+    node_specific = False
     window_size = 3
 
     def __init__(self, p: EnvironmentBounds):
@@ -164,6 +194,7 @@ class Feature_discovered_ports_sliding(Feature):
 
 class Feature_discovered_ports_counts(Feature):
     """Count of each port seen so far in discovered credentials"""
+    node_specific = False
 
     def __init__(self, p: EnvironmentBounds):
         super().__init__(p, [p.maximum_total_credentials + 1] * p.port_count)
@@ -180,6 +211,7 @@ class Feature_discovered_ports_counts(Feature):
 
 class Feature_discovered_credential_count(Feature):
     """number of credentials discovered so far"""
+    node_specific = False
 
     def __init__(self, p: EnvironmentBounds):
         super().__init__(p, [p.maximum_total_credentials + 1])
@@ -191,6 +223,7 @@ class Feature_discovered_credential_count(Feature):
 
 class Feature_discovered_node_count(Feature):
     """number of nodes discovered so far"""
+    node_specific = False
 
     def __init__(self, p: EnvironmentBounds):
         super().__init__(p, [p.maximum_node_count + 1])
@@ -201,6 +234,7 @@ class Feature_discovered_node_count(Feature):
 
 class Feature_discovered_notowned_node_count(Feature):
     """number of nodes discovered that are not owned yet (optionally clipped)"""
+    node_specific = False
 
     def __init__(self, p: EnvironmentBounds, clip: Optional[int]):
         self.clip = p.maximum_node_count if clip is None else clip
@@ -217,6 +251,7 @@ class Feature_discovered_notowned_node_count(Feature):
 
 class Feature_owned_node_count(Feature):
     """number of owned nodes so far"""
+    node_specific = False
 
     def __init__(self, p: EnvironmentBounds):
         super().__init__(p, [p.maximum_node_count + 1])
@@ -236,15 +271,33 @@ class ConcatFeatures(Feature):
     def __init__(self, p: EnvironmentBounds, feature_selection: List[Feature]):
         self.feature_selection = feature_selection
         self.dim_sizes = np.concatenate([f.nvec for f in feature_selection])
+        self.node_specific = any(f.node_specific for f in feature_selection)
+        self.column_offsets = np.cumsum([0] + [np.size(f.nvec) for f in feature_selection])
+        # reusable node x feature matrix filled by `get_at_nodes`, allocated on its first call
+        self.node_matrix_buffer: Optional[np.ndarray] = None
         super().__init__(p, [self.dim_sizes])
 
     def pretty_print(self, v):
         return v
 
+    def get_at_nodes(self, a: StateAugmentation, nodes: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """Compute the feature vectors of all the given nodes at once, one row per node.
+
+        The matrix is written in place to `out` if provided, otherwise to the
+        first rows of a float32 buffer owned by this feature and reused by
+        the next call: copy the result to keep it, or hand it directly to
+        `torch.from_numpy`."""
+        if out is None:
+            if self.node_matrix_buffer is None:
+                self.node_matrix_buffer = np.zeros((self.env_properties.maximum_node_count, len(self.dim_sizes)), dtype=np.float32)
+            out = self.node_matrix_buffer[:len(nodes)]
+        for f, start, end in zip(self.feature_selection, self.column_offsets[:-1], self.column_offsets[1:]):
+            f.get_at_nodes(a, nodes, out[:, start:end])
+        return out
+
     def get(self, a: StateAugmentation, node=None) -> np.ndarray:
-        """Return the feature vector"""
-        feature_vector = [f.get(a, node) for f in self.feature_selection]
-        return np.concatenate(feature_vector)
+        """Return the feature vector (memoized by the agent state for the current step)"""
+        return a.memoize((id(self), node), lambda: np.concatenate([f.get(a, node) for f in self.feature_selection]))
 
 
 class FeatureEncoder(Feature):
@@ -256,11 +309,13 @@ class FeatureEncoder(Feature):
     def vector_to_index(self, feature_vector: np.ndarray) -> int:
         raise NotImplementedError
 
+    def vectors_to_indices(self, feature_vectors: np.ndarray) -> np.ndarray:
+        """Return the index encoding of each row of a matrix of feature vectors"""
+        return np.array([self.vector_to_index(v) for v in feature_vectors], dtype=np.int64)
+
     def feature_vector_of_observation_at(self, a: StateAugmentation, node: Optional[int]) -> np.ndarray:
-        """Return the current feature vector"""
-        feature_vector = [f.get(a, node) for f in self.feature_selection]
-        # print(f'feature_vector={feature_vector}  self.feature_selection={self.feature_selection}')
-        return np.concatenate(feature_vector)
+        """Return the current feature vector (memoized by the agent state for the current step)"""
+        return a.memoize((id(self), node), lambda: np.concatenate([f.get(a, node) for f in self.feature_selection]))
 
     def feature_vector_of_observation(self, a: StateAugmentation):
         return self.feature_vector_of_observation_at(a, None)
@@ -275,6 +330,13 @@ class FeatureEncoder(Feature):
         feature_vector_concat = self.feature_vector_of_observation_at(a, node)
         return self.vector_to_index(feature_vector_concat)
 
+    def encode_at_nodes(self, a: StateAugmentation, nodes) -> np.ndarray:
+        """Return the current feature vector encodings for each node of a list of nodes"""
+        if len(nodes) == 0:
+            return np.zeros(0, dtype=np.int64)
+        feature_vectors = np.array([self.feature_vector_of_observation_at(a, node) for node in nodes])
+        return self.vectors_to_indices(feature_vectors)
+
     def get(self, a: StateAugmentation, node=None) -> np.ndarray:
         """Return the feature vector"""
         return np.array([self.encode(a, node)])
@@ -285,11 +347,38 @@ class FeatureEncoder(Feature):
         return f'[{n}]'
 
 
+# FNV-1a parameters (64-bit) and splitmix64 finalizer constants used by `hash_feature_vectors`
+_FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+_FNV_PRIME = np.uint64(0x100000001b3)
+_MIX_MULTIPLIERS = (np.uint64(0xbf58476d1ce4e5b9), np.uint64(0x94d049bb133111eb))
+_MIX_SHIFTS = (np.uint64(30), np.uint64(27), np.uint64(31))
+
+
+def hash_feature_vectors(feature_vectors) -> np.ndarray:
+    """Deterministic 64-bit hash of each row of an integer feature matrix.
+
+    Rows are hashed as sequences of 64-bit integer words with FNV-1a,
+    vectorized over all rows at once, followed by a splitmix64 finalizer.
+    A single feature vector is treated as a matrix with one row.
+    Unlike the builtin `hash()` the result does not depend on the process."""
+    words = np.ascontiguousarray(np.atleast_2d(np.asarray(feature_vectors, dtype=np.int64))).view(np.uint64)
+    h = np.full(words.shape[0], _FNV_OFFSET, dtype=np.uint64)
+    for column in words.T:
+        h ^= column
+        h *= _FNV_PRIME
+    h ^= h >> _MIX_SHIFTS[0]
+    h *= _MIX_MULTIPLIERS[0]
+    h ^= h >> _MIX_SHIFTS[1]
+    h *= _MIX_MULTIPLIERS[1]
+    h ^= h >> _MIX_SHIFTS[2]
+    return h
+
+
 class HashEncoding(FeatureEncoder):
     """ Feature defined as a hash of another feature
     Parameters:
        feature_selection: a selection of features to combine
-       hash_dim: dimension after hashing with hash(str(feature_vector)) or -1 for no hashing
+       hash_dim: dimension after hashing with `hash_feature_vectors` or -1 for no hashing
     """
 
     def __init__(self, p: EnvironmentBounds, feature_selection: List[Feature], hash_size: int):
@@ -302,7 +391,11 @@ class HashEncoding(FeatureEncoder):
 
     def vector_to_index(self, feature_vector) -> int:
         """Hash the state vector"""
-        return hash(str(feature_vector)) % self.hash_size
+        return int(hash_feature_vectors(feature_vector)[0] % np.uint64(self.hash_size))
+
+    def vectors_to_indices(self, feature_vectors: np.ndarray) -> np.ndarray:
+        """Hash every row of a matrix of state vectors in one pass"""
+        return (hash_feature_vectors(feature_vectors) % np.uint64(self.hash_size)).astype(np.int64)
 
     def pretty_print(self, index):
         return f'#{index}'
@@ -332,6 +425,12 @@ class RavelEncoding(FeatureEncoder):
             f'-> index={index}, max_index={self.ravelled_size-1})'
         return index
 
+    def vectors_to_indices(self, feature_vectors: np.ndarray) -> np.ndarray:
+        feature_vectors = np.atleast_2d(feature_vectors)
+        assert feature_vectors.shape[1] == len(self.dim_sizes), \
+            f'feature vectors of size {feature_vectors.shape[1]}, expecting {len(self.dim_sizes)}'
+        return np.ravel_multi_index(tuple(feature_vectors.T), list(self.dim_sizes)).astype(np.int64)
+
     def unravel_index(self, index) -> Tuple:
         return np.unravel_index(index, self.dim_sizes)
 
@@ -443,6 +542,30 @@ class AbstractAction(Feature):
         target = np.int32(discovered_credentials[cred, 0])
         return {'connect': np.array([source_node, target, port, cred], dtype=np.int32)}
 
+    def valid_actions_mask(self, source_nodes: np.ndarray, observation) -> np.ndarray:
+        """Boolean matrix of the abstract actions that `specialize_to_gymaction`
+        can realize into an action permitted by the environment action mask,
+        with one row per source node"""
+        action_mask = observation['action_mask']
+        n = len(source_nodes)
+        mask = np.zeros((n, self.n_actions), dtype=np.bool_)
+
+        mask[:, :self.n_local_actions] = action_mask['local_vulnerability'][source_nodes] != 0
+
+        # remote abstract actions are the ravelled (target node, profile, variable) coordinates
+        remote_end = self.n_local_actions + self.n_remote_actions
+        mask[:, self.n_local_actions:remote_end] = \
+            action_mask['remote_vulnerability'][source_nodes].reshape(n, self.n_remote_actions) != 0
+
+        # connect falls back on any credential to a node not owned yet, whatever the port
+        n_discovered_creds = observation['credential_cache_length']
+        if n_discovered_creds > 0:
+            cred_targets = np.array(observation['credential_cache_matrix'])[:n_discovered_creds, 0]
+            if np.isin(cred_targets, discovered_nodes_notowned(observation)).any():
+                mask[:, remote_end:] = True
+
+        return mask
+
     def abstract_from_gymaction(self, gym_action: cyberbattle_env.Action) -> np.int32:
         """Abstract a gym action into an action to be index in the Q-matrix"""
         if 'local_vulnerability' in gym_action:
@@ -467,15 +590,39 @@ class ActionTrackingStateAugmentation(StateAugmentation):
     the environment observation augmented with the following dynamic information:
        - success_action_count: count of action taken and succeeded at the current node
        - failed_action_count: count of action taken and failed at the current node
+       - the bitsets of the (source, abstract action, target) tuples tried since the
+         observation last changed, used by `sample_untried_action`
+
+    Feature vectors computed through `memoize` are cached until the next
+    call to `on_step` or `on_reset`, so that each feature is computed at most
+    once per step. Cached vectors are read-only.
      """
 
     def __init__(self, p: EnvironmentBounds, observation: cyberbattle_env.Observation):
         self.aa = AbstractAction(p)
         self.success_action_count = np.zeros(shape=(p.maximum_node_count, self.aa.n_actions), dtype=np.int32)
         self.failed_action_count = np.zeros(shape=(p.maximum_node_count, self.aa.n_actions), dtype=np.int32)
+        # local and remote abstract actions determine the target node, connect needs it explicitly
+        self.tried_attacks = np.zeros(shape=(p.maximum_node_count, self.aa.n_local_actions + self.aa.n_remote_actions),
+                                      dtype=np.bool_)
+        self.tried_connects = np.zeros(shape=(p.maximum_node_count, p.maximum_node_count, p.port_count), dtype=np.bool_)
+        self.observation_signature = observation_signature(observation)
         self.env_properties = p
+        self.feature_cache: Dict[Hashable, ndarray] = {}
         super().__init__(observation)
 
+    def memoize(self, key: Hashable, compute: Callable[[], ndarray]) -> ndarray:
+        value = self.feature_cache.get(key)
+        if value is None:
+            value = np.asarray(compute())
+            value.flags.writeable = False
+            self.feature_cache[key] = value
+        return value
+
+    def invalidate_feature_cache(self) -> None:
+        """Drop all the feature vectors cached for the current step"""
+        self.feature_cache.clear()
+
     def on_step(self, action: cyberbattle_env.Action, reward: float, done: bool, observation: cyberbattle_env.Observation):
         node = cyberbattle_env.sourcenode_of_action(action)
         abstract_action = self.aa.abstract_from_gymaction(action)
@@ -483,14 +630,80 @@ class ActionTrackingStateAugmentation(StateAugmentation):
             self.success_action_count[node, abstract_action] += 1
         else:
             self.failed_action_count[node, abstract_action] += 1
+
+        signature = observation_signature(observation)
+        if signature != self.observation_signature:
+            # actions tried before may have a different outcome in the new state
+            self.observation_signature = signature
+            self.clear_tried_actions()
+        if 'connect' in action:
+            _, target, port, _ = action['connect']
+            self.tried_connects[node, target, port] = True
+        else:
+            self.tried_attacks[node, abstract_action] = True
+
+        self.invalidate_feature_cache()
         super().on_step(action, reward, done, observation)
 
     def on_reset(self, observation: cyberbattle_env.Observation):
         p = self.env_properties
         self.success_action_count = np.zeros(shape=(p.maximum_node_count, self.aa.n_actions), dtype=np.int32)
         self.failed_action_count = np.zeros(shape=(p.maximum_node_count, self.aa.n_actions), dtype=np.int32)
+        self.observation_signature = observation_signature(observation)
+        self.clear_tried_actions()
+        self.invalidate_feature_cache()
         super().on_reset(observation)
 
+    def clear_tried_actions(self) -> None:
+        self.tried_attacks[:] = False
+        self.tried_connects[:] = False
+
+    def untried_actions(self) -> Tuple[ndarray, ndarray, ndarray]:
+        """Valid actions not tried since the observation last changed, as the coordinates
+        of the local (source, vulnerability), remote (source, target, profile, variable)
+        and connect (source, target, port) actions"""
+        action_mask = self.observation['action_mask']
+        n_local = self.aa.n_local_actions
+        local = (action_mask['local_vulnerability'] != 0) & ~self.tried_attacks[:, :n_local]
+        remote = (action_mask['remote_vulnerability'] != 0) & \
+            ~self.tried_attacks[:, n_local:].reshape(action_mask['remote_vulnerability'].shape)
+        connect = (action_mask['connect'][:, :, :, :self.observation['credential_cache_length']] != 0).any(axis=3) & \
+            ~self.tried_connects
+        return np.argwhere(local), np.argwhere(remote), np.argwhere(connect)
+
+    def sample_untried_action(self) -> Optional[cyberbattle_env.Action]:
+        """Sample a valid action not tried since the observation last changed,
+        uniformly among all the untried local, remote and connect actions.
+        Returns None if all the valid actions were tried."""
+        local, remote, connect = self.untried_actions()
+        untried_count = len(local) + len(remote) + len(connect)
+        if not untried_count:
+            return None
+        index = np.random.randint(untried_count)
+        if index < len(local):
+            return {'local_vulnerability': local[index].astype(np.int32)}
+        index -= len(local)
+        if index < len(remote):
+            return {'remote_vulnerability': remote[index].astype(np.int32)}
+        index -= len(remote)
+
+        source, target, port = connect[index]
+        # prefer a credential known to be for this target and port
+        n_discovered_creds = self.observation['credential_cache_length']
+        discovered_credentials = np.array(self.observation['credential_cache_matrix'])[:n_discovered_creds]
+        matching = np.nonzero((discovered_credentials[:, 0] == target) & (discovered_credentials[:, 1] == port))[0]
+        cred = np.random.choice(matching) if len(matching) else np.random.randint(n_discovered_creds)
+        return {'connect': np.array([source, target, port, cred], dtype=np.int32)}
+
+
+def observation_signature(observation: cyberbattle_env.Observation) -> Tuple:
+    """Summary of the parts of an observation that the agent's actions can change"""
+    return (observation['discovered_node_count'],
+            observation['credential_cache_length'],
+            observation['discovered_profiles_count'],
+            np.asarray(observation['nodes_privilegelevel']).tobytes(),
+            np.asarray(observation['discovered_nodes_properties']).tobytes())
+
 
 class Feature_actions_tried_at_node(Feature):
     """A bit mask indicating which actions were already tried
@@ -502,6 +715,9 @@ class Feature_actions_tried_at_node(Feature):
     def get(self, a: ActionTrackingStateAugmentation, node: int):
         return ((a.failed_action_count[node, :] + a.success_action_count[node, :]) != 0) * 1
 
+    def get_at_nodes(self, a: ActionTrackingStateAugmentation, nodes: np.ndarray, out: np.ndarray) -> None:
+        out[:] = (a.failed_action_count[nodes] + a.success_action_count[nodes]) != 0
+
 
 class Feature_success_actions_at_node(Feature):
     """number of time each action succeeded at a given node"""
@@ -514,6 +730,9 @@ class Feature_success_actions_at_node(Feature):
     def get(self, a: ActionTrackingStateAugmentation, node: int):
         return np.minimum(a.success_action_count[node, :], self.max_action_count - 1)
 
+    def get_at_nodes(self, a: ActionTrackingStateAugmentation, nodes: np.ndarray, out: np.ndarray) -> None:
+        out[:] = np.minimum(a.success_action_count[nodes], self.max_action_count - 1)
+
 
 class Feature_failed_actions_at_node(Feature):
     """number of time each action failed at a given node"""
@@ -526,6 +745,9 @@ class Feature_failed_actions_at_node(Feature):
     def get(self, a: ActionTrackingStateAugmentation, node: int):
         return np.minimum(a.failed_action_count[node, :], self.max_action_count - 1)
 
+    def get_at_nodes(self, a: ActionTrackingStateAugmentation, nodes: np.ndarray, out: np.ndarray) -> None:
+        out[:] = np.minimum(a.failed_action_count[nodes], self.max_action_count - 1)
+
 
 class Verbosity(enum.IntEnum):
     """Verbosity of the learning function"""
@@ -550,3 +772,11 @@ class AgentWrapper(Wrapper):
         observation = self.env.reset()
         self.state.on_reset(observation)
         return observation
+
+    def sample_untried_action(self) -> cyberbattle_env.Action:
+        """Sample a valid action, avoiding the actions already tried in the current state
+        when the agent state tracks them. Falls back on any valid action once they were all tried."""
+        gym_action = None
+        if isinstance(self.state, ActionTrackingStateAugmentation):
+            gym_action = self.state.sample_untried_action()
+        return gym_action or self.env.sample_valid_action()
@@ -0,0 +1,153 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Test the feature encoders of the agent wrapper"""
+
+import gym
+import numpy as np
+
+import cyberbattle.agents.baseline.agent_wrapper as w
+from cyberbattle.agents.baseline.agent_wrapper import hash_feature_vectors
+
+
+def test_hash_feature_vectors_is_process_independent() -> None:
+    """Hashes must not depend on the per-process salt of the builtin `hash`"""
+    assert int(hash_feature_vectors([1, 0, 3])[0]) == 0xac2f9d1f12ef25b1
+
+
+def test_hash_feature_vectors_batch() -> None:
+    """Hashing a matrix gives the hash of each row"""
+    rng = np.random.default_rng(0)
+    matrix = rng.integers(0, 10, size=(50, 7))
+    batch = hash_feature_vectors(matrix)
+    assert batch.shape == (50,)
+    for row, h in zip(matrix, batch):
+        assert hash_feature_vectors(row)[0] == h
+    assert len(set(batch.tolist())) == len({tuple(r) for r in matrix.tolist()})
+    assert hash_feature_vectors([1, 2])[0] != hash_feature_vectors([2, 1])[0]
+
+
+def test_feature_memoization_per_step() -> None:
+    """Feature vectors are computed once per step and refreshed after each step"""
+    env = gym.make('CyberBattleToyCtf-v0')
+    ep = w.EnvironmentBounds.of_identifiers(maximum_node_count=12, maximum_total_credentials=10, identifiers=env.identifiers)
+    state = w.ActionTrackingStateAugmentation(ep, env.reset())
+    wrapped_env = w.AgentWrapper(env, state)
+    features = w.ConcatFeatures(ep, [w.Feature_success_actions_at_node(ep), w.Feature_active_node_age(ep)])
+
+    first = features.get(state, 0)
+    assert features.get(state, 0) is first
+    assert not first.flags.writeable
+
+    wrapped_env.step(env.sample_valid_action())
+    after_step = features.get(state, 0)
+    assert after_step is not first
+    np.testing.assert_array_equal(
+        after_step, np.concatenate([f.get(state, 0) for f in features.feature_selection]))
+
+
+def test_get_at_nodes_matches_per_node_features() -> None:
+    """The vectorized node x feature matrix agrees with the per-node feature vectors"""
+    env = gym.make('CyberBattleToyCtf-v0')
+    ep = w.EnvironmentBounds.of_identifiers(maximum_node_count=12, maximum_total_credentials=10, identifiers=env.identifiers)
+    state = w.ActionTrackingStateAugmentation(ep, env.reset())
+    wrapped_env = w.AgentWrapper(env, state)
+    features = w.ConcatFeatures(ep, [
+        w.Feature_discovered_notowned_node_count(ep, None),
+        w.Feature_discovered_ports(ep),
+        w.Feature_actions_tried_at_node(ep),
+        w.Feature_success_actions_at_node(ep),
+        w.Feature_failed_actions_at_node(ep),
+        w.Feature_active_node_properties(ep),
+        w.Feature_active_node_age(ep),
+        w.Feature_active_node_id(ep)
+    ])
+    assert features.node_matrix_buffer is None
+
+    for _ in range(30):
+        wrapped_env.step(env.sample_valid_action())
+        nodes = np.arange(state.observation['discovered_node_count'])
+        matrix = features.get_at_nodes(state, nodes)
+        assert matrix.dtype == np.float32
+        assert np.shares_memory(matrix, features.node_matrix_buffer)
+        np.testing.assert_array_equal(matrix, np.array([features.get(state, node) for node in nodes]))
+
+
+def test_valid_actions_mask_agrees_with_specialization() -> None:
+    """Every abstract action of the mask specializes into an action allowed by the environment"""
+    env = gym.make('CyberBattleToyCtf-v0')
+    ep = w.EnvironmentBounds.of_identifiers(maximum_node_count=12, maximum_total_credentials=10, identifiers=env.identifiers)
+    env = gym.make('CyberBattleToyCtf-v0', env_bounds=ep)
+    action_space = w.AbstractAction(ep)
+    np.random.seed(0)
+    observation = env.reset()
+    for _ in range(30):
+        observation, _, done, _ = env.step(env.sample_valid_action())
+        if done:
+            break
+
+    source_nodes = w.owned_nodes(observation)
+    mask = action_space.valid_actions_mask(source_nodes, observation)
+    assert mask.shape == (len(source_nodes), action_space.flat_size())
+    assert mask.any()
+    for source_node, row in zip(source_nodes, mask):
+        for abstract_action in np.nonzero(row)[0]:
+            gym_action = action_space.specialize_to_gymaction(source_node, observation, np.int32(abstract_action))
+            assert gym_action and env.is_action_valid(gym_action, observation['action_mask'])
+
+
+def test_sample_untried_action_does_not_repeat() -> None:
+    """Untried actions are valid and never repeated until the observation changes"""
+    env = gym.make('CyberBattleToyCtf-v0')
+    ep = w.EnvironmentBounds.of_identifiers(maximum_node_count=12, maximum_total_credentials=10, identifiers=env.identifiers)
+    env = gym.make('CyberBattleToyCtf-v0', env_bounds=ep)
+    np.random.seed(0)
+    state = w.ActionTrackingStateAugmentation(ep, env.reset())
+    wrapped_env = w.AgentWrapper(env, state)
+    observation = wrapped_env.reset()
+
+    tried = set()
+    for _ in range(200):
+        gym_action = state.sample_untried_action()
+        if gym_action is None:
+            break
+        assert env.is_action_valid(gym_action, observation['action_mask'])
+        kind, coordinates = next(iter(gym_action.items()))
+        # the credential is not part of the tried tuple of a connect action
+        key = (kind, tuple(coordinates[:3] if kind == 'connect' else coordinates))
+        signature = state.observation_signature
+        observation, _, done, _ = wrapped_env.step(gym_action)
+        if state.observation_signature != signature:
+            tried.clear()
+        else:
+            assert key not in tried
+            tried.add(key)
+        if done:
+            break
+
+
+def test_sample_untried_action_is_uniform() -> None:
+    """Each untried action is equally likely, whatever its kind"""
+    env = gym.make('CyberBattleToyCtf-v0')
+    ep = w.EnvironmentBounds.of_identifiers(maximum_node_count=12, maximum_total_credentials=10, identifiers=env.identifiers)
+    env = gym.make('CyberBattleToyCtf-v0', env_bounds=ep)
+    np.random.seed(0)
+    state = w.ActionTrackingStateAugmentation(ep, env.reset())
+    wrapped_env = w.AgentWrapper(env, state)
+    wrapped_env.reset()
+
+    # play until there are untried actions of several kinds, in different numbers
+    for _ in range(50):
+        untried_counts = np.array([len(actions) for actions in state.untried_actions()])
+        if np.count_nonzero(untried_counts) > 1:
+            break
+        wrapped_env.step(state.sample_untried_action())
+    expected = untried_counts / untried_counts.sum()
+    assert np.count_nonzero(expected) > 1
+
+    kinds = ['local_vulnerability', 'remote_vulnerability', 'connect']
+    sample_count = 6000
+    counts = np.zeros(3)
+    for _ in range(sample_count):
+        counts[kinds.index(next(iter(state.sample_untried_action())))] += 1
+    assert np.allclose(counts / sample_count, expected, atol=0.03)
@@ -0,0 +1,23 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Fixtures shared by the baseline agent tests"""
+
+import gym
+import pytest
+
+import cyberbattle.agents.baseline.agent_wrapper as w
+
+
+@pytest.fixture
+def tinymicro_bounds() -> w.EnvironmentBounds:
+    """Bounds of CyberBattleTinyMicro with all its honeytokens, with room for a single credential"""
+    env = gym.make('CyberBattleTinyMicro-v1234')
+    return w.EnvironmentBounds.of_identifiers(maximum_node_count=env.bounds.maximum_node_count,
+                                              maximum_total_credentials=1, identifiers=env.identifiers)
+
+
+@pytest.fixture
+def tinymicro_env(tinymicro_bounds):
+    """CyberBattleTinyMicro with all its honeytokens, created with the bounds of `tinymicro_bounds`"""
+    return gym.make('CyberBattleTinyMicro-v1234', env_bounds=tinymicro_bounds)
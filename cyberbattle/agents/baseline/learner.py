@@ -2,7 +2,11 @@
 # Licensed under the MIT License.
 
 """Learner helpers and epsilon greedy search"""
+import copy
+import functools
+import logging
 import math
+import queue
 import sys
 import os
 import re
@@ -14,7 +18,8 @@ import numpy as np
 import torch
 import random
 from cyberbattle._env import cyberbattle_env
-from typing import Tuple, Optional, TypedDict, List
+from cyberbattle.simulation.model import DeceptionTracker
+from typing import Dict, Tuple, Optional, TypedDict, List
 import progressbar
 import abc
 from torch.utils.tensorboard.summary import hparams
@@ -46,6 +51,16 @@ class Learner(abc.ABC):
         action_metadata is a custom object that gets passed to the on_step callback function"""
         raise NotImplementedError
 
+    def explore_batch(self, wrapped_envs: List[AgentWrapper]) -> List[Tuple[str, cyberbattle_env.Action, object]]:
+        """Exploration function applied to a batch of environments.
+        Returns one (action_type, gym_action, action_metadata) per environment"""
+        return [self.explore(wrapped_env) for wrapped_env in wrapped_envs]
+
+    def exploit_batch(self, wrapped_envs: List[AgentWrapper], observations: List) -> List[Tuple[str, Optional[cyberbattle_env.Action], object]]:
+        """Exploit function applied to a batch of environments.
+        Returns one (action_type, gym_action, action_metadata) per environment"""
+        return [self.exploit(wrapped_env, observation) for wrapped_env, observation in zip(wrapped_envs, observations)]
+
     @abc.abstractmethod
     def on_step(self, wrapped_env: AgentWrapper, observation, reward, done, info, action_metadata) -> None:
         raise NotImplementedError
@@ -59,6 +74,10 @@ class Learner(abc.ABC):
     def save(self, filename) -> None:
         return
 
+    def evaluation_snapshot(self) -> 'Learner':
+        """Independent copy of the learner, sufficient to evaluate it in another process"""
+        return copy.deepcopy(self)
+
     def load_best(self, filename) -> None:
         return
 
@@ -81,16 +100,33 @@ class Learner(abc.ABC):
 
 
 class RandomPolicy(Learner):
-    """A policy that does not learn and only explore"""
+    """A policy that does not learn and only explore
+
+    avoid_tried_actions -- do not repeat the actions already tried since the last change of the observation
+    """
+
+    def __init__(self, avoid_tried_actions: bool = False):
+        self.avoid_tried_actions = avoid_tried_actions
+
+    def sample_action(self, wrapped_env: AgentWrapper) -> cyberbattle_env.Action:
+        if self.avoid_tried_actions:
+            return wrapped_env.sample_untried_action()
+        return wrapped_env.env.sample_valid_action()
 
     def explore(self, wrapped_env: AgentWrapper) -> Tuple[str, cyberbattle_env.Action, object]:
-        gym_action = wrapped_env.env.sample_valid_action()
+        gym_action = self.sample_action(wrapped_env)
         return "explore", gym_action, None
 
     def exploit(self, wrapped_env: AgentWrapper, observation) -> Tuple[str, Optional[cyberbattle_env.Action], object]:
-        gym_action = wrapped_env.env.sample_valid_action()
+        gym_action = self.sample_action(wrapped_env)
         return "explore", gym_action, None
 
+    def explore_batch(self, wrapped_envs: List[AgentWrapper]) -> List[Tuple[str, cyberbattle_env.Action, object]]:
+        return [("explore", self.sample_action(wrapped_env), None) for wrapped_env in wrapped_envs]
+
+    def exploit_batch(self, wrapped_envs: List[AgentWrapper], observations: List) -> List[Tuple[str, Optional[cyberbattle_env.Action], object]]:
+        return self.explore_batch(wrapped_envs)
+
     def on_step(self, wrapped_env: AgentWrapper, observation, reward, done, info, action_metadata):
         return None
 
@@ -122,6 +158,54 @@ TrainedLearner = TypedDict('TrainedLearner', {
 })
 
 
+class EarlyStopping:
+    """Stop an epsilon greedy search once a running mean of the rewards stops improving
+
+    Parameters
+    ==========
+    metric -- 'eval_run_mean' to watch the best evaluation running mean after each evaluation,
+    or 'run_mean' to watch the best training running mean after each training episode
+    patience -- number of consecutive checks without an improvement before stopping
+    min_delta -- an improvement is an increase of the metric by more than this
+    goal -- also stop as soon as the metric reaches this value (e.g. the reward of capturing the flag)
+    """
+
+    METRICS = ['eval_run_mean', 'run_mean']
+
+    def __init__(self, metric: str = 'eval_run_mean', patience: int = 10, min_delta: float = 0.0,
+                 goal: Optional[float] = None):
+        if metric not in self.METRICS:
+            raise ValueError(f'unsupported early stopping metric {metric}, expected one of {self.METRICS}')
+        self.metric = metric
+        self.patience = patience
+        self.min_delta = min_delta
+        self.goal = goal
+        self.best = -sys.float_info.max
+        self.checks_without_improvement = 0
+        # set when the search is stopped
+        self.stop_reason: Optional[str] = None
+        self.stopped_at_episode: Optional[int] = None
+        self.best_checkpoint: Optional[str] = None
+
+    def update(self, value: float, i_episode: int) -> bool:
+        """Check a new value of the metric, returns True if the search should stop"""
+        # the metrics watched are best-so-far maxima: a plateau must count as no improvement
+        if value > self.best + self.min_delta:
+            self.best = value
+            self.checks_without_improvement = 0
+        else:
+            self.checks_without_improvement += 1
+
+        if self.goal is not None and value >= self.goal:
+            self.stop_reason = f'{self.metric} reached the goal {self.goal} ({value})'
+        elif self.checks_without_improvement >= self.patience:
+            self.stop_reason = f'{self.metric} did not improve by {self.min_delta} for {self.patience} checks ' \
+                f'(best {self.best})'
+        if self.stop_reason:
+            self.stopped_at_episode = i_episode
+        return self.stop_reason is not None
+
+
 def write_to_summary(writer, all_rewards, epsilon, loss_string, observation, iteration_count, run_mean, steps_done, writer_tag="training"):
     """
     all_rewards: - (training case) list of rewards per episode; (evaluation case) list of sum of rewards during episode
@@ -152,8 +236,6 @@ def write_to_summary(writer, all_rewards, epsilon, loss_string, observation, ite
     else:
         writer.add_scalar("eval_run_mean", run_mean, steps_done)
 
-    writer.flush()
-
 
 def print_stats(stats):
     """Print learning statistics"""
@@ -180,6 +262,97 @@ def print_stats(stats):
     print(f"  exploit deflected to exploration: {stats['exploit_deflected_to_explore']}")
 
 
+EvaluationEpisode = TypedDict('EvaluationEpisode', {
+    'rewards': List[float],
+    'availability': List[float],
+    'stats': Stats,
+    'episode_ended_at': Optional[int],
+    'dead_end': bool,
+    'deception_tracker': Dict[str, DeceptionTracker]
+})
+
+
+def evaluation_episode(
+    wrapped_env: AgentWrapper,
+    learner: Learner,
+    iteration_count: int,
+    verbosity: Verbosity = Verbosity.Normal,
+    render_rewards_to: Optional[str] = None
+) -> EvaluationEpisode:
+    """Run one greedy evaluation episode of a learner (in eval mode).
+    If `render_rewards_to` is set the environment is rendered to files with this prefix
+    each time there is a positive reward"""
+    cyberbattle_gym_env = wrapped_env.env
+    observation = wrapped_env.reset()
+    total_reward = 0.0
+    all_rewards = []
+    all_availability = []
+    learner.new_episode()
+
+    stats = Stats(exploit=Outcomes(reward=Breakdown(local=0, remote=0, connect=0),
+                                   noreward=Breakdown(local=0, remote=0, connect=0)),
+                  explore=Outcomes(reward=Breakdown(local=0, remote=0, connect=0),
+                                   noreward=Breakdown(local=0, remote=0, connect=0)),
+                  exploit_deflected_to_explore=0
+                  )
+
+    episode_ended_at = None
+    dead_end = False
+    render_file_index = 1
+    sys.stdout.flush()
+
+    for t in range(1, 1 + iteration_count):
+
+        action_style, gym_action, action_metadata = learner.exploit(wrapped_env, observation)
+        if not gym_action:
+            stats['exploit_deflected_to_explore'] += 1
+            _, gym_action, action_metadata = learner.explore(wrapped_env)  # TODO: evaluation - exclude gym_aciton is None due to 1) NN no candidates 2)  > n_discovered_nodes, > n_credential_cache
+
+        # Take the step
+        observation, reward, done, info = wrapped_env.step(gym_action)
+
+        action_type = 'exploit' if action_style == 'exploit' else 'explore'
+        outcome = 'reward' if reward > 0 else 'noreward'
+        if 'local_vulnerability' in gym_action:
+            stats[action_type][outcome]['local'] += 1
+        elif 'remote_vulnerability' in gym_action:
+            stats[action_type][outcome]['remote'] += 1
+        else:
+            stats[action_type][outcome]['connect'] += 1
+
+        assert np.shape(reward) == ()
+
+        all_rewards.append(reward)
+        all_availability.append(info['network_availability'])
+        total_reward += reward
+
+        if verbosity == Verbosity.Verbose or (verbosity == Verbosity.Normal and reward > 0):
+            sign = ['-', '+'][reward > 0]
+
+            print(f"    {sign} t={t} {action_style} r={reward} total_reward:{total_reward} "
+                  f"a={action_metadata}-{gym_action} "
+                  f"creds={len(observation['credential_cache_matrix'])} "
+                  f" {learner.stateaction_as_string(action_metadata)}")
+
+        if render_rewards_to is not None and reward > 0:
+            fig = cyberbattle_gym_env.render_as_fig()
+            fig.write_image(f"{render_rewards_to}-{render_file_index}.png")
+            render_file_index += 1
+
+        learner.end_of_iteration(t, done)
+
+        if done:
+            episode_ended_at = t
+            dead_end = info.get('dead_end', False)
+            break
+
+    sys.stdout.flush()
+
+    return EvaluationEpisode(rewards=all_rewards, availability=all_availability, stats=stats,
+                             episode_ended_at=episode_ended_at, dead_end=dead_end,
+                             deception_tracker=observation['_deception_tracker'])
+
+
 def evaluate_model(
     cyberbattle_gym_env: cyberbattle_env.CyberBattleEnv,
     environment_properties: EnvironmentBounds,
@@ -196,8 +369,19 @@ def evaluate_model(
     render=True,
     render_last_episode_rewards_to: Optional[str] = None,
     verbosity: Verbosity = Verbosity.Normal,
-    save_model_filename=""
+    save_model_filename="",
+    evaluator=None,
+    evaluation=None,
+    headless=False
 ) -> TrainedLearner:
+    """Evaluate a learner greedily for `eval_episode_count` episodes
+
+    The episodes run in this process, or in the worker processes of `evaluator`
+    (a `parallel_evaluation.ParallelEvaluator`) if set. If `evaluation` is set
+    (a `PendingEvaluation` submitted to an evaluator earlier) its episodes are
+    recorded instead, and the evaluated snapshot of the learner is saved as best model.
+    In `headless` mode only one line is printed per evaluation episode.
+    """
     writer = configuration.writer
 
     print(f"###### {title}\n"
@@ -213,105 +397,29 @@ def evaluate_model(
     all_episodes_sum_rewards = []
     all_episodes_availability = []
 
-    wrapped_env = AgentWrapper(cyberbattle_gym_env,
-                               ActionTrackingStateAugmentation(environment_properties, cyberbattle_gym_env.reset()))
     steps_done = 0
 
     plot_title = f"{title} (epochs={eval_episode_count}, ϵ={initial_epsilon}" + learner.parameters_as_string()
 
-    render_file_index = 1
-    learner.eval()
-
     if configuration.log_results:
         detection_points_results = {}
 
-    for i_episode in range(1, eval_episode_count + 1):
-
-        print(f"  ## Episode: {i_episode}/{eval_episode_count} '{title}' "
-              f"ϵ={epsilon:.4f}, "
-              f"{learner.parameters_as_string()}")
-
-        observation = wrapped_env.reset()
-        total_reward = 0.0
-        all_rewards = []
-        all_availability = []
-        learner.new_episode()
-
-        stats = Stats(exploit=Outcomes(reward=Breakdown(local=0, remote=0, connect=0),
-                                       noreward=Breakdown(local=0, remote=0, connect=0)),
-                      explore=Outcomes(reward=Breakdown(local=0, remote=0, connect=0),
-                                       noreward=Breakdown(local=0, remote=0, connect=0)),
-                      exploit_deflected_to_explore=0
-                      )
-
-        episode_ended_at = None
-        sys.stdout.flush()
-
-        for t in range(1, 1 + iteration_count):
-
-            steps_done += 1
-
-            # x = np.random.rand()
-            # if x <= epsilon:
-            #     action_style, gym_action, action_metadata = learner.explore(wrapped_env)
-            # else:
-            action_style, gym_action, action_metadata = learner.exploit(wrapped_env, observation)
-            if not gym_action:
-                stats['exploit_deflected_to_explore'] += 1
-                _, gym_action, action_metadata = learner.explore(wrapped_env)  # TODO: evaluation - exclude gym_aciton is None due to 1) NN no candidates 2)  > n_discovered_nodes, > n_credential_cache
-
-            # Take the step
-            # logger.debug(f"gym_action={gym_action}, action_metadata={action_metadata}") if configuration.log_results else None
-            observation, reward, done, info = wrapped_env.step(gym_action)
-
-            action_type = 'exploit' if action_style == 'exploit' else 'explore'
-            outcome = 'reward' if reward > 0 else 'noreward'
-            if 'local_vulnerability' in gym_action:
-                stats[action_type][outcome]['local'] += 1
-            elif 'remote_vulnerability' in gym_action:
-                stats[action_type][outcome]['remote'] += 1
-            else:
-                stats[action_type][outcome]['connect'] += 1
-
-            # learner.on_step(wrapped_env, observation, reward, done, info, action_metadata)
-            assert np.shape(reward) == ()
-
-            all_rewards.append(reward)
-            all_availability.append(info['network_availability'])
-            total_reward += reward
-            # bar.update(t, reward=total_reward)
-            # if reward > 0:
-            # bar.update(t, last_reward_at=t)
-
-            if verbosity == Verbosity.Verbose or (verbosity == Verbosity.Normal and reward > 0):
-                sign = ['-', '+'][reward > 0]
-
-                print(f"    {sign} t={t} {action_style} r={reward} total_reward:{total_reward} "
-                      f"a={action_metadata}-{gym_action} "
-                      f"creds={len(observation['credential_cache_matrix'])} "
-                      f" {learner.stateaction_as_string(action_metadata)}")
-
-            if i_episode == eval_episode_count \
-                    and render_last_episode_rewards_to is not None \
-                    and reward > 0:
-                fig = cyberbattle_gym_env.render_as_fig()
-                fig.write_image(f"{render_last_episode_rewards_to}-e{i_episode}-{render_file_index}.png")
-                render_file_index += 1
+    if evaluation is None and evaluator is not None:
+        evaluation = evaluator.submit(learner, eval_episode_count, iteration_count, seed=training_steps_done)
+    # the learner evaluated, and saved when it reaches a new best running mean
+    evaluated_learner = evaluation.learner if evaluation is not None else learner
 
-            learner.end_of_iteration(t, done)
-
-            if done:
-                episode_ended_at = t
-                # bar.update(t, done_at=t)
-                # bar.finish(dirty=True)
-                break
-
-        sys.stdout.flush()
+    def record_episode(i_episode: int, episode: EvaluationEpisode) -> None:
+        nonlocal steps_done, best_eval_running_mean
+        all_rewards = episode['rewards']
+        episode_ended_at = episode['episode_ended_at']
+        total_reward = sum(all_rewards)
+        steps_done += len(all_rewards)
 
         loss_string = learner.loss_as_string()
 
         if (not training_episode_done % (5 * eval_freq)) and configuration.log_results:
-            for name, deception_tracker in observation['_deception_tracker'].items():
+            for name, deception_tracker in episode['deception_tracker'].items():
                 detection_points_results[name] = detection_points_results.get(name, [[], [0], []])
                 _, name_indptr, _ = detection_points_results[name]
                 # if len(deception_tracker.trigger_times):
@@ -323,15 +431,17 @@ def evaluate_model(
             loss_string = f"loss={loss_string}"
 
         if episode_ended_at:
-            print(f"Episode {i_episode} ended at t={episode_ended_at} total_reward {total_reward} with {loss_string}")
+            print(f"Episode {i_episode} ended{' at a dead end' if episode['dead_end'] else ''} at t={episode_ended_at} "
+                  f"total_reward {total_reward} with {loss_string}")
         else:
             print(f"Episode {i_episode} stopped at t={iteration_count} total_reward {total_reward} with {loss_string}")
 
-        print_stats(stats)
+        if not headless:
+            print_stats(episode['stats'])
 
-        all_episodes_sum_rewards.append(sum(all_rewards))
+        all_episodes_sum_rewards.append(total_reward)
         all_episodes_rewards.append(all_rewards)
-        all_episodes_availability.append(all_availability)
+        all_episodes_availability.append(episode['availability'])
 
         mean_over_window = np.mean(all_episodes_sum_rewards[-mean_reward_window:])
         if best_eval_running_mean < mean_over_window:
@@ -339,8 +449,8 @@ def evaluate_model(
             best_eval_running_mean = mean_over_window
 
             if save_model_filename:
-                learner.save(save_model_filename.replace('.tar', f'_eval_steps{training_steps_done + steps_done}.tar'))
-                learner.save(save_model_filename.replace('.tar', '_eval_best.tar'))
+                evaluated_learner.save(save_model_filename.replace('.tar', f'_eval_steps{training_steps_done + steps_done}.tar'))
+                evaluated_learner.save(save_model_filename.replace('.tar', '_eval_best.tar'))
 
         if (not training_episode_done % (5 * eval_freq)) and configuration.log_results:
             np.savez(os.path.join(configuration.log_dir, 'training',
@@ -350,17 +460,43 @@ def evaluate_model(
                         {name + '_eplength': np.array(v[2]) for name, v in detection_points_results.items()}))
 
         if configuration.log_results:
-            write_to_summary(writer, np.array(all_rewards), epsilon, loss_string, observation, iteration_count, best_eval_running_mean,
+            write_to_summary(writer, np.array(all_rewards), epsilon, loss_string,
+                             {'_deception_tracker': episode['deception_tracker']}, iteration_count, best_eval_running_mean,
                              training_steps_done + steps_done, writer_tag="evaluation")
-        length = episode_ended_at if episode_ended_at else iteration_count
-        learner.end_of_episode(i_episode=i_episode, t=length)
-        # if render:
-        #     wrapped_env.render()
 
-    wrapped_env.close()
-    logger.info("evaluation ended\n") if configuration.log_results else None
+    if evaluation is not None:
+        for i_episode, episode in enumerate(evaluation.result(), 1):
+            if not headless:
+                print(f"  ## Episode: {i_episode}/{eval_episode_count} '{title}' (worker) "
+                      f"ϵ={epsilon:.4f}, "
+                      f"{learner.parameters_as_string()}")
+            record_episode(i_episode, episode)
+    else:
+        wrapped_env = AgentWrapper(cyberbattle_gym_env,
+                                   ActionTrackingStateAugmentation(environment_properties, cyberbattle_gym_env.reset()))
+        learner.eval()
+
+        for i_episode in range(1, eval_episode_count + 1):
+
+            if not headless:
+                print(f"  ## Episode: {i_episode}/{eval_episode_count} '{title}' "
+                      f"ϵ={epsilon:.4f}, "
+                      f"{learner.parameters_as_string()}")
+
+            render_rewards_to = f"{render_last_episode_rewards_to}-e{i_episode}" \
+                if i_episode == eval_episode_count and render_last_episode_rewards_to is not None else None
+            episode = evaluation_episode(wrapped_env, learner, iteration_count, verbosity, render_rewards_to)
+            record_episode(i_episode, episode)
 
-    learner.train()
+            length = episode['episode_ended_at'] if episode['episode_ended_at'] else iteration_count
+            learner.end_of_episode(i_episode=i_episode, t=length)
+            # if render:
+            #     wrapped_env.render()
+
+        wrapped_env.close()
+        learner.train()
+
+    logger.info("evaluation ended\n") if configuration.log_results else None
 
     return TrainedLearner(
         all_episodes_rewards=all_episodes_rewards,
@@ -372,6 +508,29 @@ def evaluate_model(
     )
 
 
+def put_unless_stopped(channel, message, stop) -> None:
+    """Put a message on a bounded multiprocessing queue, giving up once the `stop` event is set"""
+    while not stop.is_set():
+        try:
+            channel.put(message, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def restores_logger_level(function):
+    """Restore the level of the simulation logger once `function` returns or raises"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        log_level = logger.level
+        try:
+            return function(*args, **kwargs)
+        finally:
+            logger.setLevel(log_level)
+    return wrapper
+
+
+@restores_logger_level
 def epsilon_greedy_search(
     cyberbattle_gym_env: cyberbattle_env.CyberBattleEnv,
     environment_properties: EnvironmentBounds,
@@ -392,7 +551,11 @@ def epsilon_greedy_search(
     verbosity: Verbosity = Verbosity.Normal,
     plot_episodes_length=True,
     save_model_filename="",
-    only_eval_summary=False
+    only_eval_summary=False,
+    evaluator=None,
+    eval_async=False,
+    early_stopping: Optional[EarlyStopping] = None,
+    headless: Optional[bool] = None
 ) -> TrainedLearner:
     """Epsilon greedy search for CyberBattle gym environments
 
@@ -430,6 +593,20 @@ def epsilon_greedy_search(
     - plot_episodes_length -- Plot the graph showing total number of steps by episode
     at th end of the search.
 
+    - evaluator -- a `parallel_evaluation.ParallelEvaluator` running the evaluation episodes
+    in worker processes, instead of sequentially in this process
+
+    - eval_async -- with an `evaluator`, keep training while a snapshot of the learner is evaluated
+    and record the evaluation once it is done (an evaluation due while the previous one
+    is still running is skipped)
+
+    - early_stopping -- stop the search before `episode_count` episodes once its metric stops
+    improving; the reason is recorded in `early_stopping.stop_reason` and `best_checkpoint`
+    names the best model saved (if `save_model_filename` is set)
+
+    - headless -- fast training without progress bars, per-step logging or per-episode breakdowns:
+    only errors are logged and one line is printed per episode (default: `configuration.headless`)
+
     Note on convergence
     ===================
 
@@ -449,6 +626,13 @@ def epsilon_greedy_search(
 
     writer = configuration.writer
 
+    headless = configuration.headless if headless is None else headless
+    if headless:
+        # the environment only formats its per-step messages if the logger lets them through,
+        # the level is restored by `restores_logger_level`
+        logger.setLevel(logging.ERROR)
+        verbosity = Verbosity.Quiet
+
     print(f"###### {title}\n"
           f"Learning with: episode_count={episode_count},"
           f"iteration_count={iteration_count},"
@@ -521,15 +705,35 @@ def epsilon_greedy_search(
 
     detection_points_results = {}
 
+    # evaluation running on the evaluator while training continues, and the (steps, episode, epsilon) it started at
+    pending_evaluation = None
+    pending_evaluation_at = (0, 0, epsilon)
+
+    def record_pending_evaluation() -> float:
+        """Record the pending evaluation at the steps, episode and epsilon it was submitted at.
+        Note that the loss shown is the current loss of the learner, not its loss at that time."""
+        nonlocal pending_evaluation
+        steps_at, episode_at, epsilon_at = pending_evaluation_at
+        logger.info(f"Evaluation of the network on episode {episode_at} step {steps_at} done")
+        trained_learner_results = evaluate_model(cyberbattle_gym_env, environment_properties, learner, title, iteration_count, epsilon_at,
+                                                 eval_episode_count, best_eval_running_mean, training_steps_done=steps_at, training_episode_done=episode_at,
+                                                 render=True, mean_reward_window=mean_reward_window,
+                                                 render_last_episode_rewards_to=None, eval_freq=eval_freq,
+                                                 verbosity=Verbosity.Quiet, save_model_filename=save_model_filename,
+                                                 evaluation=pending_evaluation, headless=headless)
+        pending_evaluation = None
+        return trained_learner_results['best_running_mean']
+
     logger.info('episode_counts ' + str(episode_count))
 
     # for i_episode in range(1, episode_count + 1):
     while steps_done <= episode_count * iteration_count:
         i_episode += 1
 
-        print(f"  ## Episode: {i_episode}/{episode_count} '{title}' "
-              f"ϵ={epsilon:.4f}, "
-              f"{learner.parameters_as_string()}")
+        if not headless:
+            print(f"  ## Episode: {i_episode}/{episode_count} '{title}' "
+                  f"ϵ={epsilon:.4f}, "
+                  f"{learner.parameters_as_string()}")
 
         observation = wrapped_env.reset()
         total_reward = 0.0
@@ -545,9 +749,10 @@ def epsilon_greedy_search(
                       )
 
         episode_ended_at = None
+        dead_end = False
         sys.stdout.flush()
 
-        bar = progressbar.ProgressBar(
+        bar = None if headless else progressbar.ProgressBar(
             widgets=[
                 'Episode ',
                 f'{i_episode:4}',
@@ -579,7 +784,7 @@ def epsilon_greedy_search(
             epsilon = epsilon_minimum + math.exp(-5. * steps_done /  # min is exp(-5) ~ 0.007 compare to exp(-1) ~ 0.37
                                                  (epsilon_exponential_decay * iteration_count)) * (initial_epsilon - epsilon_minimum)
 
-        for t in bar(range(1, 1 + iteration_count)):
+        for t in (range(1, 1 + iteration_count) if headless else bar(range(1, 1 + iteration_count))):
 
             steps_done += 1
 
@@ -595,7 +800,8 @@ def epsilon_greedy_search(
                     _, gym_action, action_metadata = learner.explore(wrapped_env)
 
             # Take the step
-            logger.debug(f"gym_action={gym_action}, action_metadata={action_metadata}") if configuration.log_results else None
+            logger.debug(f"gym_action={gym_action}, action_metadata={action_metadata}") \
+                if configuration.log_results and logger.isEnabledFor(logging.DEBUG) else None
             observation, reward, done, info = wrapped_env.step(gym_action)
 
             action_type = 'exploit' if action_style == 'exploit' else 'explore'
@@ -613,12 +819,11 @@ def epsilon_greedy_search(
             all_rewards.append(reward)
             all_availability.append(info['network_availability'])
             total_reward += reward
-            bar.update(t, reward=total_reward)
-            bar.update(t, epsilon=epsilon)
-            bar.update(t, best_eval_mean=best_eval_running_mean)
+            if bar:
+                bar.update(t, reward=total_reward, epsilon=epsilon, best_eval_mean=best_eval_running_mean)
 
-            if reward > 0:
-                bar.update(t, last_reward_at=t)
+                if reward > 0:
+                    bar.update(t, last_reward_at=t)
 
             if verbosity == Verbosity.Verbose or (verbosity == Verbosity.Normal and reward > 0):
                 sign = ['-', '+'][reward > 0]
@@ -639,15 +844,16 @@ def epsilon_greedy_search(
 
             if done:
                 episode_ended_at = t
-                bar.update(t, done_at=t)
-                bar.update(t, steps_done=steps_done)
-                bar.update(t, loss=getattr(learner, 'loss', None))
-                bar.finish(dirty=True)
+                dead_end = info.get('dead_end', False)
+                if bar:
+                    bar.update(t, done_at=t, steps_done=steps_done, loss=getattr(learner, 'loss', None))
+                    bar.finish(dirty=True)
                 break
 
         # Log progressbar to ligfile
         sys.stdout.flush()
-        logger.info(str(bar._format_line()))
+        if bar:
+            logger.info(str(bar._format_line()))
 
         loss_string = learner.loss_as_string()
 
@@ -664,21 +870,41 @@ def epsilon_greedy_search(
             loss_string = f"loss={loss_string}"
 
         if episode_ended_at:
-            print(f"Episode {i_episode} ended at t={episode_ended_at} total_reward {total_reward} with {loss_string}")
+            print(f"Episode {i_episode} ended{' at a dead end' if dead_end else ''} at t={episode_ended_at} "
+                  f"total_reward {total_reward} with {loss_string}")
         else:
             print(f"Episode {i_episode} stopped at t={iteration_count} total_reward {total_reward} with {loss_string}")
 
-        print_stats(stats)
+        if not headless:
+            print_stats(stats)
 
         # Evaluate model
+        evaluated = False
         if not i_episode % eval_freq:
-            logger.info(f"Evaluate network on episode {i_episode} step {steps_done}")
-            trained_learner_results = evaluate_model(cyberbattle_gym_env, environment_properties, learner, title, iteration_count, epsilon,
-                                                     eval_episode_count, best_eval_running_mean, training_steps_done=steps_done, training_episode_done=i_episode,
-                                                     render=True, mean_reward_window=mean_reward_window,
-                                                     render_last_episode_rewards_to=None, eval_freq=eval_freq,
-                                                     verbosity=Verbosity.Quiet, save_model_filename=save_model_filename)
-            best_eval_running_mean = trained_learner_results['best_running_mean']
+            if evaluator is not None and eval_async:
+                if pending_evaluation is None:
+                    logger.info(f"Start evaluating network on episode {i_episode} step {steps_done}")
+                    pending_evaluation = evaluator.submit(learner, eval_episode_count, iteration_count, seed=steps_done)
+                    pending_evaluation_at = (steps_done, i_episode, epsilon)
+                else:
+                    logger.info(f"Skip evaluation on episode {i_episode}: the previous one is still running")
+            else:
+                logger.info(f"Evaluate network on episode {i_episode} step {steps_done}")
+                trained_learner_results = evaluate_model(cyberbattle_gym_env, environment_properties, learner, title, iteration_count, epsilon,
+                                                         eval_episode_count, best_eval_running_mean, training_steps_done=steps_done, training_episode_done=i_episode,
+                                                         render=True, mean_reward_window=mean_reward_window,
+                                                         render_last_episode_rewards_to=None, eval_freq=eval_freq,
+                                                         verbosity=Verbosity.Quiet, save_model_filename=save_model_filename,
+                                                         evaluator=evaluator, headless=headless)
+                best_eval_running_mean = trained_learner_results['best_running_mean']
+                evaluated = True
+
+        if pending_evaluation is not None and pending_evaluation.done():
+            best_eval_running_mean = record_pending_evaluation()
+            evaluated = True
+
+        if early_stopping and early_stopping.metric == 'eval_run_mean' and evaluated:
+            early_stopping.update(best_eval_running_mean, i_episode)
 
         all_episodes_sum_rewards.append(sum(all_rewards))
         all_episodes_rewards.append(all_rewards)
@@ -693,6 +919,9 @@ def epsilon_greedy_search(
                 learner.save(save_model_filename.replace('.tar', f'_steps{steps_done}.tar'))
                 learner.save(save_model_filename.replace('.tar', '_best.tar'))
 
+        if early_stopping and early_stopping.metric == 'run_mean':
+            early_stopping.update(best_running_mean, i_episode)
+
         if configuration.log_results and not only_eval_summary:
             write_to_summary(writer, np.array(all_rewards), epsilon, loss_string, observation, iteration_count, best_running_mean,
                              steps_done)
@@ -713,6 +942,19 @@ def epsilon_greedy_search(
                         {name + '_indptr': np.array(v[1]) for name, v in detection_points_results.items()} |
                         {name + '_eplength': np.array(v[2]) for name, v in detection_points_results.items()}))
 
+        if early_stopping and early_stopping.stop_reason:
+            if save_model_filename:
+                early_stopping.best_checkpoint = save_model_filename.replace(
+                    '.tar', '_eval_best.tar' if early_stopping.metric == 'eval_run_mean' else '_best.tar')
+            print(f"Early stopping at episode {i_episode} step {steps_done}: {early_stopping.stop_reason}")
+            logger.info(f"Early stopping at episode {i_episode} step {steps_done}: {early_stopping.stop_reason}")
+            if configuration.log_results:
+                writer.add_text("early_stopping", early_stopping.stop_reason, steps_done)
+            break
+
+    if pending_evaluation is not None:
+        best_eval_running_mean = record_pending_evaluation()
+
     if configuration.log_results:
         np.savez(os.path.join(configuration.log_dir, 'training', f'detection_points_results_e{i_episode}.npz'),
                  **({name + '_indices': np.array(v[0]) for name, v in detection_points_results.items()} |
@@ -725,6 +967,7 @@ def epsilon_greedy_search(
 
     wrapped_env.close()
     logger.info("simulation ended\n") if configuration.log_results else None
+    writer.flush() if configuration.log_results else None
 
     if plot_episodes_length:
         plottraining.plot_end()
@@ -739,6 +982,126 @@ def epsilon_greedy_search(
     )
 
 
+def epsilon_greedy_search_batch(
+    cyberbattle_gym_envs: List[cyberbattle_env.CyberBattleEnv],
+    environment_properties: EnvironmentBounds,
+    learner: Learner,
+    title: str,
+    episode_count: int,
+    iteration_count: int,
+    epsilon: float,
+    epsilon_minimum=0.0,
+    epsilon_exponential_decay: Optional[int] = None,
+    mean_reward_window=10,
+    seed=0,
+    verbosity: Verbosity = Verbosity.Normal
+) -> TrainedLearner:
+    """Epsilon greedy search stepping a batch of K environments in lockstep
+
+    At every iteration the learner picks the actions of all the environments
+    with one call to `explore_batch` and one call to `exploit_batch`
+    (exploits that fail are deflected to one more `explore_batch`).
+    An environment is reset as soon as its episode ends, until `episode_count`
+    episodes were completed across all environments.
+
+    Parameters are those of `epsilon_greedy_search`. The exponential epsilon
+    decay is computed on the total number of steps taken in all environments.
+    Note that the per-episode hooks of the learner (`new_episode`,
+    `end_of_episode`) are called for interleaved episodes.
+    """
+    torch.manual_seed(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+
+    print(f"###### {title}\n"
+          f"Learning on {len(cyberbattle_gym_envs)} environments with: episode_count={episode_count},"
+          f"iteration_count={iteration_count},"
+          f"ϵ={epsilon},"
+          f'ϵ_min={epsilon_minimum}, ' +
+          (f"ϵ_expdecay={epsilon_exponential_decay}," if epsilon_exponential_decay else '') +
+          f"{learner.parameters_as_string()}")
+
+    initial_epsilon = epsilon
+    env_count = len(cyberbattle_gym_envs)
+    wrapped_envs = [AgentWrapper(env, ActionTrackingStateAugmentation(environment_properties, env.reset()))
+                    for env in cyberbattle_gym_envs]
+    observations = [wrapped_env.reset() for wrapped_env in wrapped_envs]
+    episodes_rewards: List[List[float]] = [[] for _ in range(env_count)]
+    episodes_availability: List[List[float]] = [[] for _ in range(env_count)]
+
+    all_episodes_rewards: List[List[float]] = []
+    all_episodes_availability: List[List[float]] = []
+    best_running_mean = -sys.float_info.max
+    steps_done = 0
+    learner.new_episode()
+
+    while len(all_episodes_rewards) < episode_count:
+        if epsilon_exponential_decay:
+            epsilon = epsilon_minimum + math.exp(-5. * steps_done /
+                                                 (epsilon_exponential_decay * iteration_count)) * (initial_epsilon - epsilon_minimum)
+
+        explore = np.random.rand(env_count) <= epsilon
+        choices: List = [None] * env_count
+        explore_indices = list(np.flatnonzero(explore))
+        exploit_indices = list(np.flatnonzero(~explore))
+
+        if exploit_indices:
+            exploited = learner.exploit_batch([wrapped_envs[i] for i in exploit_indices],
+                                              [observations[i] for i in exploit_indices])
+            for i, choice in zip(exploit_indices, exploited):
+                if choice[1]:
+                    choices[i] = choice
+                else:
+                    explore_indices.append(i)
+        if explore_indices:
+            for i, choice in zip(explore_indices, learner.explore_batch([wrapped_envs[i] for i in explore_indices])):
+                choices[i] = choice
+
+        for i, (wrapped_env, (action_style, gym_action, action_metadata)) in enumerate(zip(wrapped_envs, choices)):
+            steps_done += 1
+            observation, reward, done, info = wrapped_env.step(gym_action)
+            learner.on_step(wrapped_env, observation, reward, done, info, action_metadata)
+            observations[i] = observation
+            episodes_rewards[i].append(reward)
+            episodes_availability[i].append(info['network_availability'])
+            t = len(episodes_rewards[i])
+            learner.end_of_iteration(t, done)
+
+            if verbosity == Verbosity.Verbose or (verbosity == Verbosity.Normal and reward > 0):
+                sign = ['-', '+'][reward > 0]
+                print(f"    {sign} env={i} t={t} {action_style} r={reward} total_reward:{sum(episodes_rewards[i])} "
+                      f"a={action_metadata}-{gym_action}")
+
+            if done or t >= iteration_count:
+                all_episodes_rewards.append(episodes_rewards[i])
+                all_episodes_availability.append(episodes_availability[i])
+                i_episode = len(all_episodes_rewards)
+                mean_over_window = np.mean([sum(r) for r in all_episodes_rewards[-mean_reward_window:]])
+                best_running_mean = max(best_running_mean, mean_over_window)
+                if verbosity != Verbosity.Quiet:
+                    print(f"Episode {i_episode} (env {i}) {'ended' if done else 'stopped'}{' at a dead end' if info.get('dead_end') else ''} at t={t} "
+                          f"total_reward {sum(episodes_rewards[i])} with loss={learner.loss_as_string()}")
+                learner.end_of_episode(i_episode=i_episode, t=t)
+                learner.new_episode()
+
+                episodes_rewards[i] = []
+                episodes_availability[i] = []
+                observations[i] = wrapped_env.reset()
+
+    for wrapped_env in wrapped_envs:
+        wrapped_env.close()
+
+    return TrainedLearner(
+        all_episodes_rewards=all_episodes_rewards[:episode_count],
+        all_episodes_availability=all_episodes_availability[:episode_count],
+        learner=learner,
+        trained_on=cyberbattle_gym_envs[0].name,
+        title=f"{title} (epochs={episode_count}, envs={env_count}, ϵ={initial_epsilon}, ϵ_min={epsilon_minimum}," +
+              learner.parameters_as_string(),
+        best_running_mean=best_running_mean
+    )
+
+
 def transfer_learning_evaluation(
     environment_properties: EnvironmentBounds,
     trained_learner: TrainedLearner,
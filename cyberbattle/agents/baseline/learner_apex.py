@@ -0,0 +1,275 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Asynchronous actor-learner training of the Deep Q-learning agent (Ape-X style)
+
+A central learner process owns the replay memory and the optimizer of a
+`DeepQLearnerPolicy`. N actor processes each run their own CyberBattle gym
+environment with an epsilon-greedy copy of the policy network and stream
+the transitions they observe to the learner through a multiprocessing queue.
+The learner publishes its network weights to a shared memory buffer that the
+actors poll periodically. Everything runs on a single multi-core machine.
+
+Reference: Horgan et al., Distributed Prioritized Experience Replay, 2018.
+"""
+
+import multiprocessing
+import queue
+import random
+import sys
+from typing import Any, Dict, List, Optional
+
+import gym
+import numpy as np
+import torch
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
+
+from .agent_dql import DeepQLearnerPolicy
+from .agent_wrapper import AgentWrapper, EnvironmentBounds, ActionTrackingStateAugmentation
+from .learner import TrainedLearner, put_unless_stopped
+from cyberbattle.simulation.config import logger
+
+
+class SharedWeights:
+    """Network weights published by the learner to the actors through shared memory.
+
+    The weights are stored as one flat float32 vector together with a version
+    number incremented on every publication, so actors only copy them when
+    they changed."""
+
+    def __init__(self, ctx, network: torch.nn.Module):
+        size = sum(p.numel() for p in network.parameters())
+        self.buffer = ctx.RawArray('f', size)
+        self.version = ctx.Value('q', -1)
+        self.publish(network)
+
+    def publish(self, network: torch.nn.Module) -> None:
+        vector = parameters_to_vector(network.parameters()).detach().cpu().numpy()
+        with self.version.get_lock():
+            np.frombuffer(self.buffer, dtype=np.float32)[:] = vector
+            self.version.value += 1
+
+    def fetch(self, network: torch.nn.Module, known_version: int) -> int:
+        """Copy the weights to `network` if newer than `known_version`, return the version of the weights"""
+        with self.version.get_lock():
+            version = self.version.value
+            if version == known_version:
+                return version
+            vector = torch.from_numpy(np.frombuffer(self.buffer, dtype=np.float32).copy())
+        vector_to_parameters(vector.to(next(network.parameters()).device), network.parameters())
+        return version
+
+
+def actor_epsilon(actor_id: int, actor_count: int, epsilon: float, alpha: float) -> float:
+    """Fixed exploration rate of each actor: epsilon^(1 + alpha * i / (N - 1))"""
+    return epsilon ** (1 + alpha * actor_id / max(1, actor_count - 1))
+
+
+def _actor_process(actor_id: int,
+                   gym_id: str,
+                   env_kwargs: Dict[str, Any],
+                   environment_properties: EnvironmentBounds,
+                   epsilon: float,
+                   iteration_count: int,
+                   weights: SharedWeights,
+                   channel,
+                   stop,
+                   seed: int,
+                   send_every: int,
+                   weights_refresh_steps: int) -> None:
+    """Act epsilon-greedily in a private environment and stream the transitions to the learner"""
+    torch.manual_seed(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+
+    env = gym.make(gym_id, **env_kwargs)
+    policy = DeepQLearnerPolicy(environment_properties, gamma=0.0, replay_memory_size=1, target_update=1,
+                                batch_size=1, learning_rate=0.0, train_while_exploit=False)
+    version = weights.fetch(policy.policy_net, -1)
+    # act through the frozen inference engine
+    policy.eval()
+    assert policy.inference
+
+    wrapped_env = AgentWrapper(env, ActionTrackingStateAugmentation(environment_properties, env.reset()))
+    state_dim = len(policy.stateaction_model.state_space.dim_sizes)
+    states = np.zeros((send_every, state_dim), dtype=np.float32)
+    next_states = np.zeros((send_every, state_dim), dtype=np.float32)
+    actions = np.zeros(send_every, dtype=np.int64)
+    rewards = np.zeros(send_every, dtype=np.float32)
+    non_final = np.zeros(send_every, dtype=np.bool_)
+    pending = 0
+    steps_done = 0
+
+    while not stop.is_set():
+        observation = wrapped_env.reset()
+        all_rewards: List[float] = []
+        all_availability: List[float] = []
+
+        for _ in range(iteration_count):
+            if np.random.rand() <= epsilon:
+                _, gym_action, action_metadata = policy.explore(wrapped_env)
+            else:
+                _, gym_action, action_metadata = policy.exploit(wrapped_env, observation)
+                if not gym_action:
+                    _, gym_action, action_metadata = policy.explore(wrapped_env)
+
+            observation, reward, done, info = wrapped_env.step(gym_action)
+            next_actor_state = policy.next_actor_state(wrapped_env, done, action_metadata)
+
+            states[pending] = action_metadata.actor_state
+            actions[pending] = action_metadata.abstract_action
+            rewards[pending] = reward
+            non_final[pending] = next_actor_state is not None
+            if next_actor_state is not None:
+                next_states[pending] = next_actor_state
+            pending += 1
+            steps_done += 1
+
+            if pending == send_every:
+                put_unless_stopped(channel, ('transitions', states.copy(), actions.copy(), rewards.copy(), next_states.copy(), non_final.copy()), stop)
+                pending = 0
+
+            if steps_done % weights_refresh_steps == 0:
+                new_version = weights.fetch(policy.policy_net, version)
+                if new_version != version:
+                    version = new_version
+                    policy.inference.refresh(policy.policy_net)
+
+            all_rewards.append(reward)
+            all_availability.append(info['network_availability'])
+
+            if done or stop.is_set():
+                break
+
+        if pending:
+            put_unless_stopped(channel, ('transitions', states[:pending].copy(), actions[:pending].copy(), rewards[:pending].copy(),
+                                         next_states[:pending].copy(), non_final[:pending].copy()), stop)
+            pending = 0
+        put_unless_stopped(channel, ('episode', actor_id, all_rewards, all_availability), stop)
+
+    env.close()
+
+
+def apex_dql_search(
+    gym_id: str,
+    environment_properties: EnvironmentBounds,
+    learner: DeepQLearnerPolicy,
+    title: str,
+    episode_count: int,
+    iteration_count: int,
+    actor_count: int = 4,
+    epsilon: float = 0.4,
+    epsilon_alpha: float = 7.0,
+    env_kwargs: Optional[Dict[str, Any]] = None,
+    weights_publish_steps: int = 50,
+    weights_refresh_steps: int = 100,
+    send_every: int = 32,
+    queue_size: int = 256,
+    mean_reward_window: int = 10,
+    seed: int = 0,
+    start_method: str = 'spawn'
+) -> TrainedLearner:
+    """Train a Deep Q-learning agent with asynchronous actor processes
+
+    Parameters
+    ==========
+
+    - gym_id, env_kwargs -- the gym environment (and its `gym.make` arguments) each actor runs
+
+    - learner -- the DQL policy trained in this process, its optimization schedule
+    (`optimize_every`, `gradient_steps`, `target_update_steps`) applies to the transitions received from the actors
+
+    - episode_count -- total number of episodes to collect across all actors
+
+    - iteration_count -- maximum number of iterations in each episode
+
+    - actor_count -- number of actor processes
+
+    - epsilon, epsilon_alpha -- actor i explores with the fixed rate epsilon^(1 + epsilon_alpha * i / (actor_count - 1))
+
+    - weights_publish_steps -- the learner publishes its weights every this many gradient steps
+
+    - weights_refresh_steps -- actors check for new weights every this many environment steps
+
+    - send_every -- actors send their transitions in chunks of this size
+
+    - start_method -- multiprocessing start method of the actor processes
+    """
+    ctx = multiprocessing.get_context(start_method)
+    env_kwargs = env_kwargs or {}
+
+    weights = SharedWeights(ctx, learner.policy_net)
+    channel = ctx.Queue(maxsize=queue_size)
+    stop = ctx.Event()
+    actors = [
+        ctx.Process(target=_actor_process,
+                    args=(i, gym_id, env_kwargs, environment_properties,
+                          actor_epsilon(i, actor_count, epsilon, epsilon_alpha),
+                          iteration_count, weights, channel, stop, seed + i, send_every, weights_refresh_steps),
+                    daemon=True)
+        for i in range(actor_count)]
+
+    print(f"###### {title}\n"
+          f"Learning with {actor_count} actors: episode_count={episode_count},"
+          f"iteration_count={iteration_count},"
+          f"ϵ={epsilon},"
+          f"ϵ_alpha={epsilon_alpha},"
+          f"{learner.parameters_as_string()}")
+
+    all_episodes_rewards: List[List[float]] = []
+    all_episodes_availability: List[List[float]] = []
+    best_running_mean = -sys.float_info.max
+    published_at = learner.gradient_steps_done
+    transitions_received = 0
+
+    for actor in actors:
+        actor.start()
+    try:
+        while len(all_episodes_rewards) < episode_count:
+            try:
+                message = channel.get(timeout=1.0)
+            except queue.Empty:
+                if not any(actor.is_alive() for actor in actors):
+                    raise RuntimeError('all the actor processes exited')
+                continue
+
+            if message[0] == 'transitions':
+                _, states, actions, rewards, next_states, non_final = message
+                for state, action, reward, next_state, is_non_final in zip(states, actions, rewards, next_states, non_final):
+                    learner.update_q_function(float(reward), actor_state=state, abstract_action=action,
+                                              next_actor_state=next_state if is_non_final else None)
+                transitions_received += len(rewards)
+                if learner.gradient_steps_done - published_at >= weights_publish_steps:
+                    weights.publish(learner.policy_net)
+                    published_at = learner.gradient_steps_done
+            else:
+                _, actor_id, episode_rewards, episode_availability = message
+                all_episodes_rewards.append(episode_rewards)
+                all_episodes_availability.append(episode_availability)
+                i_episode = len(all_episodes_rewards)
+                learner.end_of_episode(i_episode=i_episode, t=len(episode_rewards))
+
+                mean_over_window = np.mean([sum(r) for r in all_episodes_rewards[-mean_reward_window:]])
+                best_running_mean = max(best_running_mean, mean_over_window)
+                logger.info(f"Episode {i_episode}/{episode_count} from actor {actor_id}: total_reward {sum(episode_rewards)} "
+                            f"steps {len(episode_rewards)}, transitions received {transitions_received}, "
+                            f"gradient steps {learner.gradient_steps_done}, loss={learner.loss_as_string()}")
+    finally:
+        stop.set()
+        # unblock actors waiting on the queue before joining them
+        while any(actor.is_alive() for actor in actors):
+            try:
+                channel.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for actor in actors:
+            actor.join()
+
+    return TrainedLearner(
+        all_episodes_rewards=all_episodes_rewards,
+        all_episodes_availability=all_episodes_availability,
+        learner=learner,
+        trained_on=gym_id,
+        title=title,
+        best_running_mean=best_running_mean
+    )
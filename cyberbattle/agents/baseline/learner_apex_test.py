@@ -0,0 +1,51 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Test the asynchronous actor-learner helpers"""
+
+import multiprocessing
+
+import torch
+
+from cyberbattle.agents.baseline.agent_dql import DeepQLearnerPolicy
+from cyberbattle.agents.baseline.learner_apex import SharedWeights, actor_epsilon, apex_dql_search
+
+
+def test_shared_weights_versioning() -> None:
+    """Weights are only copied to the actor network when a new version was published"""
+    ctx = multiprocessing.get_context('spawn')
+    learner_net = torch.nn.Linear(3, 2)
+    actor_net = torch.nn.Linear(3, 2)
+    weights = SharedWeights(ctx, learner_net)
+
+    version = weights.fetch(actor_net, -1)
+    assert torch.equal(actor_net.weight, learner_net.weight)
+
+    with torch.no_grad():
+        learner_net.weight += 1.0
+        actor_net.weight.zero_()
+    assert weights.fetch(actor_net, version) == version
+    assert not actor_net.weight.any()
+
+    weights.publish(learner_net)
+    assert weights.fetch(actor_net, version) == version + 1
+    assert torch.equal(actor_net.weight, learner_net.weight)
+
+
+def test_actor_epsilon() -> None:
+    assert actor_epsilon(0, 4, 0.4, 7.0) == 0.4
+    assert actor_epsilon(3, 4, 0.4, 7.0) == 0.4 ** 8
+    assert actor_epsilon(0, 1, 0.4, 7.0) == 0.4
+
+
+def test_apex_dql_search(tinymicro_bounds) -> None:
+    """The learner trains on the actors' transitions and the actors are shut down at the end"""
+    ep = tinymicro_bounds
+    learner = DeepQLearnerPolicy(ep, gamma=0.5, replay_memory_size=1000, target_update=5, batch_size=4, learning_rate=0.01)
+    trained = apex_dql_search('CyberBattleTinyMicro-v1234', ep, learner, 'apex',
+                              episode_count=4, iteration_count=10, actor_count=2,
+                              env_kwargs={'env_bounds': ep}, weights_publish_steps=1, send_every=4)
+    assert len(trained['all_episodes_rewards']) == 4
+    assert all(0 < len(rewards) <= 10 for rewards in trained['all_episodes_rewards'])
+    assert learner.gradient_steps_done > 0
+    assert multiprocessing.active_children() == []
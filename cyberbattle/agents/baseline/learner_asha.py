@@ -0,0 +1,259 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Hyperparameter search for the Deep Q-learning agent with successive halving (ASHA)
+
+Each trial (one hyperparameter configuration) is trained with
+`epsilon_greedy_search` for a small budget of episodes, evaluated with
+`evaluate_model`, and checkpointed with `DeepQLearnerPolicy.save`. The rungs
+have budgets of `min_episodes`, `min_episodes * reduction_factor`, ... up to
+`max_episodes` training episodes. Whenever a worker process is free, a trial
+ranked in the top 1/`reduction_factor` of the trials evaluated at its rung is
+promoted to the next rung and resumes training from its checkpoint; if no
+trial can be promoted a new configuration is started at the bottom rung.
+Losing configurations therefore stop after a fraction of the full budget.
+
+Trials resume with the network and optimizer state of their checkpoint and
+the epsilon reached so far, but with an empty replay memory.
+
+Reference: Li et al., A System for Massively Parallel Hyperparameter Tuning, 2020.
+"""
+
+import concurrent.futures
+import contextlib
+import math
+import multiprocessing
+import os
+import random
+import sys
+from typing import Any, Dict, List, Optional, Tuple, TypedDict
+
+import gym
+import numpy as np
+
+from .agent_dql import DeepQLearnerPolicy
+from .agent_wrapper import EnvironmentBounds, Verbosity
+from .learner import epsilon_greedy_search, evaluate_model
+from cyberbattle.simulation.config import configuration, logger
+
+# keys of a configuration passed to `epsilon_greedy_search`, all other keys are `DeepQLearnerPolicy` arguments
+SEARCH_PARAMETERS = ['epsilon', 'epsilon_minimum', 'epsilon_exponential_decay']
+
+DEFAULT_PARAMETERS: Dict[str, Any] = {
+    'epsilon': 0.9,
+    'epsilon_minimum': 0.1,
+    'epsilon_exponential_decay': None,
+    'replay_memory_size': 10000,
+    'target_update': 5,
+    'batch_size': 512,
+}
+
+Trial = TypedDict('Trial', {
+    'trial_id': int,
+    'parameters': Dict[str, Any],
+    # highest rung evaluated so far, its training budget and the evaluation score at each rung
+    'rung': int,
+    'episodes': int,
+    'scores': List[float],
+    # state to resume training from
+    'checkpoint': str,
+    'steps_done': int,
+    'epsilon': float
+})
+
+
+def rung_budgets(min_episodes: int, max_episodes: int, reduction_factor: int) -> List[int]:
+    """Cumulative number of training episodes of each rung"""
+    budgets = [min_episodes]
+    while budgets[-1] * reduction_factor <= max_episodes:
+        budgets.append(budgets[-1] * reduction_factor)
+    return budgets
+
+
+def sample_configurations(space: Dict[str, List[Any]], count: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """Draw configurations uniformly at random from the candidate values of each parameter"""
+    generator = random.Random(seed)
+    return [{name: generator.choice(values) for name, values in space.items()} for _ in range(count)]
+
+
+def train_trial(gym_id: str,
+                env_kwargs: Dict[str, Any],
+                environment_properties: EnvironmentBounds,
+                title: str,
+                parameters: Dict[str, Any],
+                resume_from: str,
+                epsilon: float,
+                episodes: int,
+                iteration_count: int,
+                eval_episode_count: int,
+                checkpoint: str,
+                seed: int) -> Tuple[float, int, float]:
+    """Train a Deep Q-learning configuration for a budget of episodes, evaluate it and checkpoint it.
+    Used by the worker processes of `successive_halving_search` and `population_based_training`.
+
+    Parameters
+    ==========
+
+    - gym_id, env_kwargs -- the gym environment (and its `gym.make` arguments) to train on
+
+    - parameters -- the configuration, see `successive_halving_search`
+
+    - resume_from -- checkpoint to resume training from, if not empty
+
+    - epsilon -- exploration rate to resume from
+
+    - episodes, iteration_count -- number of training episodes and maximum number of iterations in each of them
+
+    - eval_episode_count -- number of greedy evaluation episodes scoring the configuration
+
+    - checkpoint -- where to save the trained network and optimizer state
+
+    Returns the evaluation score, the number of training steps and the epsilon reached.
+    """
+    configuration.log_results = False
+    parameters = {**DEFAULT_PARAMETERS, **parameters}
+    search_parameters = {name: parameters.pop(name) for name in SEARCH_PARAMETERS}
+    env = gym.make(gym_id, **env_kwargs)
+    learner = DeepQLearnerPolicy(environment_properties, **parameters)
+    if resume_from:
+        learner.load(resume_from)
+        learner.train()
+        # the checkpointed optimizer state comes with the learning rate it was saved with
+        for group in learner.optimizer.param_groups:
+            group['lr'] = learner.learning_rate
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        trained = epsilon_greedy_search(
+            env, environment_properties, learner, title=title,
+            episode_count=episodes, iteration_count=iteration_count,
+            epsilon=epsilon,
+            epsilon_minimum=search_parameters['epsilon_minimum'],
+            epsilon_exponential_decay=search_parameters['epsilon_exponential_decay'],
+            eval_freq=sys.maxsize, seed=seed, verbosity=Verbosity.Quiet, plot_episodes_length=False)
+        evaluation = evaluate_model(
+            env, environment_properties, learner, title=title,
+            iteration_count=iteration_count, epsilon=0.0, eval_episode_count=eval_episode_count,
+            best_eval_running_mean=-sys.float_info.max, render=False, verbosity=Verbosity.Quiet)
+    learner.save(checkpoint, optimizer_save=True)
+    env.close()
+
+    steps = sum(len(rewards) for rewards in trained['all_episodes_rewards'])
+    if search_parameters['epsilon_exponential_decay']:
+        # the exponential decay of `epsilon_greedy_search` resumes exactly from the epsilon reached
+        epsilon = search_parameters['epsilon_minimum'] + \
+            math.exp(-5. * steps / (search_parameters['epsilon_exponential_decay'] * iteration_count)) * \
+            (epsilon - search_parameters['epsilon_minimum'])
+    score = float(np.mean([sum(rewards) for rewards in evaluation['all_episodes_rewards']]))
+    return score, steps, epsilon
+
+
+def successive_halving_search(
+    gym_id: str,
+    environment_properties: EnvironmentBounds,
+    configurations: List[Dict[str, Any]],
+    checkpoint_dir: str,
+    iteration_count: int,
+    min_episodes: int,
+    max_episodes: int,
+    reduction_factor: int = 3,
+    eval_episode_count: int = 5,
+    worker_count: int = 4,
+    env_kwargs: Optional[Dict[str, Any]] = None,
+    seed: int = 0,
+    start_method: str = 'spawn'
+) -> List[Trial]:
+    """Search the best configuration of a Deep Q-learning agent with asynchronous successive halving
+
+    Parameters
+    ==========
+
+    - gym_id, env_kwargs -- the gym environment (and its `gym.make` arguments) to train on
+
+    - configurations -- the candidate configurations: `gamma` and `learning_rate` are required,
+    `epsilon`, `epsilon_minimum` and `epsilon_exponential_decay` configure the epsilon greedy search,
+    any other key is passed to `DeepQLearnerPolicy` (see `DEFAULT_PARAMETERS` for the defaults)
+
+    - checkpoint_dir -- directory of the checkpoint of each trial at each rung
+
+    - iteration_count -- maximum number of iterations in each episode
+
+    - min_episodes, max_episodes, reduction_factor -- training budget of the first and last rungs,
+    a trial is promoted if it ranks in the top 1/reduction_factor of its rung
+
+    - eval_episode_count -- number of greedy evaluation episodes scoring a trial at each rung
+
+    - worker_count -- number of trials trained at the same time
+
+    Returns the trials, best first (highest rung reached, then best score at that rung).
+    """
+    budgets = rung_budgets(min_episodes, max_episodes, reduction_factor)
+    env_kwargs = env_kwargs or {}
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    trials: List[Trial] = []
+    # the trials evaluated at each rung, and those of them already promoted to the next one
+    evaluated: List[List[Trial]] = [[] for _ in budgets]
+    promoted: List[set] = [set() for _ in budgets]
+    next_configuration = 0
+
+    def next_job() -> Optional[Tuple[Trial, int]]:
+        nonlocal next_configuration
+        for rung in reversed(range(len(budgets) - 1)):
+            ranked = sorted(evaluated[rung], key=lambda t: t['scores'][rung], reverse=True)
+            for trial in ranked[:len(ranked) // reduction_factor]:
+                if trial['trial_id'] not in promoted[rung]:
+                    promoted[rung].add(trial['trial_id'])
+                    return trial, rung + 1
+        if next_configuration < len(configurations):
+            parameters = configurations[next_configuration]
+            trial = Trial(trial_id=next_configuration, parameters=parameters, rung=-1, episodes=0, scores=[],
+                          checkpoint='', steps_done=0,
+                          epsilon=parameters.get('epsilon', DEFAULT_PARAMETERS['epsilon']))
+            trials.append(trial)
+            next_configuration += 1
+            return trial, 0
+        return None
+
+    print(f"###### Successive halving over {len(configurations)} configurations, "
+          f"rung budgets {budgets} episodes, {worker_count} workers")
+
+    ctx = multiprocessing.get_context(start_method)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=worker_count, mp_context=ctx) as executor:
+        running: Dict[concurrent.futures.Future, Tuple[Trial, int]] = {}
+        while True:
+            while len(running) < worker_count:
+                job = next_job()
+                if job is None:
+                    break
+                trial, rung = job
+                episodes = budgets[rung] - trial['episodes']
+                checkpoint = os.path.join(checkpoint_dir, f"trial{trial['trial_id']}_rung{rung}.tar")
+                future = executor.submit(train_trial, gym_id, env_kwargs, environment_properties,
+                                         f"trial {trial['trial_id']}", trial['parameters'], trial['checkpoint'],
+                                         trial['epsilon'], episodes, iteration_count, eval_episode_count, checkpoint,
+                                         seed + 1000 * trial['trial_id'] + rung)
+                running[future] = (trial, rung)
+            if not running:
+                break
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                trial, rung = running.pop(future)
+                score, steps, epsilon = future.result()
+                trial['scores'].append(score)
+                trial['rung'] = rung
+                trial['episodes'] = budgets[rung]
+                trial['checkpoint'] = os.path.join(checkpoint_dir, f"trial{trial['trial_id']}_rung{rung}.tar")
+                trial['steps_done'] += steps
+                trial['epsilon'] = epsilon
+                evaluated[rung].append(trial)
+                logger.info(f"Trial {trial['trial_id']} rung {rung} ({budgets[rung]} episodes): "
+                            f"eval mean reward {score:.2f} {trial['parameters']}")
+
+    ranked_trials = sorted(trials, key=lambda t: (t['rung'], t['scores'][-1]), reverse=True)
+    best = ranked_trials[0]
+    training_spent = sum(t['episodes'] for t in trials)
+    print(f"Best configuration {best['parameters']}: eval mean reward {best['scores'][-1]:.2f} "
+          f"after {best['episodes']} episodes ({training_spent} training episodes in total, "
+          f"{len(configurations) * budgets[-1]} without early stopping)")
+    return ranked_trials
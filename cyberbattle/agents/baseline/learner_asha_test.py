@@ -0,0 +1,31 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Test the successive halving hyperparameter search"""
+
+import os
+
+from cyberbattle.agents.baseline.learner_asha import rung_budgets, sample_configurations, successive_halving_search
+
+
+def test_rung_budgets() -> None:
+    assert rung_budgets(10, 100, 3) == [10, 30, 90]
+    assert rung_budgets(10, 90, 3) == [10, 30, 90]
+    assert rung_budgets(5, 5, 2) == [5]
+
+
+def test_successive_halving_search(tmp_path, tinymicro_bounds) -> None:
+    """Only the best trial of the first rung is trained further, from its checkpoint"""
+    ep = tinymicro_bounds
+    configurations = sample_configurations({'gamma': [0.015, 0.5], 'learning_rate': [0.01, 0.001],
+                                            'batch_size': [4], 'epsilon_exponential_decay': [10]}, count=3)
+    trials = successive_halving_search('CyberBattleTinyMicro-v1234', ep, configurations, str(tmp_path),
+                                       iteration_count=10, min_episodes=1, max_episodes=3, reduction_factor=3,
+                                       eval_episode_count=1, worker_count=2, env_kwargs={'env_bounds': ep})
+
+    assert [trial['rung'] for trial in trials] == [1, 0, 0]
+    best = trials[0]
+    assert best['scores'][0] == max(trial['scores'][0] for trial in trials)
+    assert best['episodes'] == 3 and len(best['scores']) == 2
+    assert best['epsilon'] < 0.9
+    assert os.path.exists(best['checkpoint']) and best['checkpoint'].endswith('rung1.tar')
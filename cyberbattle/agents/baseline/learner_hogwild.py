@@ -0,0 +1,240 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Lock-free parallel training of the tabular Q-learning agent (Hogwild! style)
+
+The two Q matrices of a `QTabularLearner` are moved to shared memory and N
+worker processes, each running its own CyberBattle gym environment, apply
+their Q-learning updates to them concurrently without any locking. Updates
+touch a single cell of a large and sparsely visited matrix, so conflicting
+writes are rare and harmless.
+
+Workers index the matrices with the feature encodings of their own process:
+this relies on `HashEncoding` hashing feature vectors with
+`hash_feature_vectors`, which unlike the builtin `hash()` gives the same
+state indices in every process.
+
+Reference: Niu et al., Hogwild!: A Lock-Free Approach to Parallelizing
+Stochastic Gradient Descent, 2011.
+"""
+
+import math
+import multiprocessing
+import queue
+import random
+import sys
+from typing import Any, Dict, List, Optional
+
+import gym
+import numpy as np
+
+from .agent_tabularqlearning import QMatrix, QTabularLearner
+from .agent_wrapper import AgentWrapper, EnvironmentBounds, ActionTrackingStateAugmentation
+from .learner import TrainedLearner, put_unless_stopped
+from cyberbattle.simulation.config import logger
+
+
+def share_qmatrix(ctx, qmatrix: QMatrix):
+    """Move the values of a dense Q matrix to shared memory and return the shared buffer.
+    The matrix keeps working on a view of the buffer."""
+    assert not qmatrix.sparse, 'sparse Q matrices cannot be shared between processes'
+    buffer = ctx.RawArray('d', int(qmatrix.statedim * qmatrix.actiondim))
+    attach_qmatrix(qmatrix, buffer)
+    return buffer
+
+
+def attach_qmatrix(qmatrix: QMatrix, buffer) -> np.ndarray:
+    """Make a Q matrix work on a shared buffer, copying its current values to it"""
+    shared = np.frombuffer(buffer, dtype=np.float64).reshape(qmatrix.shape())
+    shared[:] = qmatrix.qm
+    qmatrix.qm = shared
+    return shared
+
+
+def save_qmatrices(learner: QTabularLearner, filename: str) -> None:
+    """Save a copy of the Q matrices of a tabular learner"""
+    np.savez(filename, qsource=np.asarray(learner.qsource.qm), qattack=np.asarray(learner.qattack.qm))
+
+
+def _worker_process(worker_id: int,
+                    gym_id: str,
+                    env_kwargs: Dict[str, Any],
+                    environment_properties: EnvironmentBounds,
+                    gamma: float,
+                    learning_rate: float,
+                    exploit_percentile: float,
+                    qsource_buffer,
+                    qattack_buffer,
+                    epsilon: float,
+                    epsilon_minimum: float,
+                    epsilon_exponential_decay: Optional[int],
+                    iteration_count: int,
+                    channel,
+                    stop,
+                    seed: int) -> None:
+    """Train epsilon-greedily in a private environment, updating the shared Q matrices in place"""
+    random.seed(seed)
+    np.random.seed(seed)
+
+    env = gym.make(gym_id, **env_kwargs)
+    learner = QTabularLearner(environment_properties, gamma=gamma, learning_rate=learning_rate,
+                              exploit_percentile=exploit_percentile, seed=seed)
+    learner.qsource.qm = np.frombuffer(qsource_buffer, dtype=np.float64).reshape(learner.qsource.shape())
+    learner.qattack.qm = np.frombuffer(qattack_buffer, dtype=np.float64).reshape(learner.qattack.shape())
+
+    wrapped_env = AgentWrapper(env, ActionTrackingStateAugmentation(environment_properties, env.reset()))
+    steps_done = 0
+    current_epsilon = epsilon
+
+    while not stop.is_set():
+        observation = wrapped_env.reset()
+        learner.new_episode()
+        all_rewards: List[float] = []
+        all_availability: List[float] = []
+
+        if epsilon_exponential_decay:
+            current_epsilon = epsilon_minimum + math.exp(-5. * steps_done / (epsilon_exponential_decay * iteration_count)) * \
+                (epsilon - epsilon_minimum)
+
+        for t in range(1, 1 + iteration_count):
+            steps_done += 1
+            if np.random.rand() <= current_epsilon:
+                _, gym_action, action_metadata = learner.explore(wrapped_env)
+            else:
+                _, gym_action, action_metadata = learner.exploit(wrapped_env, observation)
+                if not gym_action:
+                    _, gym_action, action_metadata = learner.explore(wrapped_env)
+
+            observation, reward, done, info = wrapped_env.step(gym_action)
+            learner.on_step(wrapped_env, observation, reward, done, info, action_metadata)
+            learner.end_of_iteration(t, done)
+
+            all_rewards.append(reward)
+            all_availability.append(info['network_availability'])
+            if done or stop.is_set():
+                break
+
+        put_unless_stopped(channel, ('episode', worker_id, all_rewards, all_availability,
+                                     learner.loss_qsource.current_episode_loss(), learner.loss_qattack.current_episode_loss()), stop)
+
+    env.close()
+
+
+def hogwild_tabular_search(
+    gym_id: str,
+    environment_properties: EnvironmentBounds,
+    learner: QTabularLearner,
+    title: str,
+    episode_count: int,
+    iteration_count: int,
+    worker_count: int = 4,
+    epsilon: float = 0.9,
+    epsilon_minimum: float = 0.01,
+    epsilon_exponential_decay: Optional[int] = None,
+    env_kwargs: Optional[Dict[str, Any]] = None,
+    snapshot_episodes: Optional[int] = None,
+    snapshot_filename: Optional[str] = None,
+    queue_size: int = 64,
+    mean_reward_window: int = 10,
+    seed: int = 0,
+    start_method: str = 'spawn'
+) -> TrainedLearner:
+    """Train a tabular Q-learning agent with worker processes updating shared Q matrices
+
+    Parameters
+    ==========
+
+    - gym_id, env_kwargs -- the gym environment (and its `gym.make` arguments) each worker runs
+
+    - learner -- the dense tabular learner to train, its Q matrices are moved to shared memory
+    and keep their values (e.g. from a pretrained learner)
+
+    - episode_count -- total number of episodes to collect across all workers
+
+    - iteration_count -- maximum number of iterations in each episode
+
+    - worker_count -- number of worker processes
+
+    - epsilon, epsilon_minimum, epsilon_exponential_decay -- exploration rate of each worker,
+    decayed with the worker's own step count as in `epsilon_greedy_search`
+
+    - snapshot_episodes, snapshot_filename -- save a copy of the Q matrices every this many episodes,
+    to `snapshot_filename` (.npz) suffixed with the episode number
+
+    - start_method -- multiprocessing start method of the worker processes
+    """
+    ctx = multiprocessing.get_context(start_method)
+    env_kwargs = env_kwargs or {}
+
+    qsource_buffer = share_qmatrix(ctx, learner.qsource)
+    qattack_buffer = share_qmatrix(ctx, learner.qattack)
+    channel = ctx.Queue(maxsize=queue_size)
+    stop = ctx.Event()
+    workers = [
+        ctx.Process(target=_worker_process,
+                    args=(i, gym_id, env_kwargs, environment_properties,
+                          learner.gamma, learner.learning_rate, learner.exploit_percentile,
+                          qsource_buffer, qattack_buffer,
+                          epsilon, epsilon_minimum, epsilon_exponential_decay,
+                          iteration_count, channel, stop, seed + i),
+                    daemon=True)
+        for i in range(worker_count)]
+
+    print(f"###### {title}\n"
+          f"Learning with {worker_count} workers: episode_count={episode_count},"
+          f"iteration_count={iteration_count},"
+          f"ϵ={epsilon},"
+          f"ϵ_min={epsilon_minimum}, " +
+          (f"ϵ_expdecay={epsilon_exponential_decay}," if epsilon_exponential_decay else '') +
+          f"{learner.parameters_as_string()}")
+
+    all_episodes_rewards: List[List[float]] = []
+    all_episodes_availability: List[List[float]] = []
+    best_running_mean = -sys.float_info.max
+
+    for worker in workers:
+        worker.start()
+    try:
+        while len(all_episodes_rewards) < episode_count:
+            try:
+                _, worker_id, episode_rewards, episode_availability, loss_qsource, loss_qattack = channel.get(timeout=1.0)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError('all the worker processes exited')
+                continue
+
+            all_episodes_rewards.append(episode_rewards)
+            all_episodes_availability.append(episode_availability)
+            learner.loss_qsource.all_episodes.append(loss_qsource)
+            learner.loss_qattack.all_episodes.append(loss_qattack)
+            i_episode = len(all_episodes_rewards)
+
+            mean_over_window = np.mean([sum(r) for r in all_episodes_rewards[-mean_reward_window:]])
+            best_running_mean = max(best_running_mean, mean_over_window)
+            logger.info(f"Episode {i_episode}/{episode_count} from worker {worker_id}: total_reward {sum(episode_rewards)} "
+                        f"steps {len(episode_rewards)}, loss_source={loss_qsource:0.3f} loss_attack={loss_qattack:0.3f}")
+
+            if snapshot_filename and snapshot_episodes and not i_episode % snapshot_episodes:
+                save_qmatrices(learner, snapshot_filename.replace('.npz', f'_e{i_episode}.npz'))
+    finally:
+        stop.set()
+        # unblock workers waiting on the queue before joining them
+        while any(worker.is_alive() for worker in workers):
+            try:
+                channel.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for worker in workers:
+            worker.join()
+
+    if snapshot_filename:
+        save_qmatrices(learner, snapshot_filename)
+
+    return TrainedLearner(
+        all_episodes_rewards=all_episodes_rewards,
+        all_episodes_availability=all_episodes_availability,
+        learner=learner,
+        trained_on=gym_id,
+        title=title,
+        best_running_mean=best_running_mean
+    )
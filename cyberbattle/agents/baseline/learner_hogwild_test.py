@@ -0,0 +1,36 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Test the parallel tabular Q-learning over shared Q matrices"""
+
+import multiprocessing
+
+import numpy as np
+
+from cyberbattle.agents.baseline.agent_tabularqlearning import QTabularLearner
+from cyberbattle.agents.baseline.learner_hogwild import hogwild_tabular_search, share_qmatrix
+
+
+def test_share_qmatrix_keeps_values(tinymicro_bounds) -> None:
+    learner = QTabularLearner(tinymicro_bounds, gamma=0.0, learning_rate=0.0, exploit_percentile=100)
+    learner.qattack.qm[3, 1] = 2.5
+    buffer = share_qmatrix(multiprocessing.get_context('spawn'), learner.qattack)
+    assert learner.qattack.qm[3, 1] == 2.5
+    learner.qattack.update(4, 0, 4, reward=1.0, gamma=0.0, learning_rate=1.0)
+    assert np.frombuffer(buffer, dtype=np.float64)[4 * learner.qattack.actiondim] == 1.0
+
+
+def test_hogwild_tabular_search(tmp_path, tinymicro_bounds) -> None:
+    """Workers' updates land in the learner's Q matrices"""
+    ep = tinymicro_bounds
+    learner = QTabularLearner(ep, gamma=0.015, learning_rate=0.1, exploit_percentile=100)
+    snapshot = str(tmp_path / 'q.npz')
+    trained = hogwild_tabular_search('CyberBattleTinyMicro-v1234', ep, learner, 'hogwild',
+                                     episode_count=4, iteration_count=10, worker_count=2,
+                                     env_kwargs={'env_bounds': ep}, snapshot_episodes=2, snapshot_filename=snapshot)
+    assert len(trained['all_episodes_rewards']) == 4
+    assert len(learner.loss_qsource.all_episodes) == 4
+    assert np.any(learner.qsource.qm) and np.any(learner.qattack.qm)
+    saved = np.load(snapshot)
+    np.testing.assert_array_equal(saved['qattack'], learner.qattack.qm)
+    assert (tmp_path / 'q_e2.npz').exists()
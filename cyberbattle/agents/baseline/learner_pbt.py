@@ -0,0 +1,172 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Population-based training of Deep Q-learning agents (PBT)
+
+A population of `DeepQLearnerPolicy` members is trained in parallel worker
+processes, in generations of `interval_episodes` training episodes followed
+by a greedy evaluation. After each generation the members in the bottom
+`truncation` fraction of their environment exploit a member of the top
+fraction: they resume from its checkpoint (network weights and optimizer
+state, saved with `DeepQLearnerPolicy.save`) and epsilon, and explore by
+perturbing its gamma, learning rate and exploration schedule (the epsilon
+resumed from, the minimum epsilon and the epsilon decay if one is set: without
+decay epsilon stays constant, so perturbing epsilon itself is what explores
+the schedule).
+
+The population can be spread over several environments (e.g. the honeytoken
+versions of CyberBattleTinyMicro), members are only compared with and copied
+from the members training on the same environment.
+
+Reference: Jaderberg et al., Population Based Training of Neural Networks, 2017.
+"""
+
+import concurrent.futures
+import math
+import multiprocessing
+import os
+import random
+from typing import Any, Dict, List, Optional, Tuple, TypedDict
+
+from .agent_wrapper import EnvironmentBounds
+from .learner_asha import DEFAULT_PARAMETERS, train_trial
+from cyberbattle.simulation.config import logger
+
+# hyperparameters perturbed when a member exploits a peer
+PERTURBED_PARAMETERS = ['gamma', 'learning_rate', 'epsilon', 'epsilon_minimum', 'epsilon_exponential_decay']
+
+Member = TypedDict('Member', {
+    'member_id': int,
+    'gym_id': str,
+    'parameters': Dict[str, Any],
+    # evaluation score after each generation
+    'scores': List[float],
+    # state to resume training from
+    'checkpoint': str,
+    'steps_done': int,
+    'epsilon': float,
+    # (generation, member copied from) every time the member exploited a peer
+    'exploited': List[Tuple[int, int]]
+})
+
+
+def perturb(parameters: Dict[str, Any], factors: Tuple[float, ...], generator: random.Random) -> Dict[str, Any]:
+    """Copy of the parameters with each perturbed hyperparameter multiplied by one of `factors`,
+    epsilon being kept between the minimum epsilon and 1"""
+    perturbed = dict(parameters)
+    for name in PERTURBED_PARAMETERS:
+        if perturbed.get(name):
+            perturbed[name] = perturbed[name] * generator.choice(factors)
+    if 'gamma' in perturbed:
+        perturbed['gamma'] = min(perturbed['gamma'], 0.999)
+    if 'epsilon_minimum' in perturbed:
+        perturbed['epsilon_minimum'] = min(perturbed['epsilon_minimum'], 1.0)
+    if 'epsilon' in perturbed:
+        perturbed['epsilon'] = min(max(perturbed['epsilon'], perturbed.get('epsilon_minimum', 0.0)), 1.0)
+    if perturbed.get('epsilon_exponential_decay'):
+        perturbed['epsilon_exponential_decay'] = max(1, round(perturbed['epsilon_exponential_decay']))
+    return perturbed
+
+
+def population_based_training(
+    gym_ids: List[str],
+    environment_properties: EnvironmentBounds,
+    configurations: List[Dict[str, Any]],
+    checkpoint_dir: str,
+    iteration_count: int,
+    generation_count: int,
+    interval_episodes: int,
+    eval_episode_count: int = 5,
+    truncation: float = 0.25,
+    perturbation_factors: Tuple[float, ...] = (0.8, 1.2),
+    worker_count: Optional[int] = None,
+    env_kwargs: Optional[Dict[str, Any]] = None,
+    seed: int = 0,
+    start_method: str = 'spawn'
+) -> List[Member]:
+    """Train a population of Deep Q-learning agents with population-based training
+
+    Parameters
+    ==========
+
+    - gym_ids, env_kwargs -- the gym environments (and their `gym.make` arguments), members are
+    assigned to them in turn; all must fit `environment_properties`
+
+    - configurations -- the initial configuration of each member, with the same keys as the
+    configurations of `successive_halving_search`
+
+    - checkpoint_dir -- directory of the checkpoint of each member after each generation
+
+    - iteration_count -- maximum number of iterations in each episode
+
+    - generation_count, interval_episodes -- number of generations and training episodes in each of them
+
+    - eval_episode_count -- number of greedy evaluation episodes scoring a member after each generation
+
+    - truncation -- fraction of the members of an environment replaced by a better peer after each generation
+
+    - perturbation_factors -- the perturbed hyperparameters of a member exploiting a peer are the peer's
+    multiplied by one of these factors
+
+    - worker_count -- number of members trained at the same time (default: the population size)
+
+    Returns the members, best first (by score after the last generation).
+    """
+    env_kwargs = env_kwargs or {}
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    generator = random.Random(seed)
+
+    members = [Member(member_id=i, gym_id=gym_ids[i % len(gym_ids)], parameters=dict(parameters), scores=[],
+                      checkpoint='', steps_done=0,
+                      epsilon=parameters.get('epsilon', DEFAULT_PARAMETERS['epsilon']), exploited=[])
+               for i, parameters in enumerate(configurations)]
+
+    print(f"###### Population based training of {len(members)} members on {gym_ids}, "
+          f"{generation_count} generations of {interval_episodes} episodes")
+
+    ctx = multiprocessing.get_context(start_method)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=worker_count or len(members), mp_context=ctx) as executor:
+        for generation in range(generation_count):
+            futures = {}
+            for member in members:
+                checkpoint = os.path.join(checkpoint_dir, f"member{member['member_id']}_gen{generation}.tar")
+                futures[executor.submit(train_trial, member['gym_id'], env_kwargs, environment_properties,
+                                        f"member {member['member_id']}", member['parameters'], member['checkpoint'],
+                                        member['epsilon'], interval_episodes, iteration_count, eval_episode_count,
+                                        checkpoint, seed + 1000 * member['member_id'] + generation)] = (member, checkpoint)
+
+            for future in concurrent.futures.as_completed(futures):
+                member, checkpoint = futures[future]
+                score, steps, epsilon = future.result()
+                member['scores'].append(score)
+                member['checkpoint'] = checkpoint
+                member['steps_done'] += steps
+                member['epsilon'] = epsilon
+
+            if generation == generation_count - 1:
+                break
+
+            for gym_id in gym_ids:
+                ranked = sorted([m for m in members if m['gym_id'] == gym_id], key=lambda m: m['scores'][-1], reverse=True)
+                replaced_count = min(math.ceil(len(ranked) * truncation), len(ranked) // 2)
+                if not replaced_count:
+                    continue
+                for member in ranked[-replaced_count:]:
+                    peer = generator.choice(ranked[:replaced_count])
+                    # resume from the epsilon reached by the peer, perturbed with the rest of the schedule
+                    member['parameters'] = perturb(dict(peer['parameters'], epsilon=peer['epsilon']), perturbation_factors, generator)
+                    member['checkpoint'] = peer['checkpoint']
+                    member['steps_done'] = peer['steps_done']
+                    member['epsilon'] = member['parameters']['epsilon']
+                    member['exploited'].append((generation, peer['member_id']))
+                    logger.info(f"Generation {generation} on {gym_id}: member {member['member_id']} "
+                                f"({member['scores'][-1]:.2f}) exploits member {peer['member_id']} "
+                                f"({peer['scores'][-1]:.2f}), new parameters {member['parameters']}")
+
+            print(f"Generation {generation}: " +
+                  ', '.join(f"{m['member_id']}={m['scores'][-1]:.1f}" for m in members))
+
+    ranked_members = sorted(members, key=lambda m: m['scores'][-1], reverse=True)
+    print(f"Best member {ranked_members[0]['member_id']} on {ranked_members[0]['gym_id']}: "
+          f"eval mean reward {ranked_members[0]['scores'][-1]:.2f} {ranked_members[0]['parameters']}")
+    return ranked_members
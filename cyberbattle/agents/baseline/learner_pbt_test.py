@@ -0,0 +1,49 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Test the population-based training of DQL agents"""
+
+import os
+import random
+
+import pytest
+
+from cyberbattle.agents.baseline.learner_pbt import perturb, population_based_training
+
+
+def test_perturb() -> None:
+    parameters = {'gamma': 0.9, 'learning_rate': 0.01, 'epsilon': 0.4, 'epsilon_minimum': 0.1,
+                  'epsilon_exponential_decay': 100, 'batch_size': 32}
+    perturbed = perturb(parameters, (2.0,), random.Random(0))
+    assert perturbed == {'gamma': 0.999, 'learning_rate': 0.02, 'epsilon': 0.8, 'epsilon_minimum': 0.2,
+                         'epsilon_exponential_decay': 200, 'batch_size': 32}
+    assert parameters['gamma'] == 0.9
+
+
+def test_perturb_constant_epsilon() -> None:
+    """Without decay the schedule is perturbed through epsilon itself, kept within [epsilon_minimum, 1]"""
+    parameters = {'epsilon': 0.6, 'epsilon_minimum': 0.1, 'epsilon_exponential_decay': None}
+    assert perturb(parameters, (2.0,), random.Random(0)) == {'epsilon': 1.0, 'epsilon_minimum': 0.2, 'epsilon_exponential_decay': None}
+    assert perturb(parameters, (0.1,), random.Random(0))['epsilon'] == pytest.approx(0.06)
+    assert perturb({'epsilon': 0.5, 'epsilon_minimum': 0.4}, (2.0, 0.5), random.Random(1))['epsilon'] >= 0.4
+
+
+def test_population_based_training(tmp_path, tinymicro_bounds) -> None:
+    """The worst member of each environment continues from the best one's checkpoint"""
+    ep = tinymicro_bounds
+    gym_ids = ['CyberBattleTinyMicro-v1234', 'CyberBattleTinyMicro-v12']
+    configurations = [{'gamma': 0.5, 'learning_rate': 0.01 * (i + 1), 'batch_size': 4, 'epsilon_exponential_decay': 10}
+                      for i in range(4)]
+    members = population_based_training(gym_ids, ep, configurations, str(tmp_path), iteration_count=10,
+                                        generation_count=2, interval_episodes=1, eval_episode_count=1,
+                                        truncation=0.5, perturbation_factors=(0.5,), env_kwargs={'env_bounds': ep})
+
+    assert all(len(member['scores']) == 2 and os.path.exists(member['checkpoint']) for member in members)
+    exploiting = [member for member in members if member['exploited']]
+    assert len(exploiting) == 2
+    for member in exploiting:
+        [(generation, peer_id)] = member['exploited']
+        peer = next(m for m in members if m['member_id'] == peer_id)
+        assert generation == 0 and peer['gym_id'] == member['gym_id']
+        assert member['parameters']['learning_rate'] == pytest.approx(peer['parameters']['learning_rate'] * 0.5)
+        assert member['parameters']['epsilon'] <= 0.9 * 0.5
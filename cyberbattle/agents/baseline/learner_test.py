@@ -0,0 +1,138 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Test the learner helpers and training drivers"""
+
+import gym
+import numpy as np
+import pytest
+
+import cyberbattle.agents.baseline.agent_wrapper as w
+import cyberbattle.agents.baseline.learner as learner
+from cyberbattle.agents.baseline.agent_tabularqlearning import QTabularLearner, percentile_thresholds, random_argtop_percentile_rows
+
+
+def test_epsilon_greedy_search_batch(tinymicro_bounds) -> None:
+    ep = tinymicro_bounds
+    envs = [gym.make('CyberBattleTinyMicro-v1234', env_bounds=ep) for _ in range(3)]
+    trained = learner.epsilon_greedy_search_batch(
+        envs, ep, QTabularLearner(ep, gamma=0.015, learning_rate=0.01, exploit_percentile=100),
+        title='batch', episode_count=4, iteration_count=10, epsilon=0.5, verbosity=w.Verbosity.Quiet)
+    assert len(trained['all_episodes_rewards']) == 4
+    assert all(0 < len(rewards) <= 10 for rewards in trained['all_episodes_rewards'])
+
+
+def test_qmatrix_exploit_batch(tinymicro_bounds) -> None:
+    ep = tinymicro_bounds
+    qattack = QTabularLearner(ep, gamma=0.0, learning_rate=0.0, exploit_percentile=100).qattack
+    qattack.qm[1, 2] = 5.0
+    qattack.qm[3, 0] = qattack.qm[3, 4] = 7.0
+    actions, expectedq = qattack.exploit_batch(np.array([1, 3, 3, 3]), percentile=100)
+    assert actions[0] == 2
+    assert set(actions[1:]) <= {0, 4}
+    np.testing.assert_array_equal(expectedq, [5.0, 7.0, 7.0, 7.0])
+
+
+def test_sparse_qtable_matches_dense(tinymicro_bounds) -> None:
+    """Sparse and dense Q matrices go through the same updates and allocate only visited rows"""
+    ep = tinymicro_bounds
+    dense = QTabularLearner(ep, gamma=0.5, learning_rate=0.1, exploit_percentile=100).qattack
+    sparse = QTabularLearner(ep, gamma=0.5, learning_rate=0.1, exploit_percentile=100, sparse=True).qattack
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        state, action, next_state = rng.integers(0, 20), rng.integers(0, dense.actiondim), rng.integers(0, 20)
+        reward = float(rng.integers(-5, 10))
+        dense.update(state, action, next_state, reward, gamma=0.5, learning_rate=0.1)
+        sparse.update(state, action, next_state, reward, gamma=0.5, learning_rate=0.1)
+
+    np.testing.assert_allclose(np.asarray(sparse.qm), dense.qm, rtol=1e-5, atol=1e-5)
+    assert len(sparse.qm.rows) <= 20
+    assert sparse.memory_usage() < dense.memory_usage()
+    states = np.arange(25)
+    np.testing.assert_allclose(sparse.qm[states, :], dense.qm[states, :], rtol=1e-5, atol=1e-5)
+
+
+def test_top_percentile_selection() -> None:
+    """Thresholds agree with np.percentile and the picks are uniform among the rows' top elements"""
+    rng = np.random.default_rng(0)
+    rows = rng.integers(0, 6, size=(40, 17)).astype(np.float64)
+    for percentile in [0, 10, 50, 83.3, 99, 100]:
+        np.testing.assert_allclose(percentile_thresholds(rows, percentile), np.percentile(rows, percentile, axis=1))
+        thresholds, indices = random_argtop_percentile_rows(rows, percentile, rng)
+        assert np.all(rows[np.arange(len(rows)), indices] >= thresholds)
+
+    row = np.array([[1.0, 5.0, 2.0, 5.0, 5.0]])
+    picks = [int(random_argtop_percentile_rows(row, 100, rng)[1][0]) for _ in range(3000)]
+    counts = np.bincount(picks, minlength=5)
+    assert counts[0] == counts[2] == 0
+    assert all(900 < c < 1100 for c in counts[[1, 3, 4]])
+
+
+def test_early_stopping_controller() -> None:
+    early_stopping = learner.EarlyStopping(metric='run_mean', patience=2, min_delta=1.0, goal=10.0)
+    assert not early_stopping.update(0.0, 1)
+    assert not early_stopping.update(0.5, 2)
+    assert early_stopping.update(0.5, 3)
+    assert early_stopping.stopped_at_episode == 3 and 'did not improve' in early_stopping.stop_reason
+
+    # with the default min_delta a constant value is a plateau
+    early_stopping = learner.EarlyStopping(metric='run_mean', patience=3)
+    assert [early_stopping.update(5.0, i) for i in range(1, 5)] == [False, False, False, True]
+    assert early_stopping.stopped_at_episode == 4 and early_stopping.checks_without_improvement == 3
+
+    early_stopping = learner.EarlyStopping(patience=5, goal=10.0)
+    assert not early_stopping.update(5.0, 5)
+    assert early_stopping.update(12.0, 10)
+    assert 'goal' in early_stopping.stop_reason
+
+
+def test_epsilon_greedy_search_early_stopping(tinymicro_bounds, tinymicro_env) -> None:
+    ep, env = tinymicro_bounds, tinymicro_env
+    # no running mean can improve by this much: the search stops after `patience` more episodes
+    early_stopping = learner.EarlyStopping(metric='run_mean', patience=2, min_delta=1e9)
+    trained = learner.epsilon_greedy_search(env, ep, learner.RandomPolicy(), 'early stopping', episode_count=20,
+                                            iteration_count=10, epsilon=1.0, verbosity=w.Verbosity.Quiet,
+                                            plot_episodes_length=False, early_stopping=early_stopping)
+    assert len(trained['all_episodes_rewards']) == 3
+    assert early_stopping.stopped_at_episode == 3
+
+
+@pytest.mark.parametrize('metric', ['run_mean', 'eval_run_mean'])
+def test_epsilon_greedy_search_early_stopping_on_plateau(metric, tinymicro_bounds, tinymicro_env) -> None:
+    ep, env = tinymicro_bounds, tinymicro_env
+    # the best running mean of a random policy soon saturates
+    early_stopping = learner.EarlyStopping(metric=metric, patience=2)
+    trained = learner.epsilon_greedy_search(env, ep, learner.RandomPolicy(), 'early stopping', episode_count=50,
+                                            iteration_count=10, epsilon=1.0, eval_episode_count=1, eval_freq=1,
+                                            mean_reward_window=2, verbosity=w.Verbosity.Quiet,
+                                            plot_episodes_length=False, early_stopping=early_stopping)
+    assert early_stopping.stopped_at_episode is not None and early_stopping.stopped_at_episode < 50
+    assert 'did not improve' in early_stopping.stop_reason
+    assert early_stopping.checks_without_improvement == 2
+    assert len(trained['all_episodes_rewards']) < 50
+
+
+def test_epsilon_greedy_search_headless(capsys, tinymicro_bounds, tinymicro_env) -> None:
+    ep, env = tinymicro_bounds, tinymicro_env
+    log_level = learner.logger.level
+    trained = learner.epsilon_greedy_search(env, ep, learner.RandomPolicy(), 'headless', episode_count=3,
+                                            iteration_count=10, epsilon=1.0, verbosity=w.Verbosity.Quiet,
+                                            plot_episodes_length=False, headless=True)
+    assert learner.logger.level == log_level
+    # one line per episode, no progress bar nor per-episode breakdown
+    lines = capsys.readouterr().out.strip().splitlines()
+    episode_lines = [line for line in lines if line.startswith('Episode ')]
+    assert len(episode_lines) == len(trained['all_episodes_rewards']) and not any('## Episode' in line or 'explore-' in line for line in lines)
+
+
+def test_headless_search_restores_logger_level_on_error(tinymicro_bounds, tinymicro_env) -> None:
+    class FailingPolicy(learner.RandomPolicy):
+        def on_step(self, wrapped_env, observation, reward, done, info, action_metadata):
+            raise KeyboardInterrupt
+
+    ep, env = tinymicro_bounds, tinymicro_env
+    log_level = learner.logger.level
+    with pytest.raises(KeyboardInterrupt):
+        learner.epsilon_greedy_search(env, ep, FailingPolicy(), 'interrupted', episode_count=3, iteration_count=10,
+                                      epsilon=1.0, verbosity=w.Verbosity.Quiet, plot_episodes_length=False, headless=True)
+    assert learner.logger.level == log_level
@@ -79,7 +79,7 @@ exploit_train = "exploittrain" * train_while_exploit + "exploitinfer" * (1 - tra
 def main(gymid=gymid, training_episode_count=training_episode_count,
          eval_episode_count=eval_episode_count, iteration_count=iteration_count,
          epsilon_exponential_decay=epsilon_exponential_decay, seed=seed,
-         reward_clip=reward_clip, gamma=gamma, log_results=log_results, args=None):
+         reward_clip=reward_clip, gamma=gamma, log_results=log_results, headless=None, args=None):
     if args is not None:
         training_episode_count = args.training_episode_count
         eval_episode_count = args.eval_episode_count
@@ -92,6 +92,7 @@ def main(gymid=gymid, training_episode_count=training_episode_count,
         log_results = args.log_results
         run_random_agent = args.run_random_agent
         run_qtabular = args.run_qtabular
+        headless = args.headless
     else:
         run_random_agent = False
         run_qtabular = False
@@ -101,6 +102,8 @@ def main(gymid=gymid, training_episode_count=training_episode_count,
     seed = round(seed)
 
     configuration.log_results = log_results
+    if headless is not None:
+        configuration.headless = headless
 
     iteration_count = max_episode_steps if iteration_count is None else iteration_count
     os.environ['TRAINING_EPISODE_COUNT'] = os.getenv('TRAINING_EPISODE_COUNT', 1000) if training_episode_count is None else str(training_episode_count)
@@ -177,6 +180,7 @@ def main(gymid=gymid, training_episode_count=training_episode_count,
             verbosity=Verbosity.Quiet,
             title="Random search"
         )
+        trained_run = random_run
         agent = random_run['learner']
         n_episodes = len(random_run["all_episodes_rewards"])
     elif run_qtabular:
@@ -191,6 +195,7 @@ def main(gymid=gymid, training_episode_count=training_episode_count,
             verbosity=Verbosity.Quiet,
             title="Tabular Q-learning"
         )
+        trained_run = qtabular_run
         agent = qtabular_run['learner']
         n_episodes = len(qtabular_run["all_episodes_rewards"])
     else:
@@ -225,6 +230,7 @@ def main(gymid=gymid, training_episode_count=training_episode_count,
             save_model_filename=log_results * os.path.join(log_dir, 'training',
                                                            f"{exploit_train}_te{training_episode_count}.tar")
         )
+        trained_run = dqn_learning_run
         agent = dqn_learning_run['learner']
         n_episodes = len(dqn_learning_run["all_episodes_rewards"])
     # # %%
@@ -309,6 +315,12 @@ def main(gymid=gymid, training_episode_count=training_episode_count,
         configuration.writer.close()
         logger.info("Ending of simulation!")
 
+    return {'log_dir': log_dir,
+            'gymid': gymid,
+            'training_episode_count': n_episodes,
+            'best_running_mean': float(trained_run['best_running_mean']),
+            'eval_total_rewards': [float(h[-1][2]) if h else 0.0 for h in eval_h]}
+
 
 # %%
 if papermill_as_main:
@@ -0,0 +1,118 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Greedy evaluation of a learner in a pool of worker processes
+
+`evaluate_model` runs its evaluation episodes one after the other in the
+training process. A `ParallelEvaluator` instead takes a snapshot of the
+learner (`Learner.evaluation_snapshot`), fans the episodes out to worker
+processes, each with its own environment and seed, and gives back the
+episodes in order, to be recorded by `evaluate_model` as if it had run them.
+
+Submitting an evaluation does not block: the training loop of
+`epsilon_greedy_search` keeps training while the workers evaluate the
+snapshot, and records the evaluation once it is done.
+"""
+
+import concurrent.futures
+import multiprocessing
+import random
+from typing import Any, Dict, List, Optional
+
+import gym
+import numpy as np
+import torch
+
+from .agent_wrapper import AgentWrapper, EnvironmentBounds, ActionTrackingStateAugmentation, Verbosity
+from .learner import EvaluationEpisode, Learner, evaluation_episode
+from cyberbattle.simulation.config import configuration
+
+# environment of each worker process, created on its first evaluation
+_worker_envs: Dict[str, AgentWrapper] = {}
+
+
+def _evaluation_worker(gym_id: str,
+                       env_kwargs: Dict[str, Any],
+                       environment_properties: EnvironmentBounds,
+                       learner: Learner,
+                       episode_count: int,
+                       iteration_count: int,
+                       seed: int) -> List[EvaluationEpisode]:
+    """Run greedy evaluation episodes of a learner snapshot"""
+    configuration.log_results = False
+    torch.manual_seed(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+
+    if gym_id not in _worker_envs:
+        env = gym.make(gym_id, **env_kwargs)
+        _worker_envs[gym_id] = AgentWrapper(env, ActionTrackingStateAugmentation(environment_properties, env.reset()))
+    wrapped_env = _worker_envs[gym_id]
+
+    learner.eval()
+    episodes = []
+    for i_episode in range(1, episode_count + 1):
+        episode = evaluation_episode(wrapped_env, learner, iteration_count, Verbosity.Quiet)
+        learner.end_of_episode(i_episode=i_episode, t=episode['episode_ended_at'] or iteration_count)
+        episodes.append(episode)
+    return episodes
+
+
+class PendingEvaluation:
+    """Evaluation episodes running on the workers of a `ParallelEvaluator`"""
+
+    def __init__(self, learner: Learner, futures: List[concurrent.futures.Future]):
+        # the snapshot being evaluated
+        self.learner = learner
+        self.futures = futures
+
+    def done(self) -> bool:
+        return all(future.done() for future in self.futures)
+
+    def result(self) -> List[EvaluationEpisode]:
+        """The evaluation episodes, in order, waiting for them if needed"""
+        return [episode for future in self.futures for episode in future.result()]
+
+
+class ParallelEvaluator:
+    """Evaluate learners greedily in `worker_count` processes
+
+    Parameters
+    ==========
+    gym_id, env_kwargs -- the gym environment (and its `gym.make` arguments) each worker evaluates on
+    environment_properties -- bounds of the environment used by the learner
+    worker_count -- number of worker processes
+    start_method -- multiprocessing start method of the worker processes
+    """
+
+    def __init__(self, gym_id: str, environment_properties: EnvironmentBounds, worker_count: int = 4,
+                 env_kwargs: Optional[Dict[str, Any]] = None, start_method: str = 'spawn'):
+        self.gym_id = gym_id
+        self.env_kwargs = env_kwargs or {}
+        self.environment_properties = environment_properties
+        self.worker_count = worker_count
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=worker_count,
+                                                               mp_context=multiprocessing.get_context(start_method))
+
+    def submit(self, learner: Learner, episode_count: int, iteration_count: int, seed: int = 0) -> PendingEvaluation:
+        """Start evaluating a snapshot of the learner for `episode_count` episodes split among the workers"""
+        snapshot = learner.evaluation_snapshot()
+        shares = [len(share) for share in np.array_split(np.arange(episode_count), self.worker_count) if len(share)]
+        futures = [self.executor.submit(_evaluation_worker, self.gym_id, self.env_kwargs, self.environment_properties, snapshot,
+                                        share, iteration_count, seed + i)
+                   for i, share in enumerate(shares)]
+        return PendingEvaluation(snapshot, futures)
+
+    def evaluate(self, learner: Learner, episode_count: int, iteration_count: int, seed: int = 0) -> List[EvaluationEpisode]:
+        """Evaluate a snapshot of the learner, waiting for the result"""
+        return self.submit(learner, episode_count, iteration_count, seed).result()
+
+    def close(self) -> None:
+        """Shut the workers down, once they finished the evaluations submitted"""
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
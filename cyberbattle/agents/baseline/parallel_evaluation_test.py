@@ -0,0 +1,41 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Test the greedy evaluation of learners in worker processes"""
+
+import sys
+
+import torch
+
+import cyberbattle.agents.baseline.agent_wrapper as w
+from cyberbattle.agents.baseline.agent_dql import DeepQLearnerPolicy
+from cyberbattle.agents.baseline.learner import epsilon_greedy_search, evaluate_model
+from cyberbattle.agents.baseline.parallel_evaluation import ParallelEvaluator
+
+
+def test_snapshot_keeps_weights_only(tinymicro_bounds) -> None:
+    ep = tinymicro_bounds
+    learner = DeepQLearnerPolicy(ep, gamma=0.5, replay_memory_size=1000, target_update=5, batch_size=4, learning_rate=0.01)
+    snapshot = learner.evaluation_snapshot()
+    assert snapshot.memory.capacity == 1
+    for snapshot_param, param in zip(snapshot.policy_net.parameters(), learner.policy_net.parameters()):
+        assert torch.equal(snapshot_param, param)
+    with torch.no_grad():
+        learner.policy_net.head.bias += 1.0
+    assert not torch.equal(snapshot.policy_net.head.bias, learner.policy_net.head.bias)
+
+
+def test_parallel_evaluate_model(tinymicro_bounds, tinymicro_env) -> None:
+    ep, env = tinymicro_bounds, tinymicro_env
+    learner = DeepQLearnerPolicy(ep, gamma=0.5, replay_memory_size=1000, target_update=5, batch_size=4, learning_rate=0.01)
+    with ParallelEvaluator('CyberBattleTinyMicro-v1234', ep, worker_count=2, env_kwargs={'env_bounds': ep}) as evaluator:
+        results = evaluate_model(env, ep, learner, 'parallel', iteration_count=10, epsilon=0.0, eval_episode_count=3,
+                                 best_eval_running_mean=-sys.float_info.max, verbosity=w.Verbosity.Quiet,
+                                 evaluator=evaluator)
+        assert len(results['all_episodes_rewards']) == 3
+        assert all(0 < len(rewards) <= 10 for rewards in results['all_episodes_rewards'])
+
+        trained = epsilon_greedy_search(env, ep, learner, 'async evaluation', episode_count=4, iteration_count=10,
+                                        epsilon=0.9, eval_episode_count=2, eval_freq=2, verbosity=w.Verbosity.Quiet,
+                                        plot_episodes_length=False, evaluator=evaluator, eval_async=True)
+        assert trained['best_running_mean'] > -sys.float_info.max
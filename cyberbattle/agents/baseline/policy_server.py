@@ -0,0 +1,250 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Central batched inference for many environment workers (SEED RL style)
+
+Instead of giving each worker its own copy of the Q network, workers send
+the candidate actor state vectors of their current step to a policy server
+over local pipes. The server waits until every connected worker has a
+pending request, or until the oldest pending request is `max_batch_latency`
+seconds old, and answers all of them with a single forward pass of the DQN.
+
+On the worker side `PolicyClient` has the same `lookup` interface as
+`DQNInference`, so it can be plugged into a `DeepQLearnerPolicy` as its
+inference engine.
+
+Reference: Espeholt et al., SEED RL: Scalable and Efficient Deep-RL with
+Accelerated Central Inference, 2020.
+"""
+
+import multiprocessing
+import queue
+import random
+import threading
+import time
+from multiprocessing.connection import Connection, wait
+from typing import Any, Dict, List, Optional, Tuple
+
+import gym
+import numpy as np
+import torch
+from numpy import ndarray
+
+from .agent_dql import DeepQLearnerPolicy, DQN, DQNInference, mask_q_values
+from .agent_wrapper import AgentWrapper, EnvironmentBounds, ActionTrackingStateAugmentation
+from cyberbattle.simulation.config import logger
+
+
+class PolicyClient:
+    """Worker end of a connection to a `PolicyServer`"""
+
+    def __init__(self, connection: Connection):
+        self.connection = connection
+
+    def refresh(self, dqn: DQN) -> None:
+        """Weights are owned by the server"""
+        return
+
+    def lookup(self, states: ndarray, valid_actions: Optional[ndarray] = None) -> Tuple[List[int], List[float]]:
+        """Best action and its expected Q value for each state, computed by the server"""
+        self.connection.send((np.asarray(states, dtype=np.float32), valid_actions))
+        return self.connection.recv()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class PolicyServer:
+    """Answer the lookups of many `PolicyClient` with batched forward passes
+
+    Parameters
+    ==========
+    dqn -- the network to serve, a frozen snapshot is taken (see `refresh`)
+    max_batch_latency -- maximum time in seconds a request waits for other workers' requests
+    max_batch_size -- a batch is answered as soon as it has this many state vectors
+    """
+
+    def __init__(self, dqn: DQN, max_batch_latency: float = 0.002, max_batch_size: int = 1024):
+        self.max_batch_latency = max_batch_latency
+        self.max_batch_size = max_batch_size
+        self.inference = DQNInference(dqn, max_batch_size)
+        self.inference_lock = threading.Lock()
+        self.connections: List[Connection] = []
+        self.connections_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.batch_count = 0
+        self.request_count = 0
+
+    def connect(self) -> PolicyClient:
+        """Open a new connection and return its worker end (can be passed to a worker process)"""
+        server_end, worker_end = multiprocessing.Pipe()
+        with self.connections_lock:
+            self.connections.append(server_end)
+        return PolicyClient(worker_end)
+
+    def refresh(self, dqn: DQN) -> None:
+        """Serve the current weights of the network"""
+        with self.inference_lock:
+            self.inference.refresh(dqn)
+
+    def mean_batch_size(self) -> float:
+        """Average number of requests answered per forward pass"""
+        return self.request_count / self.batch_count if self.batch_count else 0.0
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        for connection in self.connections:
+            connection.close()
+
+    def answer(self, pending: Dict[Connection, Tuple[ndarray, Optional[ndarray]]]) -> None:
+        """Run one forward pass for all the pending requests and send back the results"""
+        states = np.concatenate([request_states for request_states, _ in pending.values()])
+        with self.inference_lock:
+            q_values = self.inference.forward(states)
+        if any(valid_actions is not None for _, valid_actions in pending.values()):
+            valid_actions = np.concatenate([
+                np.ones((len(request_states), q_values.shape[1]), dtype=np.bool_) if request_valid_actions is None
+                else request_valid_actions
+                for request_states, request_valid_actions in pending.values()])
+            q_values = mask_q_values(q_values, valid_actions)
+        expectedq, actions = q_values.max(1)
+        actions_list, expectedq_list = actions.tolist(), expectedq.tolist()
+        start = 0
+        for connection, (request_states, _) in pending.items():
+            end = start + len(request_states)
+            connection.send((actions_list[start:end], expectedq_list[start:end]))
+            start = end
+        self.batch_count += 1
+        self.request_count += len(pending)
+
+    def serve(self) -> None:
+        """Serving loop, returns when stopped"""
+        pending: Dict[Connection, Tuple[ndarray, Optional[ndarray]]] = {}
+        pending_rows = 0
+        oldest_request_at = 0.0
+        while not self.stopped.is_set():
+            with self.connections_lock:
+                connections = list(self.connections)
+            waiting = [c for c in connections if c not in pending]
+            if pending:
+                timeout = max(0.0, oldest_request_at + self.max_batch_latency - time.perf_counter())
+            else:
+                timeout = 0.1
+            ready = wait(waiting, timeout=timeout) if waiting else []
+
+            for connection in ready:
+                assert isinstance(connection, Connection)
+                try:
+                    request = connection.recv()
+                except EOFError:
+                    # the worker closed its end of the connection
+                    with self.connections_lock:
+                        self.connections.remove(connection)
+                    continue
+                if not pending:
+                    oldest_request_at = time.perf_counter()
+                pending[connection] = request
+                pending_rows += len(request[0])
+
+            if pending and (len(pending) >= len(self.connections)
+                            or pending_rows >= self.max_batch_size
+                            or time.perf_counter() - oldest_request_at >= self.max_batch_latency):
+                self.answer(pending)
+                pending = {}
+                pending_rows = 0
+
+
+def _evaluation_worker(worker_id: int,
+                       client: PolicyClient,
+                       gym_id: str,
+                       env_kwargs: Dict[str, Any],
+                       environment_properties: EnvironmentBounds,
+                       episode_count: int,
+                       iteration_count: int,
+                       seed: int,
+                       results) -> None:
+    """Run greedy evaluation episodes, looking up the Q values on the policy server"""
+    torch.manual_seed(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+
+    env = gym.make(gym_id, **env_kwargs)
+    policy = DeepQLearnerPolicy(environment_properties, gamma=0.0, replay_memory_size=1, target_update=1,
+                                batch_size=1, learning_rate=0.0, train_while_exploit=False)
+    policy.inference = client  # type: ignore
+    policy.eval()
+
+    wrapped_env = AgentWrapper(env, ActionTrackingStateAugmentation(environment_properties, env.reset()))
+    for _ in range(episode_count):
+        observation = wrapped_env.reset()
+        all_rewards = []
+        for _ in range(iteration_count):
+            _, gym_action, action_metadata = policy.exploit(wrapped_env, observation)
+            if not gym_action:
+                _, gym_action, action_metadata = policy.explore(wrapped_env)
+            observation, reward, done, info = wrapped_env.step(gym_action)
+            all_rewards.append(reward)
+            if done:
+                break
+        results.put((worker_id, all_rewards))
+
+    client.close()
+    env.close()
+
+
+def evaluate_with_policy_server(
+    gym_id: str,
+    environment_properties: EnvironmentBounds,
+    learner: DeepQLearnerPolicy,
+    worker_count: int,
+    episode_count: int,
+    iteration_count: int,
+    env_kwargs: Optional[Dict[str, Any]] = None,
+    max_batch_latency: float = 0.002,
+    seed: int = 0,
+    start_method: str = 'spawn'
+) -> List[List[float]]:
+    """Evaluate a DQL policy greedily on `worker_count` environment processes
+    sharing one policy server. Each worker runs `episode_count` episodes.
+    Returns the rewards of every episode."""
+    ctx = multiprocessing.get_context(start_method)
+    env_kwargs = env_kwargs or {}
+    server = PolicyServer(learner.policy_net, max_batch_latency=max_batch_latency)
+    results = ctx.Queue()
+    clients = [server.connect() for _ in range(worker_count)]
+    workers = [ctx.Process(target=_evaluation_worker,
+                           args=(i, client, gym_id, env_kwargs, environment_properties,
+                                 episode_count, iteration_count, seed + i, results),
+                           daemon=True)
+               for i, client in enumerate(clients)]
+    server.start()
+    for worker, client in zip(workers, clients):
+        worker.start()
+        # the worker process owns its end of the pipe from now on
+        client.close()
+
+    all_episodes_rewards = []
+    try:
+        while len(all_episodes_rewards) < worker_count * episode_count:
+            try:
+                _, episode_rewards = results.get(timeout=1.0)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError('all the evaluation workers exited')
+                continue
+            all_episodes_rewards.append(episode_rewards)
+    finally:
+        for worker in workers:
+            worker.join()
+        server.stop()
+
+    logger.info(f"Policy server answered {server.request_count} requests in {server.batch_count} batches "
+                f"(mean batch size {server.mean_batch_size():.1f})")
+    return all_episodes_rewards
@@ -0,0 +1,60 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Test the batched inference policy server"""
+
+import multiprocessing
+import threading
+
+import gym
+import numpy as np
+
+import cyberbattle.agents.baseline.agent_wrapper as w
+from cyberbattle.agents.baseline.agent_dql import DQN, DQNInference, DeepQLearnerPolicy
+from cyberbattle.agents.baseline.policy_server import PolicyServer, evaluate_with_policy_server
+
+
+def test_policy_server_batches_worker_lookups() -> None:
+    """Concurrent lookups are answered together and agree with a local forward pass"""
+    env = gym.make('CyberBattleToyCtf-v0')
+    ep = w.EnvironmentBounds.of_identifiers(maximum_node_count=12, maximum_total_credentials=10, identifiers=env.identifiers)
+    dqn = DQN(ep)
+    local = DQNInference(dqn)
+    server = PolicyServer(dqn, max_batch_latency=1.0)
+    clients = [server.connect() for _ in range(4)]
+    server.start()
+
+    rng = np.random.default_rng(0)
+    requests = [rng.integers(0, 5, size=(i + 1, dqn.hidden_layer1.in_features)).astype(np.float32) for i in range(4)]
+    answers = [None] * 4
+
+    def lookup(i):
+        answers[i] = clients[i].lookup(requests[i])
+
+    threads = [threading.Thread(target=lookup, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.stop()
+
+    assert server.batch_count == 1
+    assert server.mean_batch_size() == 4
+    for request, (actions, expectedq) in zip(requests, answers):
+        expected_actions, expected_q = local.lookup(request)
+        assert actions == expected_actions
+        np.testing.assert_allclose(expectedq, expected_q, rtol=1e-4)
+
+
+def test_evaluate_with_policy_server(tinymicro_bounds) -> None:
+    """Every worker runs its episodes against the server, which is stopped at the end"""
+    ep = tinymicro_bounds
+    learner = DeepQLearnerPolicy(ep, gamma=0.5, replay_memory_size=1000, target_update=5, batch_size=4, learning_rate=0.01)
+    threads_before = set(threading.enumerate())
+    all_episodes_rewards = evaluate_with_policy_server('CyberBattleTinyMicro-v1234', ep, learner,
+                                                       worker_count=2, episode_count=3, iteration_count=10,
+                                                       env_kwargs={'env_bounds': ep})
+    assert len(all_episodes_rewards) == 2 * 3
+    assert all(0 < len(rewards) <= 10 for rewards in all_episodes_rewards)
+    assert set(threading.enumerate()) <= threads_before
+    assert multiprocessing.active_children() == []
@@ -93,6 +93,10 @@ parser.add_argument('--qtabular', dest='run_qtabular', action='store_true', help
 parser.add_argument('--no-qtabular', dest='run_qtabular', action='store_false', help='do not run the q-tabular learning agent')
 parser.set_defaults(run_qtabular=False)
 
+parser.add_argument('--headless', action='store_true',
+                    help='fast training: no progress bars, per-step logging or per-episode breakdowns, only episode level metrics')
+parser.set_defaults(headless=False)
+
 args = parser.parse_args()
 
 if args.eval:
@@ -138,7 +142,8 @@ else:
             epsilon_exponential_decay=5000,  # 10000
             epsilon_minimum=0.10,
             verbosity=Verbosity.Quiet,
-            title="DQL"
+            title="DQL",
+            headless=args.headless
         )
 
         all_runs.append(dqn_learning_run)
@@ -153,7 +158,8 @@ else:
                 epsilon=1.0,  # purely random
                 render=False,
                 verbosity=Verbosity.Quiet,
-                title="Random search"
+                title="Random search",
+                headless=args.headless
             )
             all_runs.append(random_run)
 
@@ -15,6 +15,7 @@ from boolean import boolean
 from collections import OrderedDict
 import sys
 import re
+import logging
 from enum import Enum
 from typing import Iterator, List, Optional, Set, Tuple, Dict, TypedDict, cast
 from IPython.display import display
@@ -24,6 +25,7 @@ import numpy as np
 from cyberbattle.simulation.model import FirewallRule, MachineStatus, PrivilegeLevel, PropertyName, VulnerabilityID, VulnerabilityType
 import cyberbattle.simulation.model as model
 from cyberbattle.simulation.config import logger
+from cyberbattle.simulation.tracing import EventKind, EventTracer
 
 RewardType = float
 
@@ -110,6 +112,20 @@ class ErrorType(Enum):
     NO_AUTH = 6
 
 
+# messages logged by `_process_outcome`, formatted only if the log level lets them through
+LOGGER_ACTION = "GOT REWARD r={0} with \tAction: {2}/{1}\tProfile: {3},\tPrecondition: {4}\t Description: {5}"
+ERROR_STRING_DICT = {
+    ErrorType.REPEATED: "Repeated action",
+    ErrorType.IP_LOCAL_NEEDED: "No access use VPN",
+    ErrorType.ROLES_WRONG: "Error {6} only",
+    # THIS should be invalid actually, for example, if DOCUMENT is not discovered
+    ErrorType.PROPERTY_WRONG: "Not discovered property",
+    ErrorType.WRONG_AUTH: "Wrong Authentification",
+    ErrorType.NO_AUTH: "Authentification required",
+    ErrorType.OTHER: "Cannot get {2}/{1}",
+}
+
+
 class EdgeAnnotation(Enum):
     """Annotation added to the network edges created as the simulation is played"""
     KNOWS = 0
@@ -147,16 +163,19 @@ class AgentActions:
         This is the AgentActions class. It interacts with and makes changes to the environment.
     """
 
-    def __init__(self, environment: model.Environment, throws_on_invalid_actions=True, deception_penalty_raise=False):
+    def __init__(self, environment: model.Environment, throws_on_invalid_actions=True, deception_penalty_raise=False,
+                 tracer: Optional[EventTracer] = None):
         """
             AgentActions Constructor
 
         environment               - CyberBattleSim environment parameters
         throws_on_invalid_actions - whether to raise an exception when executing an invalid action (e.g., running an attack from a node that's not owned)
                                     if set to False a negative reward is returned instead.
+        tracer                    - if set, records an event for each vulnerability exploited
 
         """
         self._environment = environment
+        self._tracer = tracer
         self._gathered_credentials: Set[model.CredentialID] = set()
         self._gathered_profiles: List[model.Profile] = [model.Profile(username="NoAuth")]
         self._discovered_nodes: OrderedDict[model.NodeID, NodeTrackingInformation] = OrderedDict()
@@ -421,13 +440,19 @@ class AgentActions:
                           local_or_remote: bool,
                           failed_penalty: float,
                           throw_if_vulnerability_not_present: bool,
-                          profile: Optional[model.Profile] = None
+                          profile: Optional[model.Profile] = None,
+                          source_node_id: Optional[model.NodeID] = None
                           ) -> Tuple[bool, ActionResult]:
 
         # # logger.info("Process outcome")
+        tracer = self._tracer
+        event_kind = EventKind.LOCAL_EXPLOIT if local_or_remote else EventKind.REMOTE_EXPLOIT
 
         if node_info.status != model.MachineStatus.Running:
             logger.warning("target machine not in running state")
+            if tracer is not None:
+                tracer.record(event_kind, source_node_id, node_id, vulnerability_id,
+                              error_type=ErrorType.OTHER.value, reward=Penalty.MACHINE_NOT_RUNNING)
             return False, ActionResult(reward=Penalty.MACHINE_NOT_RUNNING,
                                        outcome=None, profile=str(profile), precondition="", reward_string="")
 
@@ -446,6 +471,9 @@ class AgentActions:
                 # It was only possible with target_node being random,
                 # now everything is in action_mask, and isinvalid(...) check is done to change exploit -> explore
                 logger.warning("Vulnerability '{}' not supported by node '{}'".format(vulnerability_id, node_id))
+                if tracer is not None:
+                    tracer.record(event_kind, source_node_id, node_id, vulnerability_id,
+                                  error_type=ErrorType.OTHER.value, reward=Penalty.SUPSPICIOUSNESS)
                 return False, ActionResult(reward=Penalty.SUPSPICIOUSNESS, outcome=None, profile=str(profile), precondition="", reward_string="SUSPICIOUSNESS action")
 
         vulnerability = vulnerabilities[vulnerability_id]
@@ -459,17 +487,6 @@ class AgentActions:
         max_reward, max_outcome, max_precondition_index = -sys.float_info.max, None, -1
 
         error_type = ErrorType.OTHER
-        logger_action = "GOT REWARD r={0} with \tAction: {2}/{1}\tProfile: {3},\tPrecondition: {4}\t Description: {5}"
-        error_string_dict = {
-            ErrorType.REPEATED: "Repeated action",
-            ErrorType.IP_LOCAL_NEEDED: "No access use VPN",
-            ErrorType.ROLES_WRONG: "Error {6} only",
-            # THIS should be invalid actually, for example, if DOCUMENT is not discovered
-            ErrorType.PROPERTY_WRONG: "Not discovered property",
-            ErrorType.WRONG_AUTH: "Wrong Authentification",
-            ErrorType.NO_AUTH: "Authentification required",
-            ErrorType.OTHER: "Cannot get {2}/{1}",
-        }
 
         ip_local_flag = profile.ip == "local" if profile else False  # means we choose to try local network vuln using SSRF
         max_reward_list = []
@@ -621,7 +638,7 @@ class AgentActions:
         # max_outcome = vulnerability.outcome[max_precondition_index] if isinstance(vulnerability.outcome, list) else vulnerability.outcome
         max_reward_string = vulnerability.reward_string[max_precondition_index] if isinstance(vulnerability.reward_string, list) else vulnerability.reward_string
         max_precondition = vulnerability.precondition[max_precondition_index] if isinstance(vulnerability.precondition, list) else vulnerability.precondition
-        if len(ind_max_reward_candidates) > 1:
+        if len(ind_max_reward_candidates) > 1 and logger.isEnabledFor(logging.WARNING):
             logger.warning(f"\tChoosing candidate max_reward with node {node_id} precondition  {str(max_precondition.expression)} among other preconditions indices {ind_max_reward_candidates}")
 
         if error_type != ErrorType.NOERROR:  # ver2: error_type == ErrorType.NOERROR ver3: max_reward < 0
@@ -635,27 +652,36 @@ class AgentActions:
                         error_type = ErrorType.REPEATED
                         max_reward -= Penalty.REPEAT
 
-            logger.warning((error_string_dict[error_type] + " => " + logger_action).format(max_reward, vulnerability_id, node_id, str(profile), str(max_precondition.expression),
-                                                                                           max_reward_string, need_doctor * "doctors or " + (need_doctor + need_chemist) * "chemists"))
+            if logger.isEnabledFor(logging.WARNING):
+                logger.warning((ERROR_STRING_DICT[error_type] + " => " + LOGGER_ACTION).format(max_reward, vulnerability_id, node_id, str(profile), str(max_precondition.expression),
+                                                                                               max_reward_string, need_doctor * "doctors or " + (need_doctor + need_chemist) * "chemists"))
+            if tracer is not None:
+                tracer.record(event_kind, source_node_id, node_id, vulnerability_id,
+                              precondition_index=max_precondition_index, candidate_count=len(ind_max_reward_candidates),
+                              error_type=error_type.value, reward=max_reward, cost=vulnerability.cost)
             return False, ActionResult(reward=max_reward, outcome=max_outcome, profile=profile,
                                        precondition=max_precondition, reward_string=max_reward_string)
 
-        logger.info(logger_action.format(max_reward, vulnerability_id, node_id, str(profile), str(max_precondition.expression), max_reward_string))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(LOGGER_ACTION.format(max_reward, vulnerability_id, node_id, str(profile), str(max_precondition.expression), max_reward_string))
 
         reward = -vulnerability.cost
+        node_value = 0.0
         if isinstance(max_outcome, model.PrivilegeEscalation):
             if max_outcome.tag in node_info.properties:
                 reward += Penalty.REPEAT
             else:
                 last_owned_at, is_currently_owned = self.__mark_node_as_owned(node_id, max_outcome.level)
                 if not last_owned_at:
-                    reward += float(node_info.value)
+                    node_value = float(node_info.value)
+                    reward += node_value
                 node_info.properties.append(max_outcome.tag)
 
         elif isinstance(max_outcome, model.LateralMove):
             last_owned_at, is_currently_owned = self.__mark_node_as_owned(node_id)
             if not last_owned_at:
-                reward += float(node_info.value)
+                node_value = float(node_info.value)
+                reward += node_value
 
         elif isinstance(outcome, model.CustomerData):
             reward += outcome.reward
@@ -712,6 +738,13 @@ class AgentActions:
 
         assert reward == max_reward, f'{reward} and {max_reward}, action {node_id} {str(max_precondition.expression)} {str(type(max_outcome))}'
 
+        if tracer is not None:
+            tracer.record(event_kind, source_node_id, node_id, vulnerability_id,
+                          precondition_index=max_precondition_index, candidate_count=len(ind_max_reward_candidates),
+                          error_type=ErrorType.NOERROR.value, reward=max_reward, cost=vulnerability.cost, node_value=node_value,
+                          new_nodes=newly_discovered_nodes, new_credentials=newly_discovered_credentials,
+                          new_profiles=newly_discovered_profiles, new_properties=newly_discovered_properties)
+
         return True, ActionResult(reward=max_reward, outcome=max_outcome, profile=profile,
                                   precondition=max_precondition, reward_string=max_reward_string)
 
@@ -754,6 +787,7 @@ class AgentActions:
             profile=profile,
             local_or_remote=False,
             failed_penalty=Penalty.FAILED_REMOTE_EXPLOIT,
+            source_node_id=node_id,
             # We do not throw if the vulnerability is missing in order to
             # allow agent attempts to explore potential remote vulnerabilities
             throw_if_vulnerability_not_present=False
@@ -790,7 +824,8 @@ class AgentActions:
             node_id, node_info,
             local_or_remote=True,
             failed_penalty=Penalty.LOCAL_EXPLOIT_FAILED,
-            throw_if_vulnerability_not_present=False)
+            throw_if_vulnerability_not_present=False,
+            source_node_id=node_id)
 
         return result
 
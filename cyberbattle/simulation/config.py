@@ -1,7 +1,12 @@
+import atexit
 import sys
 import logging
 import os
+import threading
+import time
+from collections import deque
 from dotenv import load_dotenv
+import numpy as np
 import datetime
 from torch.utils.tensorboard import SummaryWriter
 
@@ -56,7 +61,13 @@ class Configuration():
         self.log_dir = os.path.join(log_dir, gymid, datetime_str)
         self.summary_dir = None
         self.log_level = os.getenv("LOG_LEVEL", "info")
+        # headless runs only log errors and episode level metrics, and keep stdout untouched
+        self.headless = os.getenv("HEADLESS", 'False').lower() in ('true', '1', 't')
         self.writer = None
+        # the summary writer writes its buffered values every `summary_flush_secs` seconds,
+        # or as soon as `summary_max_queue` values are pending
+        self.summary_flush_secs = float(os.getenv("SUMMARY_FLUSH_SECS", 10))
+        self.summary_max_queue = int(os.getenv("SUMMARY_MAX_QUEUE", 1000))
         self.honeytokens_on = {"HT1_v2tov1": True, "HT2_phonebook": True, "HT3_state": True, "HT4_cloudactivedefense": True}
         if type(self.honeytokens_on) == str:
             self.honeytokens_on = {{ht_include_tuple.split(':')[0].strip(): ht_include_tuple.split(':')[1].strip().lower() in ['true', 'True']}
@@ -82,7 +93,7 @@ class Configuration():
         #     return logging.getLogger("General")
         # self.logger = logging.getLogger(LOGGER_NAME)
 
-        self.logger.setLevel(log_level_dict[self.log_level])
+        self.logger.setLevel(logging.ERROR if self.headless else log_level_dict[self.log_level])
 
         # self.logger.disabled = True
         # handler = logging.StreamHandler(sys.stdout)
@@ -92,7 +103,8 @@ class Configuration():
 
         if self.log_results:
             # os.makedirs(self.log_dir, exist_ok=True)
-            sys.stdout = LoggerWriter(self.logger, log_level_dict[self.log_level])  # logging.INFO)
+            if not self.headless:
+                sys.stdout = LoggerWriter(self.logger, log_level_dict[self.log_level])  # logging.INFO)
             # sys.stderr = LoggerWriter(self.logger, logging.ERROR)
             handler = logging.FileHandler(os.path.join(self.log_dir, 'logfile.log'))
             formatter = logging.Formatter(fmt="[%(asctime)s] %(levelname)s: %(message)s", datefmt='%Y-%m-%d %H:%M:%S')
@@ -110,26 +122,93 @@ class Configuration():
         if self.log_results:
             self.summary_dir = os.path.join(self.log_dir, 'training/' if 'dql' in self.log_dir else '')
             os.makedirs(self.summary_dir, exist_ok=True)
-        self.writer = WriterWrapper(log_results=self.log_results, log_dir=self.summary_dir)
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = BackgroundSummaryWriter(log_dir=self.summary_dir, flush_secs=self.summary_flush_secs,
+                                              max_queue=self.summary_max_queue) if self.log_results else NullWriter()
 
 
-class WriterWrapper(SummaryWriter):
+class NullWriter():
+    """Summary writer used when results are not logged, all its methods do nothing"""
+    log_results = False
+    file_writer = None
 
-    def __init__(self, log_results: bool, **kwargs):
-        self.log_results = log_results
-        if log_results:
-            super().__init__(**kwargs)
-
-    def empty_method(self, *args, **kwargs):
+    def add_scalar(self, *args, **kwargs):
         pass
 
-    def __getattribute__(self, attr):
-        if hasattr(SummaryWriter, attr):
-            if not self.log_results and callable(getattr(SummaryWriter, attr)):  # callable(method)
-                # print("No writer")
-                return super().__getattribute__("empty_method")
-            return super().__getattribute__(attr)
-        return object.__getattribute__(self, attr)
+    add_text = add_histogram = flush = close = add_scalar
+
+
+class BackgroundSummaryWriter():
+    """TensorBoard summary writer buffering the values logged and writing them in batches from a background thread
+
+    Parameters
+    ==========
+    log_dir -- directory of the TensorBoard event files
+    flush_secs -- the buffered values are written at least this often
+    max_queue -- the buffered values are written as soon as there are this many
+    """
+    log_results = True
+
+    def __init__(self, log_dir: str, flush_secs: float = 10., max_queue: int = 1000):
+        self.writer = SummaryWriter(log_dir=log_dir, max_queue=max_queue, flush_secs=flush_secs)
+        self.flush_secs = flush_secs
+        self.max_queue = max_queue
+        # (method of the SummaryWriter, arguments) of the values to write, appended by the training thread
+        self.__pending: deque = deque()
+        self.__lock = threading.Lock()
+        self.__wake = threading.Event()
+        self.__closed = False
+        self.__thread = threading.Thread(target=self.__run, name='BackgroundSummaryWriter', daemon=True)
+        self.__thread.start()
+        # the background thread is a daemon: write what is left when the interpreter exits
+        atexit.register(self.close)
+
+    @property
+    def file_writer(self):
+        return self.writer.file_writer
+
+    def __enqueue(self, method, args) -> None:
+        self.__pending.append((method, args))
+        if len(self.__pending) >= self.max_queue:
+            self.__wake.set()
+
+    def add_scalar(self, tag, scalar_value, global_step=None, walltime=None) -> None:
+        self.__enqueue(SummaryWriter.add_scalar, (tag, float(scalar_value), global_step, walltime or time.time()))
+
+    def add_text(self, tag, text_string, global_step=None, walltime=None) -> None:
+        self.__enqueue(SummaryWriter.add_text, (tag, text_string, global_step, walltime or time.time()))
+
+    def add_histogram(self, tag, values, global_step=None, bins='tensorflow', walltime=None, max_bins=None) -> None:
+        # copied: the caller may modify its array before the background thread writes it
+        self.__enqueue(SummaryWriter.add_histogram, (tag, np.array(values, copy=True), global_step, bins, walltime or time.time(), max_bins))
+
+    def __write_pending(self) -> None:
+        with self.__lock:
+            while self.__pending:
+                method, args = self.__pending.popleft()
+                method(self.writer, *args)
+            self.writer.flush()
+
+    def __run(self) -> None:
+        while not self.__closed:
+            self.__wake.wait(self.flush_secs)
+            self.__wake.clear()
+            self.__write_pending()
+
+    def flush(self) -> None:
+        """Write all the buffered values now"""
+        self.__write_pending()
+
+    def close(self) -> None:
+        """Write the buffered values and stop the background thread"""
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__wake.set()
+        self.__thread.join()
+        self.__write_pending()
+        self.writer.close()
 
 
 configuration = Configuration()
@@ -0,0 +1,57 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Test the summary writers"""
+
+import time
+
+import numpy as np
+from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
+
+from cyberbattle.simulation.config import BackgroundSummaryWriter, NullWriter
+
+
+def scalars(log_dir: str, tag: str):
+    accumulator = EventAccumulator(log_dir)
+    accumulator.Reload()
+    return [(event.step, event.value) for event in accumulator.Scalars(tag)] if tag in accumulator.Tags()['scalars'] else []
+
+
+def test_background_writer_writes_in_batches(tmpdir) -> None:
+    writer = BackgroundSummaryWriter(log_dir=str(tmpdir), flush_secs=3600, max_queue=3)
+    writer.add_scalar("total_reward", 1.0, 1)
+    writer.add_scalar("total_reward", 2.0, 2)
+    # nothing written before the size or time policy, or an explicit flush
+    assert scalars(str(tmpdir), "total_reward") == []
+
+    writer.add_scalar("total_reward", 3.0, 3)
+    for _ in range(100):
+        if len(scalars(str(tmpdir), "total_reward")) == 3:
+            break
+        time.sleep(0.05)
+    assert scalars(str(tmpdir), "total_reward") == [(1, 1.0), (2, 2.0), (3, 3.0)]
+
+    writer.add_scalar("run_mean", 0.5, 3)
+    writer.close()
+    writer.close()
+    assert scalars(str(tmpdir), "run_mean") == [(3, 0.5)]
+
+
+def test_background_writer_copies_histograms(tmpdir) -> None:
+    writer = BackgroundSummaryWriter(log_dir=str(tmpdir), flush_secs=3600, max_queue=1000)
+    values = np.zeros(10)
+    writer.add_histogram("step_reward", values, 1)
+    values += 5.0
+    writer.close()
+    accumulator = EventAccumulator(str(tmpdir))
+    accumulator.Reload()
+    histogram = accumulator.Histograms("step_reward")[0].histogram_value
+    assert histogram.min == 0.0 and histogram.max == 0.0
+
+
+def test_null_writer() -> None:
+    writer = NullWriter()
+    writer.add_scalar("total_reward", 1.0, 1)
+    writer.flush()
+    writer.close()
+    assert not writer.log_results
@@ -0,0 +1,152 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Structured tracing of the simulation internals
+
+An `EventTracer` records one typed event per attacker action (the chosen
+precondition, the error type and the components of the reward computed by
+`AgentActions`), per detection point triggered and per invalid action, in a
+preallocated ring buffer: recording an event writes one row of a numpy
+structured array, with no string formatting. When no tracer is passed to the
+environment the simulation only pays for a `None` check at each hook point.
+
+The events retained in the buffer are dumped to a binary `.npz` file on demand
+(`EventTracer.dump`) or at the end of each episode if the tracer has a
+`dump_dir`, and are read back with `load_trace`.
+
+Example usage:
+
+    tracer = EventTracer(capacity=100000, dump_dir='traces')
+    env = gym.make('CyberBattleTinyMicro-v1234', tracer=tracer)
+"""
+
+import os
+from enum import IntEnum
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class EventKind(IntEnum):
+    """Kind of a traced event"""
+    LOCAL_EXPLOIT = 0
+    REMOTE_EXPLOIT = 1
+    CONNECT = 2
+    DETECTION_POINT = 3
+    INVALID_ACTION = 4
+
+
+# Node ids, vulnerability ids (or port names) and detection point names are stored
+# as indices into the names table of the tracer, -1 standing for no name.
+EVENT_DTYPE = np.dtype([
+    ('episode', np.int32),
+    ('step', np.int32),
+    ('kind', np.uint8),
+    ('source_node', np.int32),
+    ('target_node', np.int32),
+    ('vulnerability', np.int32),
+    ('detection_point', np.int32),
+    # precondition chosen among `candidate_count` candidates with the same reward, -1 if none was evaluated
+    ('precondition_index', np.int16),
+    ('candidate_count', np.int16),
+    # `actions.ErrorType` value
+    ('error_type', np.int8),
+    # reward returned for the action and its components
+    ('reward', np.float32),
+    ('cost', np.float32),
+    ('node_value', np.float32),
+    ('new_nodes', np.int16),
+    ('new_credentials', np.int16),
+    ('new_profiles', np.int16),
+    ('new_properties', np.int16),
+])
+
+
+class EventTracer:
+    """Ring buffer of the last `capacity` simulation events
+
+    Parameters
+    ==========
+    capacity -- number of events retained, older events are overwritten
+    dump_dir -- if set, the events of each episode are dumped to `<dump_dir>/trace_e<episode>.npz`
+    when the episode ends, and the buffer is cleared
+    """
+
+    def __init__(self, capacity: int = 65536, dump_dir: Optional[str] = None):
+        self.events = np.zeros(capacity, dtype=EVENT_DTYPE)
+        self.capacity = capacity
+        self.dump_dir = dump_dir
+        # number of events recorded since the buffer was last cleared
+        self.count = 0
+        self.names: List[str] = []
+        self.__name_index: Dict[str, int] = {}
+        # current episode and step, kept up to date by the environment
+        self.episode = 0
+        self.step = 0
+
+    def intern(self, name: Optional[str]) -> int:
+        """Index of a name in the names table"""
+        if not name:
+            return -1
+        index = self.__name_index.get(name)
+        if index is None:
+            index = self.__name_index[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+    def record(self, kind: EventKind,
+               source_node: Optional[str] = None,
+               target_node: Optional[str] = None,
+               vulnerability: Optional[str] = None,
+               detection_point: Optional[str] = None,
+               precondition_index: int = -1,
+               candidate_count: int = 0,
+               error_type: int = -1,
+               reward: float = 0.0,
+               cost: float = 0.0,
+               node_value: float = 0.0,
+               new_nodes: int = 0,
+               new_credentials: int = 0,
+               new_profiles: int = 0,
+               new_properties: int = 0) -> None:
+        """Record an event at the current episode and step"""
+        self.events[self.count % self.capacity] = (
+            self.episode, self.step, kind,
+            self.intern(source_node), self.intern(target_node), self.intern(vulnerability), self.intern(detection_point),
+            precondition_index, candidate_count, error_type,
+            reward, cost, node_value, new_nodes, new_credentials, new_profiles, new_properties)
+        self.count += 1
+
+    @property
+    def dropped(self) -> int:
+        """Number of events overwritten since the buffer was last cleared"""
+        return max(0, self.count - self.capacity)
+
+    def snapshot(self) -> np.ndarray:
+        """Copy of the retained events, oldest first"""
+        if self.count <= self.capacity:
+            return self.events[:self.count].copy()
+        start = self.count % self.capacity
+        return np.concatenate([self.events[start:], self.events[:start]])
+
+    def clear(self) -> None:
+        self.count = 0
+
+    def dump(self, filename: str) -> None:
+        """Write the retained events and the names table to a binary `.npz` file"""
+        np.savez(filename, events=self.snapshot(), names=np.array(self.names, dtype=str), dropped=self.dropped)
+
+    def end_episode(self) -> None:
+        """Dump the events of the episode if a `dump_dir` is set, and start the next episode"""
+        if self.dump_dir and self.count:
+            os.makedirs(self.dump_dir, exist_ok=True)
+            self.dump(os.path.join(self.dump_dir, f'trace_e{self.episode}.npz'))
+            self.clear()
+        self.episode += 1
+        self.step = 0
+
+
+def load_trace(filename: str) -> Tuple[np.ndarray, List[str]]:
+    """The events and the names table of a trace file written by `EventTracer.dump`"""
+    with np.load(filename) as trace:
+        return trace['events'], list(trace['names'])
@@ -0,0 +1,51 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Test the simulation event tracer"""
+
+import os
+
+import gym
+import numpy as np
+
+from cyberbattle.simulation.actions import ErrorType
+from cyberbattle.simulation.tracing import EventKind, EventTracer, load_trace
+
+
+def test_ring_buffer_keeps_latest_events(tmpdir) -> None:
+    tracer = EventTracer(capacity=4)
+    for step in range(1, 7):
+        tracer.step = step
+        tracer.record(EventKind.LOCAL_EXPLOIT, 'client', 'client', 'SearchEdgeHistory', reward=float(step))
+    events = tracer.snapshot()
+    assert list(events['step']) == [3, 4, 5, 6]
+    assert tracer.dropped == 2
+    assert tracer.names == ['client', 'SearchEdgeHistory']
+
+    filename = os.path.join(tmpdir, 'trace.npz')
+    tracer.dump(filename)
+    loaded, names = load_trace(filename)
+    assert np.array_equal(loaded, events)
+    assert names[loaded['vulnerability'][0]] == 'SearchEdgeHistory' and loaded['detection_point'][0] == -1
+
+
+def test_environment_traces_each_action(tmpdir) -> None:
+    tracer = EventTracer(capacity=1000, dump_dir=str(tmpdir))
+    env = gym.make('CyberBattleTinyMicro-v1234', tracer=tracer)
+    for _ in range(2):
+        env.reset()
+        for _ in range(20):
+            _, reward, done, _ = env.step(env.sample_valid_action())
+            if done:
+                break
+    env.close()
+
+    dumps = sorted(os.listdir(tmpdir))
+    assert dumps == ['trace_e0.npz', 'trace_e1.npz']
+    events, names = load_trace(os.path.join(tmpdir, 'trace_e0.npz'))
+    actions = events[events['kind'] != EventKind.DETECTION_POINT]
+    # one event per step, except for the connections with an unknown credential
+    assert len(actions) > 0 and np.all(np.diff(actions['step']) > 0) and np.all(events['episode'] == 0)
+    exploits = events[events['kind'] <= EventKind.REMOTE_EXPLOIT]
+    assert np.all(exploits['precondition_index'][exploits['error_type'] == ErrorType.NOERROR.value] >= 0)
+    assert all(names[i] in env.environment.network.nodes for i in exploits['target_node'])
@@ -0,0 +1,214 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Run a grid of training experiments in parallel worker processes
+
+Replaces the `run_exper_*.sh` scripts converting the training notebook with
+jupytext and running it with papermill once per configuration. Each run calls
+the `main()` of the training module in its own process, with no notebook
+conversion or kernel start-up.
+
+Example usage:
+
+    python -m cyberbattle.sweep sweep.yaml --parallelism 4
+
+with a configuration file like:
+
+    output_dir: sweeps/ht_one_by_one
+    parallelism: 4
+    # environment variables of every run, set before the training module is imported
+    environment:
+      EVAL_FREQ: 50
+    # arguments passed unchanged to every run
+    parameters:
+      training_episode_count: 2000
+      log_results: true
+    # every combination of these values is a run
+    grid:
+      gymid: [CyberBattleTinyMicro]
+      honeytokens: [[1], [2], [3], [4]]
+      gamma: [0.25, 0.5]
+      reward_clip: [true, false]
+      seed: [1, 2, 3]
+
+When `honeytokens` is given, `gymid` holds environment names without a version
+and each honeytoken set selects the registered version (e.g. [1, 3] runs
+`CyberBattleTinyMicro-v13`, [] runs `CyberBattleTinyMicro-v0`). Note that a seed
+of 0 lets the training module pick a time based seed.
+
+Each finished run is recorded in `<output_dir>/runs/<run name>.json`, and runs
+already recorded as done are skipped when the sweep is restarted. The records
+of all the runs are gathered in `<output_dir>/index.json`.
+"""
+
+import argparse
+import hashlib
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from typing import Any, Dict, List, Optional
+
+import yaml
+
+DEFAULT_ENTRY_POINT = 'cyberbattle.agents.baseline.notebooks.notebook_dql_debug_with_tinymicro:main'
+
+GRID_KEYS = ['gymid', 'honeytokens', 'gamma', 'reward_clip', 'seed']
+
+
+def gymid_with_honeytokens(gymid: str, honeytokens: List[int]) -> str:
+    """Name of the registered environment version with the given honeytokens turned on"""
+    if '-v' in gymid:
+        raise ValueError(f'gymid {gymid} already has a version, it cannot be combined with a honeytoken set')
+    return gymid + '-v' + (''.join(str(h) for h in sorted(honeytokens)) or '0')
+
+
+def run_name(parameters: Dict[str, Any]) -> str:
+    """Readable and stable name of a run"""
+    digest = hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()[:8]
+    readable = [str(parameters.get('gymid'))]
+    readable += [f'{key}{parameters[key]}' for key in ['gamma', 'reward_clip', 'seed'] if key in parameters]
+    return '_'.join(readable).replace(' ', '') + '_' + digest
+
+
+def expand_grid(config: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """The `main()` arguments of every run of a sweep configuration, by run name"""
+    grid = dict(config.get('grid') or {})
+    unknown = set(grid) - set(GRID_KEYS)
+    if unknown:
+        raise ValueError(f'unsupported grid keys {sorted(unknown)}, expected some of {GRID_KEYS}')
+
+    keys = [key for key in GRID_KEYS if key in grid]
+    runs: Dict[str, Dict[str, Any]] = {}
+    for values in itertools.product(*[grid[key] for key in keys]):
+        parameters = dict(config.get('parameters') or {})
+        parameters.update(zip(keys, values))
+        if 'honeytokens' in parameters:
+            parameters['gymid'] = gymid_with_honeytokens(parameters['gymid'], parameters.pop('honeytokens'))
+        runs[run_name(parameters)] = parameters
+    return runs
+
+
+def _record_filename(output_dir: str, name: str) -> str:
+    return os.path.join(output_dir, 'runs', name + '.json')
+
+
+def load_record(output_dir: str, name: str) -> Optional[Dict[str, Any]]:
+    """The record of a run from a previous invocation of the sweep, if any"""
+    filename = _record_filename(output_dir, name)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as file:
+        return json.load(file)
+
+
+def _write_json(filename: str, content: Any) -> None:
+    # write to a temporary file first so that an interrupted sweep never leaves a truncated record
+    with open(filename + '.tmp', 'w') as file:
+        json.dump(content, file, indent=2, default=str)
+    os.replace(filename + '.tmp', filename)
+
+
+def _run(output_dir: str, name: str, parameters: Dict[str, Any],
+         environment: Dict[str, Any], entry_point: str) -> Dict[str, Any]:
+    """Run one configuration in the current (fresh) worker process and record its outcome"""
+    for variable, value in environment.items():
+        os.environ[variable] = str(value).lower() if isinstance(value, bool) else str(value)
+    # keep the log directories of runs started in the same second apart
+    os.environ['LOG_NAME_OFFSET'] = os.getenv('LOG_NAME_OFFSET', '') + '_' + name.rsplit('_', 1)[-1]
+
+    module_name, function_name = entry_point.split(':')
+    record: Dict[str, Any] = {'name': name, 'parameters': parameters}
+    start = time.time()
+    try:
+        main = getattr(importlib.import_module(module_name), function_name)
+        record['result'] = main(**parameters)
+        record['status'] = 'done'
+    except Exception:
+        record['status'] = 'failed'
+        record['error'] = traceback.format_exc()
+    record['duration'] = time.time() - start
+
+    _write_json(_record_filename(output_dir, name), record)
+    return record
+
+
+def _run_star(args) -> Dict[str, Any]:
+    return _run(*args)
+
+
+def run_sweep(config: Dict[str, Any], parallelism: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Run all the pending runs of a sweep configuration, returns the records of all its runs
+
+    Parameters
+    ==========
+
+    config -- the sweep configuration (see module documentation),
+    `entry_point` optionally names the run function as 'module:function'
+
+    parallelism -- number of runs executed at the same time, overrides the configuration
+    """
+    output_dir = config.get('output_dir', 'sweep')
+    parallelism = parallelism or config.get('parallelism') or os.cpu_count() or 1
+    environment = dict(config.get('environment') or {})
+    entry_point = config.get('entry_point', DEFAULT_ENTRY_POINT)
+    os.makedirs(os.path.join(output_dir, 'runs'), exist_ok=True)
+
+    runs = expand_grid(config)
+    records: Dict[str, Dict[str, Any]] = {}
+    pending = []
+    for name, parameters in runs.items():
+        record = load_record(output_dir, name)
+        if record and record.get('status') == 'done':
+            records[name] = record
+        else:
+            pending.append((output_dir, name, parameters, environment, entry_point))
+
+    print(f'Sweep of {len(runs)} runs: {len(records)} already done, {len(pending)} to run with parallelism {parallelism}')
+
+    def write_index():
+        _write_json(os.path.join(output_dir, 'index.json'), [records[name] for name in runs if name in records])
+
+    write_index()
+    if pending:
+        # a new process for every run: the training module reads its defaults from
+        # the environment variables and sets global configuration when imported
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(min(parallelism, len(pending)), maxtasksperchild=1) as pool:
+            for record in pool.imap_unordered(_run_star, pending):
+                records[record['name']] = record
+                print(f"[{len(records)}/{len(runs)}] {record['name']}: {record['status']} in {record['duration']:.0f}s")
+                write_index()
+
+    return [records[name] for name in runs]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Run a grid of training experiments in parallel.')
+    parser.add_argument('config', help='sweep configuration file (yaml)')
+    parser.add_argument('--parallelism', default=None, type=int,
+                        help='number of runs executed at the same time (default: from the configuration, or the cpu count)')
+    parser.add_argument('--list', action='store_true', help='only list the runs of the sweep and whether they are done')
+    args = parser.parse_args()
+
+    with open(args.config) as file:
+        config = yaml.safe_load(file)
+
+    if args.list:
+        output_dir = config.get('output_dir', 'sweep')
+        for name in expand_grid(config):
+            record = load_record(output_dir, name)
+            print(f"{record['status'] if record else 'pending':8} {name}")
+        return
+
+    records = run_sweep(config, args.parallelism)
+    failed = [record['name'] for record in records if record['status'] != 'done']
+    if failed:
+        print(f'{len(failed)} runs failed: {failed}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Test the experiment sweep runner"""
+
+import json
+import os
+
+from cyberbattle import sweep
+
+
+def fake_main(gymid, gamma, seed, training_episode_count):
+    """Stand-in for a training run"""
+    if gamma > 1.0:
+        raise ValueError('gamma must be at most 1')
+    return {'gymid': gymid, 'score': gamma * seed, 'training_episode_count': training_episode_count}
+
+
+def test_expand_grid() -> None:
+    runs = sweep.expand_grid({
+        'parameters': {'training_episode_count': 10},
+        'grid': {'gymid': ['CyberBattleTinyMicro'], 'honeytokens': [[], [3, 1]], 'gamma': [0.25, 0.5], 'seed': [1, 2, 3]}
+    })
+    assert len(runs) == 12
+    assert {run['gymid'] for run in runs.values()} == {'CyberBattleTinyMicro-v0', 'CyberBattleTinyMicro-v13'}
+    assert all(run['training_episode_count'] == 10 and 'honeytokens' not in run for run in runs.values())
+    # names are stable across invocations
+    assert list(runs) == list(sweep.expand_grid({
+        'parameters': {'training_episode_count': 10},
+        'grid': {'gymid': ['CyberBattleTinyMicro'], 'honeytokens': [[], [3, 1]], 'gamma': [0.25, 0.5], 'seed': [1, 2, 3]}
+    }))
+
+
+def test_run_sweep_skips_finished_runs(tmpdir) -> None:
+    config = {
+        'output_dir': str(tmpdir),
+        'entry_point': 'cyberbattle.sweep_test:fake_main',
+        'parameters': {'training_episode_count': 5},
+        'grid': {'gymid': ['CyberBattleTinyMicro-v0'], 'gamma': [0.5, 2.0], 'seed': [1, 2]}
+    }
+    records = sweep.run_sweep(config, parallelism=2)
+    assert sorted(record['status'] for record in records) == ['done', 'done', 'failed', 'failed']
+    assert {record['result']['score'] for record in records if record['status'] == 'done'} == {0.5, 1.0}
+
+    # the finished runs are not executed again
+    done = [record['name'] for record in records if record['status'] == 'done']
+    modified_times = [os.path.getmtime(os.path.join(tmpdir, 'runs', name + '.json')) for name in done]
+    config['grid']['gamma'] = [0.5, 1.0]
+    records = sweep.run_sweep(config, parallelism=2)
+    assert [record['status'] for record in records] == ['done'] * 4
+    assert modified_times == [os.path.getmtime(os.path.join(tmpdir, 'runs', name + '.json')) for name in done]
+
+    with open(os.path.join(tmpdir, 'index.json')) as file:
+        index = json.load(file)
+    assert [record['name'] for record in index] == [record['name'] for record in records]